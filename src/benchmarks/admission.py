@@ -0,0 +1,43 @@
+"""Goodput of the app under overload with and without admission control
+
+For every --concurrency the load generator runs the app in process with ADMISSION=N and ADMISSION=Y. Goodput counts
+operations which succeeded within --timeout seconds, the deadline of clients. Without admission control requests
+queue for pooled connections and answers come after clients gave up; with it requests over the limit get 503 at once
+and admitted ones finish in time. Arguments not listed here are passed to src.benchmarks.load.
+
+Usage: python -m src.benchmarks.admission --concurrency 50 200 800 --duration 20 --timeout 1 --users 1000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from src.main.utils.constants import YES, NO
+
+
+def step(admission: str, concurrency: int, rest) -> dict:
+    # Middlewares are added when the app is imported, so every run has its own process
+    output = subprocess.run([sys.executable, '-m', 'src.benchmarks.load', '--concurrency', str(concurrency), *rest],
+                            env={**os.environ, 'ADMISSION': admission}, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=True, text=True).stdout
+    report = json.loads(output.splitlines()[-1])
+    return {'admission': admission, 'concurrency': concurrency, 'ops_per_sec': report['ops_per_sec'],
+            'goodput_per_sec': report['goodput_per_sec'], 'latency_ms': report['latency_ms'],
+            'errors': report['errors']}
+
+
+def main(args, rest):
+    for concurrency in args.concurrency:
+        for admission in (NO, YES):
+            print(json.dumps(step(admission, concurrency, rest)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 800])
+    args, rest = parser.parse_known_args()
+    # Users are seeded by few clients, so they aren't rejected
+    if '--seed-concurrency' not in rest:
+        rest += ['--seed-concurrency', '10']
+    main(args, rest)
@@ -0,0 +1,58 @@
+"""Measures deposit throughput and number of commits depending on the coalescing window
+
+Window 0 means every deposit commits its own transaction.
+
+Usage: python -m src.benchmarks.coalescer --deposits 5000 --concurrency 200 --users 1000 --windows 0 1 2 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from src.benchmarks.utils import latency_summary, seed_users
+from src.main.coalescer import DepositCoalescer
+from src.main.crud import create_transaction
+from src.main.settings import database, init_db, settings, spawn
+
+
+async def run(window_ms: float, user_ids, deposits: int, concurrency: int) -> dict:
+    settings.coalesce_window_ms = window_ms
+    coalescer = DepositCoalescer()
+    latencies = []
+
+    async def deposit(user_id: int):
+        if window_ms > 0:
+            return await coalescer.submit(user_id=user_id, amount='1')
+        return await create_transaction(to_user_id=user_id, amount='1')
+
+    async def worker(offset: int, count: int):
+        for i in range(count):
+            start = time.perf_counter()
+            await deposit(user_ids[(offset + i * concurrency) % len(user_ids)])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(n, deposits // concurrency)) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    commits = coalescer.flushes if window_ms > 0 else len(latencies)
+    return {'window_ms': window_ms, 'deposits': len(latencies), 'deposits_per_sec': round(len(latencies) / elapsed, 1),
+            'commits': commits, 'commits_per_sec': round(commits / elapsed, 1), **latency_summary(latencies)}
+
+
+async def main(args):
+    await init_db()
+    settings.coalesce_max_items = args.max_items
+    user_ids = [user.user_id for user in await seed_users(args.users)]
+    for window_ms in args.windows:
+        print(json.dumps(await run(window_ms, user_ids, args.deposits, args.concurrency)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deposits', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--max-items', type=int, default=500)
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 1, 2, 5])
+    asyncio.run(main(args=parser.parse_args()))
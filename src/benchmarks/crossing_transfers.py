@@ -0,0 +1,96 @@
+"""Fires concurrent transfers in opposite directions between pairs of wallets and checks that no money is lost
+
+Exits with status 1 if the total balance changed, ledger and balances disagree or any transfer failed for
+a reason other than insufficient funds.
+
+Usage: python -m src.benchmarks.crossing_transfers --pairs 10 --transfers 5000 --concurrency 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from decimal import Decimal
+
+from sqlalchemy import select, func, case
+
+from src.benchmarks.utils import seed_users
+from src.main.crud import create_transaction
+from src.main.model import wallets, transactions, TransactionType
+from src.main.retry import retry_stats
+from src.main.settings import database, init_db, spawn
+
+
+async def total_balance(wallet_ids) -> Decimal:
+    query = select([func.coalesce(func.sum(wallets.c.balance), 0)]).where(wallets.c.id.in_(wallet_ids))
+    return await database.fetch_val(query)
+
+
+async def ledger_mismatches(wallet_ids) -> int:
+    """Number of wallets whose balance differs from the sum of their ledger rows"""
+    signed_amount = case((transactions.c.type == TransactionType.debit, transactions.c.amount),
+                         else_=-transactions.c.amount)
+    ledger = (select([transactions.c.wallet_id, func.sum(signed_amount).label('total')])
+              .where(transactions.c.wallet_id.in_(wallet_ids))
+              .group_by(transactions.c.wallet_id)
+              .subquery())
+    query = (select([func.count()])
+             .select_from(wallets.outerjoin(ledger, ledger.c.wallet_id == wallets.c.id))
+             .where(wallets.c.id.in_(wallet_ids))
+             .where(func.coalesce(ledger.c.total, 0) != wallets.c.balance))
+    return await database.fetch_val(query)
+
+
+async def run(pairs: int, transfers: int, concurrency: int) -> dict:
+    users = await seed_users(2 * pairs, balance='100')
+    wallet_ids = [user.wallet_id for user in users]
+    before = await total_balance(wallet_ids)
+    retry_stats.reset()
+    outcomes = {'applied': 0, 'insufficient_funds': 0, 'failed': 0}
+    errors = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            pair = random.randrange(pairs)
+            from_user, to_user = random.sample(users[2 * pair:2 * pair + 2], 2)
+            try:
+                await create_transaction(to_user_id=to_user.user_id, from_user_id=from_user.user_id,
+                                         amount=str(random.randint(1, 10)))
+                outcomes['applied'] += 1
+            except ValueError as e:
+                if 'Not enough money' not in str(e):
+                    raise
+                outcomes['insufficient_funds'] += 1
+            except Exception as e:
+                outcomes['failed'] += 1
+                errors.append(repr(e))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(transfers // concurrency)) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    after = await total_balance(wallet_ids)
+    return {**outcomes,
+            'transfers_per_sec': round(sum(outcomes.values()) / elapsed, 1),
+            **retry_stats.as_dict(),
+            'total_before': str(before),
+            'total_after': str(after),
+            'ledger_mismatches': await ledger_mismatches(wallet_ids),
+            'errors': errors[:5]}
+
+
+async def main(args) -> int:
+    await init_db()
+    result = await run(args.pairs, args.transfers, args.concurrency)
+    await database.disconnect()
+    print(json.dumps(result))
+    ok = result['total_before'] == result['total_after'] and not result['ledger_mismatches'] and not result['failed']
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pairs', type=int, default=10)
+    parser.add_argument('--transfers', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    sys.exit(asyncio.run(main(parser.parse_args())))
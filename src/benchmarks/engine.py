@@ -0,0 +1,70 @@
+"""Compares deposit and transfer throughput of storage engines
+
+Engines: postgres, memory (no persistence) and memory-wal (write-ahead log fsynced with group commit). Every
+operation is a deposit or, with probability --transfers, a transfer between two random users.
+
+Usage: python -m src.benchmarks.engine --operations 20000 --concurrency 100 --users 1000 --transfers 0.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+
+from src.benchmarks.utils import latency_summary
+from src.main.engine import StorageEngine, PostgresEngine, MemoryEngine
+from src.main.model import UserRequest
+from src.main.settings import spawn
+
+
+async def run(name: str, engine: StorageEngine, args) -> dict:
+    await engine.connect()
+    user_ids = []
+    for i in range(args.users):
+        user = await engine.create_user(request=UserRequest(first_name=f'bench{i}', last_name='bench'))
+        await engine.create_transaction(to_user_id=user.user_id, amount='1000000')
+        user_ids.append(user.user_id)
+    latencies, errors = [], 0
+
+    async def worker(count: int):
+        nonlocal errors
+        for _ in range(count):
+            to_user_id, from_user_id = random.sample(user_ids, 2)
+            start = time.perf_counter()
+            try:
+                await engine.create_transaction(to_user_id=to_user_id, amount='1',
+                                                from_user_id=from_user_id if random.random() < args.transfers
+                                                else None)
+            except ValueError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(args.operations // args.concurrency)) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    await engine.disconnect()
+    return {'engine': name, 'operations': len(latencies), 'errors': errors,
+            'ops_per_sec': round(len(latencies) / elapsed, 1), **latency_summary(latencies)}
+
+
+async def main(args):
+    for name in args.engines:
+        if name == 'postgres':
+            engine = PostgresEngine()
+        elif name == 'memory':
+            engine = MemoryEngine()
+        else:
+            engine = MemoryEngine(data_dir=tempfile.mkdtemp(prefix='bench-engine-'))
+        print(json.dumps(await run(name, engine, args)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--transfers', type=float, default=0.5, help='share of transfers among operations')
+    parser.add_argument('--engines', nargs='+', choices=['postgres', 'memory', 'memory-wal'],
+                        default=['postgres', 'memory', 'memory-wal'])
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,75 @@
+"""CPU cost per request of the regular and the fast path of /deposit_money/ and /transfer_money/
+
+Parsing of the body and serialization of the response are timed alone first: pydantic validation and
+jsonable_encoder with json against fast_path.parse and orjson. Then --requests requests are sent in process to the
+app with FAST_PATH=N and FAST_PATH=Y and the CPU time (time.process_time) per request is reported. The storage engine
+is replaced by a stub answering at once, so the database isn't measured; the in-process client is included in both.
+
+Usage: python -m src.benchmarks.fast_path --operations 100000 --requests 5000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+
+from src.benchmarks.load import in_process_client
+from src.main import fast_path
+from src.main.app import app
+from src.main.engine import engine
+from src.main.model import DepositRequest, TransferRequest, Transaction
+from src.main.settings import settings
+from src.main.utils.constants import DEPOSIT_MONEY, TRANSFER_MONEY, YES, NO
+
+BODIES = {'deposit': (DEPOSIT_MONEY, DepositRequest, b'{"user_id": 1, "amount": "10.25"}'),
+          'transfer': (TRANSFER_MONEY, TransferRequest, b'{"from_user_id": 1, "to_user_id": 2, "amount": "10.25"}')}
+
+
+def codec_cost(operations: int) -> dict:
+    result = Transaction(debit_transaction_id=1, credit_transaction_id=2)
+    costs = {}
+    for operation, (_, model, body) in BODIES.items():
+        start = time.process_time()
+        for _ in range(operations):
+            model.parse_raw(body)
+            json.dumps(jsonable_encoder(Transaction.validate(result)), separators=(',', ':')).encode()
+        costs[f'{operation}_regular_us'] = round((time.process_time() - start) / operations * 1e6, 2)
+        start = time.process_time()
+        for _ in range(operations):
+            fast_path.parse(model, body)
+            fast_path.dumps(result.dict())
+        costs[f'{operation}_fast_us'] = round((time.process_time() - start) / operations * 1e6, 2)
+    return costs
+
+
+async def request_cost(client: httpx.AsyncClient, path: str, body: bytes, requests: int) -> float:
+    start = time.process_time()
+    for _ in range(requests):
+        response = await client.post(path, content=body)
+        assert response.status_code == 200, response.text
+    return round((time.process_time() - start) / requests * 1e6, 1)
+
+
+async def main(args):
+    print(json.dumps({'mode': 'codec', **codec_cost(args.operations)}))
+
+    async def create_transaction(to_user_id, amount, from_user_id=None, idempotency_key=None):
+        return Transaction(debit_transaction_id=1, credit_transaction_id=2 if from_user_id else None)
+
+    engine.create_transaction = create_transaction
+    async with in_process_client(app) as client:
+        for mode in (NO, YES):
+            settings.fast_path = mode
+            report = {'mode': 'request', 'fast_path': mode}
+            for operation, (path, _, body) in BODIES.items():
+                report[f'{operation}_cpu_us'] = await request_cost(client, path, body, args.requests)
+            print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=5000)
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,72 @@
+"""Measures latency of transaction history pages on a large ledger
+
+Ledger rows are generated in the database. A sample of wallets is paged through newest first; latency of the
+first page and of pages deep into the history should stay the same as the ledger grows.
+
+Usage: python -m src.benchmarks.history --rows 10000000 --wallets 10000 --samples 200 --pages 20 --limit 100
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from src.benchmarks.utils import latency_summary, seed_users
+from src.main.crud import get_transactions_page
+from src.main.model import TransactionType
+from src.main.settings import database, init_db
+
+CHUNK = 1000000
+
+SEED_LEDGER = """
+    INSERT INTO public.transactions (wallet_id, type, amount, transaction_timestamp)
+    SELECT (CAST(:wallet_ids AS bigint[]))[1 + i % :wallets], CASE WHEN i % 3 = 0 THEN 'credit' ELSE 'debit' END,
+           1 + i % 100, CURRENT_TIMESTAMP - make_interval(secs => i)
+    FROM generate_series(CAST(:start AS bigint), CAST(:stop AS bigint)) AS i
+"""
+
+
+async def seed_ledger(rows: int, wallets: int):
+    users = await seed_users(wallets)
+    wallet_ids = [user.wallet_id for user in users]
+    for start in range(0, rows, CHUNK):
+        await database.execute(query=SEED_LEDGER, values={'wallet_ids': wallet_ids, 'wallets': wallets,
+                                                          'start': start, 'stop': min(rows, start + CHUNK) - 1})
+    await database.execute('ANALYZE public.transactions')
+    return users
+
+
+async def run(users, samples: int, pages: int, limit: int, type_: TransactionType = None) -> dict:
+    first, deep = [], []
+    for user in random.sample(users, min(samples, len(users))):
+        cursor = None
+        for page_number in range(pages):
+            start = time.perf_counter()
+            page = await get_transactions_page(user_id=user.user_id, limit=limit, cursor=cursor, type_=type_)
+            (first if page_number == 0 else deep).append(time.perf_counter() - start)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+    return {'type': type_, 'limit': limit, 'first_page': latency_summary(first), 'next_pages': latency_summary(deep)}
+
+
+async def main(args):
+    await init_db()
+    start = time.perf_counter()
+    users = await seed_ledger(args.rows, args.wallets)
+    total = await database.fetch_val('SELECT count(*) FROM public.transactions')
+    print(json.dumps({'seeded_rows': args.rows, 'ledger_rows': total,
+                      'seed_sec': round(time.perf_counter() - start, 1)}))
+    for type_ in (None, TransactionType.credit):
+        print(json.dumps(await run(users, args.samples, args.pages, args.limit, type_)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--wallets', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=100)
+    asyncio.run(main(args=parser.parse_args()))
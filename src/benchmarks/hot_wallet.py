@@ -0,0 +1,52 @@
+"""Measures deposit throughput into a single wallet depending on the number of its balance slots
+
+Slots 0 means a regular wallet whose row is locked by every deposit.
+
+Usage: python -m src.benchmarks.hot_wallet --deposits 4000 --concurrency 24 --slots 0 1 2 4 8 16
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from src.benchmarks.utils import latency_summary, seed_users
+from src.main.crud import create_transaction, get_wallet
+from src.main.hot_wallets import make_wallet_hot
+from src.main.model import HotWalletRequest
+from src.main.settings import database, init_db, spawn
+
+
+async def run(slots: int, deposits: int, concurrency: int) -> dict:
+    user, = await seed_users(1)
+    if slots:
+        await make_wallet_hot(request=HotWalletRequest(user_id=user.user_id, slots=slots))
+    latencies = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            await create_transaction(to_user_id=user.user_id, amount='1')
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(deposits // concurrency)) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    wallet = await get_wallet(user_id=user.user_id)
+    assert wallet['balance'] == len(latencies), f'Balance {wallet["balance"]} after {len(latencies)} deposits'
+    return {'slots': slots, 'deposits': len(latencies), 'deposits_per_sec': round(len(latencies) / elapsed, 1),
+            **latency_summary(latencies)}
+
+
+async def main(args):
+    await init_db()
+    for slots in args.slots:
+        print(json.dumps(await run(slots, args.deposits, args.concurrency)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deposits', type=int, default=4000)
+    parser.add_argument('--concurrency', type=int, default=24)
+    parser.add_argument('--slots', type=int, nargs='+', default=[0, 1, 2, 4, 8, 16])
+    asyncio.run(main(parser.parse_args()))
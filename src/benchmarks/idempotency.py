@@ -0,0 +1,51 @@
+"""Measures latency of deposits with idempotency keys: first attempts, retries answered by the in-process cache and
+retries answered by the idempotency_keys table
+
+Usage: python -m src.benchmarks.idempotency --deposits 2000 --concurrency 50 --users 100
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from src.benchmarks.utils import latency_summary, seed_users
+from src.main.crud import create_transaction
+from src.main.idempotency import idempotency_cache
+from src.main.settings import database, init_db, spawn
+
+
+async def run(name: str, keys, user_ids, concurrency: int) -> dict:
+    latencies = []
+
+    async def worker(offset: int):
+        for i in range(offset, len(keys), concurrency):
+            start = time.perf_counter()
+            await create_transaction(to_user_id=user_ids[i % len(user_ids)], amount='1', idempotency_key=keys[i])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(n)) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {'attempt': name, 'deposits': len(latencies), 'deposits_per_sec': round(len(latencies) / elapsed, 1),
+            **latency_summary(latencies)}
+
+
+async def main(args):
+    await init_db()
+    user_ids = [user.user_id for user in await seed_users(args.users)]
+    keys = [str(uuid.uuid4()) for _ in range(args.deposits)]
+    idempotency_cache.maxsize = args.deposits
+    print(json.dumps(await run('first', keys, user_ids, args.concurrency)))
+    print(json.dumps(await run('retry_cached', keys, user_ids, args.concurrency)))
+    idempotency_cache.clear()
+    print(json.dumps(await run('retry_stored', keys, user_ids, args.concurrency)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deposits', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=100)
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,109 @@
+"""Compares insert and history query cost of a single table ledger and a partitioned one as they grow
+
+Both tables get the same rows, one month of them per step. After every step, inserting the next month is timed
+and a sample of wallets is queried for the latest page of history and for the page of the last week.
+
+Usage: python -m src.benchmarks.ledger --months 12 --rows-per-month 1000000 --wallets 10000 --samples 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import date
+
+from src.benchmarks.utils import latency_summary
+from src.main.settings import database, init_db
+
+LAYOUTS = {
+    'single': """
+        CREATE TABLE public.bench_ledger_single
+        (LIKE public.transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (id))
+    """,
+    'partitioned': """
+        CREATE TABLE public.bench_ledger_partitioned
+        (LIKE public.transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (id, transaction_timestamp))
+        PARTITION BY RANGE (transaction_timestamp)
+    """,
+}
+
+INSERT_MONTH = """
+    INSERT INTO public.{table} (id, wallet_id, type, amount, transaction_timestamp)
+    SELECT :first_id + i, 1 + i % :wallets, 'debit', 1,
+           CAST(:month AS timestamp) + (i % :rows) * (interval '28 days' / :rows)
+    FROM generate_series(0, :rows - 1) AS i
+"""
+
+LATEST_PAGE = """
+    SELECT id, amount FROM public.{table} WHERE wallet_id = :wallet_id
+    ORDER BY transaction_timestamp DESC, id DESC LIMIT 100
+"""
+
+LAST_WEEK_PAGE = """
+    SELECT id, amount FROM public.{table} WHERE wallet_id = :wallet_id AND transaction_timestamp >= :since
+    ORDER BY transaction_timestamp DESC, id DESC LIMIT 100
+"""
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+async def setup(start: date, months: int):
+    for layout, ddl in LAYOUTS.items():
+        await database.execute(f'DROP TABLE IF EXISTS public.bench_ledger_{layout}')
+        await database.execute(ddl)
+        await database.execute(f'CREATE INDEX ON public.bench_ledger_{layout} '
+                               f'(wallet_id, transaction_timestamp DESC, id DESC)')
+    for month in range(months):
+        await database.execute(f"CREATE TABLE public.bench_ledger_partitioned_{month} "
+                               f"PARTITION OF public.bench_ledger_partitioned "
+                               f"FOR VALUES FROM ('{add_months(start, month)}') TO ('{add_months(start, month + 1)}')")
+
+
+async def query_latency(query: str, wallets: int, samples: int, values: dict = None):
+    latencies = []
+    for wallet_id in random.sample(range(1, wallets + 1), min(samples, wallets)):
+        start = time.perf_counter()
+        await database.fetch_all(query=query, values={'wallet_id': wallet_id, **(values or {})})
+        latencies.append(time.perf_counter() - start)
+    return latency_summary(latencies)
+
+
+async def main(args):
+    await init_db()
+    start = add_months(date.today(), -args.months)
+    await setup(start, args.months)
+    for month in range(args.months):
+        step = {'rows': (month + 1) * args.rows_per_month}
+        for layout in LAYOUTS:
+            table = f'bench_ledger_{layout}'
+            began = time.perf_counter()
+            await database.execute(query=INSERT_MONTH.format(table=table),
+                                   values={'first_id': month * args.rows_per_month, 'wallets': args.wallets,
+                                           'month': add_months(start, month), 'rows': args.rows_per_month})
+            inserted = time.perf_counter() - began
+            await database.execute(f'ANALYZE public.{table}')
+            last_week = add_months(start, month + 1).toordinal() - 7
+            step[layout] = {
+                'insert_rows_per_sec': round(args.rows_per_month / inserted),
+                'latest_page': await query_latency(LATEST_PAGE.format(table=table), args.wallets, args.samples),
+                'last_week_page': await query_latency(LAST_WEEK_PAGE.format(table=table), args.wallets,
+                                                      args.samples, {'since': date.fromordinal(last_week)}),
+            }
+        print(json.dumps(step))
+    if not args.keep:
+        for layout in LAYOUTS:
+            await database.execute(f'DROP TABLE public.bench_ledger_{layout}')
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--rows-per-month', type=int, default=1000000)
+    parser.add_argument('--wallets', type=int, default=10000)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--keep', action='store_true', help="don't drop benchmark tables")
+    asyncio.run(main(args=parser.parse_args()))
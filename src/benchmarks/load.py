@@ -0,0 +1,276 @@
+"""Load generator for the payment endpoints
+
+Seeds users through /create_user/ and /deposit_money/, then runs a mix of deposits and transfers from --concurrency
+clients for --operations requests or --duration seconds. Wallets are picked with a Zipf distribution of exponent
+--skew (0 is uniform), so a few hot wallets get most of the traffic. Requests go to the app in process, through
+httpx.AsyncClient(app=app), or to a running service given by --url.
+
+Reports throughput, goodput (operations which succeeded within --timeout per second), p50/p95/p99/p999 latency,
+errors by kind, the deadlock rate (retried and failed) and checks that money was conserved: balances grew exactly by
+the successful deposits and none of them is negative. The report is printed and optionally written to --output. With
+--baseline, throughput and latency are compared against a saved report and the exit code is 1 if any of them
+regressed by more than --tolerance.
+
+Usage: python -m src.benchmarks.load --users 1000 --skew 1.1 --operations 20000 --concurrency 50 --output run.json
+       python -m src.benchmarks.load --url http://127.0.0.1:8003 --duration 60 --baseline run.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from decimal import Decimal
+from typing import List, Dict, Optional
+
+import httpx
+
+from src.benchmarks.utils import latency_summary
+from src.main.settings import spawn
+from src.main.utils.constants import CREATE_USER, DEPOSIT_MONEY, TRANSFER_MONEY, WALLET_BALANCE, RETRY_STATS, \
+    TEST_URL, DEADLOCK_DETECTED
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def zipf_weights(count: int, skew: float) -> List[float]:
+    """Weight of the wallet of rank i is 1 / (i + 1) ** skew"""
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
+def opening_balances(count: int, distribution: str, balance: int, skew: float) -> List[int]:
+    """Balances of seeded users, their mean is close to balance"""
+    if distribution == 'fixed':
+        return [balance] * count
+    if distribution == 'uniform':
+        return [random.randint(0, 2 * balance) for _ in range(count)]
+    weights = zipf_weights(count, skew)
+    total = sum(weights)
+    return [round(balance * count * weight / total) for weight in weights]
+
+
+def error_kind(response: httpx.Response) -> Optional[str]:
+    if response.status_code < 300:
+        return None
+    if 'Not enough money' in response.text:
+        return 'insufficient_funds'
+    if 'deadlock detected' in response.text:
+        return 'deadlock'
+    return f'http_{response.status_code}'
+
+
+class LoadGenerator:
+    """Drives the endpoints from concurrent clients and records latencies and errors per operation"""
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.user_ids: List[int] = []
+        self.cum_weights: List[float] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+        self.good: Dict[str, int] = defaultdict(int)
+        self.deposited = Decimal(0)
+
+    async def request(self, operation: str, path: str, payload: dict) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(path, json=payload)
+        except httpx.HTTPError:
+            self.errors[operation]['transport'] += 1
+            return None
+        elapsed = time.perf_counter() - start
+        self.latencies[operation].append(elapsed)
+        kind = error_kind(response)
+        if kind is not None:
+            self.errors[operation][kind] += 1
+            # Clients of an overloaded service back off as asked
+            if 'retry-after' in response.headers:
+                await asyncio.sleep(float(response.headers['retry-after']))
+            return None
+        # The app in process answers late instead of timing out
+        if elapsed <= self.args.timeout:
+            self.good[operation] += 1
+        return response
+
+    async def seed(self):
+        balances = opening_balances(self.args.users, self.args.balance_distribution, self.args.balance,
+                                    self.args.skew)
+        user_ids: List[Optional[int]] = [None] * self.args.users
+        indexes = iter(range(self.args.users))
+
+        async def worker():
+            for i in indexes:
+                response = await self.request('create_user', CREATE_USER,
+                                              {'first_name': f'load{i}', 'last_name': 'load'})
+                if response is None:
+                    continue
+                user_ids[i] = response.json()['user_id']
+                if balances[i] > 0 and await self.request('deposit', DEPOSIT_MONEY,
+                                                          {'user_id': user_ids[i], 'amount': str(balances[i])}):
+                    self.deposited += balances[i]
+
+        await asyncio.gather(*(spawn(worker()) for _ in range(self.args.seed_concurrency or self.args.concurrency)))
+        # Ranks follow the order of creation, so the first users are the hot ones
+        self.user_ids = [user_id for user_id in user_ids if user_id is not None]
+        self.cum_weights = list(itertools.accumulate(zipf_weights(len(self.user_ids), self.args.skew)))
+
+    def pick(self) -> int:
+        return random.choices(self.user_ids, cum_weights=self.cum_weights)[0]
+
+    async def operation(self):
+        amount = random.randint(1, self.args.max_amount)
+        if random.random() < self.args.transfers:
+            from_user_id, to_user_id = self.pick(), self.pick()
+            while to_user_id == from_user_id:
+                to_user_id = self.pick()
+            await self.request('transfer', TRANSFER_MONEY,
+                               {'from_user_id': from_user_id, 'to_user_id': to_user_id, 'amount': str(amount)})
+        elif await self.request('deposit', DEPOSIT_MONEY, {'user_id': self.pick(), 'amount': str(amount)}):
+            self.deposited += amount
+
+    async def run(self) -> float:
+        """Runs the workload, returns its duration in seconds"""
+        for operation in ('deposit', 'transfer'):
+            self.latencies[operation].clear()
+            self.errors[operation].clear()
+            self.good[operation] = 0
+        remaining = itertools.repeat(None, self.args.operations) if self.args.duration is None \
+            else itertools.repeat(None)
+        start = time.perf_counter()
+        deadline = start + self.args.duration if self.args.duration is not None else None
+
+        async def worker():
+            for _ in remaining:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                await self.operation()
+
+        await asyncio.gather(*(spawn(worker()) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - start
+
+    async def balances(self) -> Optional[List[Decimal]]:
+        balances = []
+        for user_id in self.user_ids:
+            response = await self.client.get(WALLET_BALANCE.format(user_id=user_id))
+            if response.status_code != 200:
+                return None
+            balances.append(Decimal(response.json()['balance']))
+        return balances
+
+    async def deadlock_retries(self) -> Optional[Dict[str, int]]:
+        response = await self.client.get(RETRY_STATS)
+        if response.status_code != 200:
+            return None
+        stats = response.json()
+        return {'retries': stats['retries'].get(DEADLOCK_DETECTED, 0),
+                'exhausted': stats['exhausted'].get(DEADLOCK_DETECTED, 0)}
+
+
+def in_process_client(app, timeout: float = 30) -> httpx.AsyncClient:
+    """Client calling the app directly. Errors are returned as responses, like by a running service"""
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url=TEST_URL,
+                             timeout=timeout)
+
+
+async def run_load(client: httpx.AsyncClient, args) -> dict:
+    generator = LoadGenerator(client=client, args=args)
+    await generator.seed()
+    before = await generator.balances()
+    deposited_before = generator.deposited
+    retries_before = await generator.deadlock_retries()
+    elapsed = await generator.run()
+    retries_after = await generator.deadlock_retries()
+    after = await generator.balances()
+    latencies = generator.latencies['deposit'] + generator.latencies['transfer']
+    errors = generator.errors['deposit'] + generator.errors['transfer']
+    operations = len(latencies) + errors['transport']
+    report = {
+        'target': args.url or 'in-process', 'users': len(generator.user_ids), 'skew': args.skew,
+        'transfers': args.transfers, 'concurrency': args.concurrency, 'operations': operations,
+        'duration_sec': round(elapsed, 3), 'ops_per_sec': round(operations / elapsed, 1),
+        'goodput_per_sec': round((generator.good['deposit'] + generator.good['transfer']) / elapsed, 1),
+        'latency_ms': latency_summary(latencies, PERCENTILES),
+        'endpoints': {operation: {'requests': len(generator.latencies[operation]),
+                                  'errors': dict(generator.errors[operation]),
+                                  'latency_ms': latency_summary(generator.latencies[operation], PERCENTILES)}
+                      for operation in ('deposit', 'transfer')},
+        'errors': dict(errors),
+        # Transfers rejected for lack of money are expected under load and aren't counted as errors
+        'error_rate': round((sum(errors.values()) - errors['insufficient_funds']) / operations, 6) if operations else 0,
+        'rejection_rate': round(errors['insufficient_funds'] / operations, 6) if operations else 0,
+        'deadlock_rate': None, 'conservation': None,
+    }
+    if retries_before is not None and retries_after is not None and operations:
+        report['deadlock_rate'] = round((retries_after['retries'] - retries_before['retries'] + errors['deadlock'])
+                                        / operations, 6)
+    if before is not None and after is not None:
+        expected = sum(before) + generator.deposited - deposited_before
+        report['conservation'] = {'ok': sum(after) == expected and min(after, default=0) >= 0,
+                                  'expected': str(expected), 'actual': str(sum(after)),
+                                  'negative_balances': sum(balance < 0 for balance in after)}
+    return report
+
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Metrics of the report worse than the ones of the baseline by more than tolerance (a fraction)"""
+    found = []
+    if report['ops_per_sec'] < baseline['ops_per_sec'] * (1 - tolerance):
+        found.append(f'ops_per_sec {report["ops_per_sec"]} < baseline {baseline["ops_per_sec"]}')
+    for name, value in report['latency_ms'].items():
+        if name in baseline['latency_ms'] and value > baseline['latency_ms'][name] * (1 + tolerance):
+            found.append(f'{name} {value} ms > baseline {baseline["latency_ms"][name]} ms')
+    # Plus 0.1% so a single error isn't a regression against a baseline without errors
+    if report['error_rate'] > baseline['error_rate'] * (1 + tolerance) + 0.001:
+        found.append(f'error_rate {report["error_rate"]} > baseline {baseline["error_rate"]}')
+    if report['conservation'] is not None and not report['conservation']['ok']:
+        found.append('money was not conserved')
+    return found
+
+
+async def main(args) -> int:
+    if args.url is not None:
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                     limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            report = await run_load(client, args)
+    else:
+        from src.main.app import app
+        await app.router.startup()
+        try:
+            async with in_process_client(app, timeout=args.timeout) as client:
+                report = await run_load(client, args)
+        finally:
+            await app.router.shutdown()
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            report['regressions'] = regressions(report, json.load(file), args.tolerance)
+    print(json.dumps(report))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 1 if report.get('regressions') else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base URL of a running service, the app runs in process by default')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--balance', type=int, default=1000, help='mean opening balance')
+    parser.add_argument('--balance-distribution', choices=['fixed', 'uniform', 'zipf'], default='fixed')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of picking wallets, 0 is uniform')
+    parser.add_argument('--transfers', type=float, default=0.5, help='share of transfers among operations')
+    parser.add_argument('--max-amount', type=int, default=10)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--duration', type=float, help='run for this many seconds instead of --operations')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seed-concurrency', type=int, help='clients seeding users, --concurrency by default')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='report of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(args=build_parser().parse_args())))
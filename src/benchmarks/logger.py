@@ -0,0 +1,75 @@
+"""Measures how long logging blocks the event loop: synchronous StreamHandler against the shared QueueHandler
+
+--requests concurrent tasks log --lines records each while a probe task sleeping 1 ms measures how late the event loop
+wakes it up. Records are written to --output. Reported are the cost of a logging call on the event loop and the lag
+of the loop, in modes: stream (a StreamHandler writing on the event loop, like loggers did before), queue, queue with
+JSON output and queue with sampling of the first 10 records of a call site per second and every 100th one after.
+
+Usage: python -m src.benchmarks.logger --requests 1000 --lines 20 --output /tmp/benchmark.log
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from src.benchmarks.utils import latency_summary
+from src.main.utils.logger import get_console_logger, configure_logging, flush_logs, TEXT_FORMAT, TEXT, JSON
+
+MODES = {'queue': {}, 'queue_json': {'format_': JSON}, 'queue_sampled': {'sample_first': 10, 'sample_every': 100}}
+
+
+async def probe(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def workload(logger: logging.Logger, requests: int, lines: int) -> dict:
+    calls = []
+
+    async def request(i: int):
+        for line in range(lines):
+            start = time.perf_counter()
+            logger.info(f'Transferred {line} from wallet {i} to wallet {i + 1}')
+            calls.append(time.perf_counter() - start)
+            await asyncio.sleep(0)
+
+    lags = []
+    stop = asyncio.Event()
+    probing = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probing
+    return {'elapsed_sec': round(elapsed, 3), 'call_us': round(sum(calls) / len(calls) * 1e6, 2),
+            'loop_lag_ms': latency_summary(lags, (50, 99, 100))}
+
+
+def main(args):
+    with open(args.output, 'w') as output:
+        # Loggers added a synchronous StreamHandler of their own before
+        logger = logging.getLogger('benchmark.stream')
+        logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        logger.addHandler(handler)
+        logger.propagate = False
+        print(json.dumps({'mode': 'stream', **asyncio.run(workload(logger, args.requests, args.lines))}))
+        logger = get_console_logger('benchmark.queue')
+        logger.propagate = False
+        for mode, options in MODES.items():
+            configure_logging(**{'format_': TEXT, 'sample_first': 0, 'sample_every': 0, **options}, stream=output)
+            report = asyncio.run(workload(logger, args.requests, args.lines))
+            flush_logs()
+            print(json.dumps({'mode': mode, **report}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--output', default='/tmp/benchmark.log')
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+"""Measures overhead of metrics: cost of single updates and of MetricsMiddleware per request
+
+Requests are sent in process to an app with a single trivial endpoint, with and without the middleware.
+
+Usage: python -m src.benchmarks.metrics --updates 1000000 --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from src.main.metrics import Counter, Histogram, MetricsMiddleware, REGISTRY, render
+from src.main.utils.constants import TEST_URL
+
+
+def update_cost(updates: int) -> dict:
+    histogram = Histogram('bench_seconds', 'Benchmark histogram', ('stage',))
+    counter = Counter('bench_total', 'Benchmark counter', ('reason',))
+    child, counter_child = histogram.labels('stage'), counter.labels('reason')
+    costs = {}
+    for name, update in (('counter_inc', lambda: counter_child.inc()),
+                         ('histogram_observe', lambda: child.observe(0.003)),
+                         ('histogram_labels_observe', lambda: histogram.labels('stage').observe(0.003))):
+        start = time.perf_counter()
+        for _ in range(updates):
+            update()
+        costs[f'{name}_ns'] = round((time.perf_counter() - start) / updates * 1e9, 1)
+    start = time.perf_counter()
+    for _ in range(updates):
+        with child.time():
+            pass
+    costs['histogram_timer_ns'] = round((time.perf_counter() - start) / updates * 1e9, 1)
+    REGISTRY.remove(histogram)
+    REGISTRY.remove(counter)
+    start = time.perf_counter()
+    render()
+    costs['render_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return costs
+
+
+async def request_cost(requests: int, middleware: bool) -> float:
+    app = FastAPI()
+    if middleware:
+        app.add_middleware(MetricsMiddleware)
+
+    @app.get('/ping/{value}')
+    async def ping(value: int):
+        return value
+
+    async with httpx.AsyncClient(app=app, base_url=TEST_URL) as client:
+        start = time.perf_counter()
+        for i in range(requests):
+            await client.get(f'/ping/{i}')
+        return (time.perf_counter() - start) / requests * 1e6
+
+
+async def main(args):
+    print(json.dumps(update_cost(args.updates)))
+    bare = await request_cost(args.requests, middleware=False)
+    measured = await request_cost(args.requests, middleware=True)
+    print(json.dumps({'request_us': round(bare, 1), 'request_with_metrics_us': round(measured, 1),
+                      'overhead_us': round(measured - bare, 1)}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=1000000)
+    parser.add_argument('--requests', type=int, default=20000)
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,79 @@
+"""Compares amounts as Decimals stored as numeric with amounts as minor units stored as bigint
+
+Measures validation of deposit requests (parsing the amount) in both modes and updates of balances in temporary
+numeric and bigint tables: single rows by primary key and --batch rows with one unnest statement, like UPDATE_BALANCES.
+
+Usage: python -m src.benchmarks.money --validations 200000 --updates 5000 --wallets 1000 --batch 100
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from decimal import Decimal
+
+from src.benchmarks.utils import latency_summary
+from src.main.model import DepositRequest
+from src.main.money import parse_amount
+from src.main.settings import database, settings
+from src.main.utils.constants import NUMERIC, MINOR_UNITS
+
+AMOUNT = '123.45'
+CURRENCY = 'USD'
+
+
+def validation_cost(validations: int) -> dict:
+    costs = {}
+    for mode, currency in ((NUMERIC, None), (MINOR_UNITS, CURRENCY)):
+        settings.currency = currency
+        start = time.perf_counter()
+        for _ in range(validations):
+            parse_amount(AMOUNT)
+        costs[f'parse_{mode}_ns'] = round((time.perf_counter() - start) / validations * 1e9, 1)
+        start = time.perf_counter()
+        for _ in range(validations):
+            DepositRequest(user_id=1, amount=AMOUNT)
+        costs[f'validate_{mode}_ns'] = round((time.perf_counter() - start) / validations * 1e9, 1)
+    settings.currency = None
+    return costs
+
+
+async def update_cost(connection, mode: str, args) -> dict:
+    table = f'bench_{mode}'
+    amount = Decimal(AMOUNT) if mode == NUMERIC else 12345
+    await connection.execute(f'CREATE TEMPORARY TABLE {table} (id bigint PRIMARY KEY, balance {mode} NOT NULL)')
+    await connection.execute(f'INSERT INTO {table} SELECT id, 0 FROM generate_series(1, {args.wallets}) AS id')
+    single = f'UPDATE {table} SET balance = balance + $2 WHERE id = $1'
+    latencies = []
+    for _ in range(args.updates):
+        start = time.perf_counter()
+        await connection.execute(single, random.randint(1, args.wallets), amount)
+        latencies.append(time.perf_counter() - start)
+    batch = (f'UPDATE {table} SET balance = {table}.balance + v.delta '
+             f'FROM unnest($1::bigint[], $2::{mode}[]) AS v(id, delta) WHERE {table}.id = v.id')
+    batch_latencies = []
+    for _ in range(max(1, args.updates // args.batch)):
+        ids = random.sample(range(1, args.wallets + 1), min(args.batch, args.wallets))
+        start = time.perf_counter()
+        await connection.execute(batch, ids, [amount] * len(ids))
+        batch_latencies.append(time.perf_counter() - start)
+    return {'mode': mode, 'single_row': latency_summary(latencies),
+            f'batch_of_{args.batch}': latency_summary(batch_latencies)}
+
+
+async def main(args):
+    print(json.dumps(validation_cost(args.validations)))
+    await database.connect()
+    async with database.connection() as connection:
+        for mode in (NUMERIC, MINOR_UNITS):
+            print(json.dumps(await update_cost(connection.raw_connection, mode, args)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--validations', type=int, default=200000)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--wallets', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=100)
+    asyncio.run(main(args=parser.parse_args()))
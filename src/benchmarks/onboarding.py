@@ -0,0 +1,71 @@
+"""Measures bulk onboarding of users against creating them one by one with create_user
+
+A CSV of --users users (every --balance-every one with an opening balance) is generated in memory and loaded with
+onboard in chunks of every --chunk-size. --single users are created with create_user for comparison.
+
+Usage: python -m src.benchmarks.onboarding --users 1000000 --chunk-size 5000 10000 50000 --single 5000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from src.main.crud import create_user
+from src.main.model import UserRequest
+from src.main.onboarding import onboard, OnboardingFormat
+from src.main.settings import database, init_db, settings
+
+
+def generate_csv(users: int, balance_every: int) -> bytes:
+    lines = ['first_name,last_name,balance']
+    lines.extend(f'first{i},last{i},{"10.50" if balance_every and i % balance_every == 0 else ""}'
+                 for i in range(users))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+async def chunks(data: bytes, size: int = 1 << 20):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def bulk(data: bytes, users: int, chunk_size: int) -> dict:
+    settings.onboarding_chunk_size = chunk_size
+    loaded = 0
+    start = time.perf_counter()
+    async for ids in onboard(f'benchmark-{uuid.uuid4()}', chunks(data), OnboardingFormat.csv):
+        loaded += len(ids)
+    elapsed = time.perf_counter() - start
+    assert loaded == users
+    return {'mode': 'bulk', 'chunk_size': chunk_size, 'users': users, 'elapsed_sec': round(elapsed, 2),
+            'users_per_sec': round(users / elapsed)}
+
+
+async def single(users: int) -> dict:
+    start = time.perf_counter()
+    for i in range(users):
+        await create_user(request=UserRequest(first_name=f'first{i}', last_name=f'last{i}'))
+    elapsed = time.perf_counter() - start
+    return {'mode': 'create_user', 'users': users, 'elapsed_sec': round(elapsed, 2),
+            'users_per_sec': round(users / elapsed)}
+
+
+async def main(args):
+    await init_db()
+    try:
+        data = generate_csv(args.users, args.balance_every)
+        for chunk_size in args.chunk_size:
+            print(json.dumps(await bulk(data, args.users, chunk_size)))
+        if args.single:
+            print(json.dumps(await single(args.single)))
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--balance-every', type=int, default=10, help='0 for no opening balances')
+    parser.add_argument('--chunk-size', type=int, nargs='+', default=[10000])
+    parser.add_argument('--single', type=int, default=5000)
+    asyncio.run(main(args=parser.parse_args()))
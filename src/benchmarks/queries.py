@@ -0,0 +1,64 @@
+"""CPU cost per operation with queries compiled by databases on every call and compiled once (COMPILED_QUERIES)
+
+Compilation of every query of crud is timed alone first. Then deposits, transfers and balance reads are performed one
+at a time with COMPILED_QUERIES=N and COMPILED_QUERIES=Y and the CPU time (time.process_time) of this process per
+operation is reported, so the work of the database server isn't counted.
+
+Usage: python -m src.benchmarks.queries --compilations 1000 --operations 2000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from src.benchmarks.utils import seed_users
+from src.main.crud import create_transaction, get_balance
+from src.main.queries import QUERIES, Compiled
+from src.main.settings import settings, database, init_db
+from src.main.utils.constants import YES, NO
+
+
+def compile_cost(compilations: int) -> dict:
+    start = time.process_time()
+    for _ in range(compilations):
+        for query in QUERIES:
+            Compiled(query.sql())
+    return {'mode': 'compile', 'queries': len(QUERIES),
+            'query_us': round((time.process_time() - start) / compilations / len(QUERIES) * 1e6, 1)}
+
+
+async def operation_cost(operation, operations: int) -> float:
+    start = time.process_time()
+    for _ in range(operations):
+        await operation()
+    return round((time.process_time() - start) / operations * 1e6, 1)
+
+
+async def main(args):
+    print(json.dumps(compile_cost(args.compilations)))
+    await init_db()
+    users = await seed_users(args.users, balance='1000000')
+
+    def transfer(from_user, to_user):
+        return create_transaction(to_user_id=to_user.user_id, amount='1', from_user_id=from_user.user_id)
+
+    operations = {
+        'deposit': lambda: create_transaction(to_user_id=random.choice(users).user_id, amount='1'),
+        'transfer': lambda: transfer(*random.sample(users, 2)),
+        'balance': lambda: get_balance(user_id=random.choice(users).user_id)}
+    for mode in (NO, YES):
+        settings.compiled_queries = mode
+        report = {'mode': 'operation', 'compiled_queries': mode}
+        for name, operation in operations.items():
+            report[f'{name}_cpu_us'] = await operation_cost(operation, args.operations)
+        print(json.dumps(report))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--compilations', type=int, default=1000)
+    parser.add_argument('--operations', type=int, default=2000)
+    asyncio.run(main(args=parser.parse_args()))
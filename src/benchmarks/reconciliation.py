@@ -0,0 +1,67 @@
+"""Measures incremental reconciliation passes against a full GROUP BY over the ledger
+
+Every step adds --rows deposits to --wallets wallets (ledger rows and balances are written together, like deposits
+do) and times a reconciliation pass over them. The GROUP BY of the whole ledger comparing sums with balances, which
+the checkpoints replace, is timed once for comparison.
+
+Usage: python -m src.benchmarks.reconciliation --wallets 1000 --rows 1000 10000 100000
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from src.benchmarks.utils import seed_users, Timer
+from src.main import money
+from src.main.reconciliation import reconcile
+from src.main.settings import database, init_db, transaction
+from src.main.utils.constants import INSERT_TRANSACTIONS, UPDATE_BALANCES
+
+FULL_RECONCILIATION = """
+    SELECT count(*) FROM public.wallets w
+    LEFT JOIN (SELECT wallet_id, sum(CASE WHEN type = 'debit' THEN amount ELSE -amount END) AS balance
+               FROM public.transactions GROUP BY wallet_id) l ON l.wallet_id = w.id
+    WHERE w.slots = 0 AND w.balance <> coalesce(l.balance, 0)
+"""
+
+BATCH = 10000
+
+
+@transaction
+async def deposit(wallet_ids):
+    amounts = [money.parse_amount('1')] * len(wallet_ids)
+    await database.execute(query=INSERT_TRANSACTIONS.format(money=money.sql_type()),
+                           values={'wallet_ids': wallet_ids, 'types': ['debit'] * len(wallet_ids), 'amounts': amounts})
+    deltas = {}
+    for wallet_id in wallet_ids:
+        deltas[wallet_id] = deltas.get(wallet_id, 0) + amounts[0]
+    await database.execute(query=UPDATE_BALANCES.format(money=money.sql_type()),
+                           values={'wallet_ids': list(deltas), 'deltas': list(deltas.values())})
+
+
+async def main(args):
+    await init_db()
+    try:
+        wallet_ids = [user.wallet_id for user in await seed_users(args.wallets)]
+        # Rows committed before are reconciled first, so every step reads only its own rows
+        await reconcile()
+        for rows in args.rows:
+            for start in range(0, rows, BATCH):
+                await deposit(random.choices(wallet_ids, k=min(BATCH, rows - start)))
+            with Timer() as timer:
+                report = await reconcile()
+            print(json.dumps({'mode': 'incremental', 'new_rows': report.rows, 'wallets': report.wallets,
+                              'mismatches': len(report.mismatches), 'elapsed_sec': round(timer.elapsed, 3)}))
+        ledger_rows = await database.fetch_val('SELECT count(*) FROM public.transactions')
+        with Timer() as timer:
+            await database.fetch_val(FULL_RECONCILIATION)
+        print(json.dumps({'mode': 'full_group_by', 'ledger_rows': ledger_rows, 'elapsed_sec': round(timer.elapsed, 3)}))
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wallets', type=int, default=1000)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    asyncio.run(main(args=parser.parse_args()))
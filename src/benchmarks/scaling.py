@@ -0,0 +1,70 @@
+"""Scaling curve of the service: throughput and latency with 1 to --max-workers worker processes
+
+Every step starts src.main.launcher with the same connection budget, waits until it answers and runs the load
+generator against it. Arguments not listed here are passed to src.benchmarks.load.
+
+Usage: python -m src.benchmarks.scaling --max-workers 8 --connections 80 --duration 30 --concurrency 64 --users 1000
+"""
+import argparse
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+from src.benchmarks.load import build_parser, run_load
+from src.main.utils.constants import RETRY_STATS
+
+
+async def wait_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while True:
+            try:
+                if (await client.get(RETRY_STATS)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.2)
+
+
+async def step(workers: int, args, load_args) -> dict:
+    url = f'http://127.0.0.1:{args.port}'
+    launcher = subprocess.Popen([sys.executable, '-m', 'src.main.launcher', '--workers', str(workers),
+                                 '--connections', str(args.connections), '--port', str(args.port)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        started = time.perf_counter()
+        await wait_ready(url, timeout=60)
+        startup = time.perf_counter() - started
+        load_args.url = url
+        async with httpx.AsyncClient(base_url=url, timeout=load_args.timeout,
+                                     limits=httpx.Limits(max_connections=load_args.concurrency)) as client:
+            report = await run_load(client, load_args)
+    finally:
+        launcher.send_signal(signal.SIGINT)
+        launcher.wait()
+    return {'workers': workers, 'startup_sec': round(startup, 2), 'ops_per_sec': report['ops_per_sec'],
+            'latency_ms': report['latency_ms'], 'error_rate': report['error_rate']}
+
+
+async def main(args, load_args):
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        result = await step(workers, args, load_args)
+        baseline = baseline or result['ops_per_sec']
+        result['speedup'] = round(result['ops_per_sec'] / baseline, 2)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--connections', type=int, default=80, help='budget of database connections of all workers')
+    parser.add_argument('--port', type=int, default=8011)
+    args, rest = parser.parse_known_args()
+    asyncio.run(main(args, build_parser().parse_args(rest)))
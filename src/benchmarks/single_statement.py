@@ -0,0 +1,56 @@
+"""Compares the multi-statement and the single-statement (server-side function) transaction paths
+
+Usage: python -m src.benchmarks.single_statement --operations 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from src.benchmarks.utils import StatementCounter, latency_summary, seed_users
+from src.main.crud import create_transaction
+from src.main.settings import settings, database, init_db, spawn
+from src.main.utils.constants import YES, NO
+
+
+async def run_mode(mode: str, users, operations: int, concurrency: int) -> dict:
+    settings.single_statement = mode
+    latencies = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            from_user, to_user = random.sample(users, 2)
+            start = time.perf_counter()
+            if random.random() < 0.5:
+                await create_transaction(to_user_id=to_user.user_id, amount='1')
+            else:
+                await create_transaction(to_user_id=to_user.user_id, from_user_id=from_user.user_id, amount='1')
+            latencies.append(time.perf_counter() - start)
+
+    counter = StatementCounter()
+    with counter.patched():
+        start = time.perf_counter()
+        await asyncio.gather(*(spawn(worker(operations // concurrency)) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {'mode': 'single_statement' if mode == YES else 'multi_statement',
+            'operations': len(latencies),
+            'statements_per_operation': round(counter.count / len(latencies), 2),
+            'ops_per_sec': round(len(latencies) / elapsed, 1),
+            **latency_summary(latencies)}
+
+
+async def main(args):
+    await init_db()
+    users = await seed_users(args.users, balance='1000000')
+    for mode in (NO, YES):
+        print(json.dumps(await run_mode(mode, users, args.operations, args.concurrency)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--operations', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+"""Measures time to first byte, throughput and memory of streaming a long wallet statement
+
+Memory is the growth of the peak resident set size of the process. Streaming runs first; the same history read
+with `database.fetch_all` is measured afterwards for comparison (skip it with --no-fetch-all).
+
+Usage: python -m src.benchmarks.statement --rows 5000000 --format ndjson csv --gzip
+"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+
+from src.benchmarks.utils import seed_users
+from src.main.settings import database, init_db
+from src.main.statements import statement_chunks, StatementFormat, STATEMENT_ROWS
+
+CHUNK = 1000000
+
+SEED_HISTORY = """
+    INSERT INTO public.transactions (wallet_id, type, amount, transaction_timestamp)
+    SELECT :wallet_id, CASE WHEN i % 3 = 0 THEN 'credit' ELSE 'debit' END, 1 + i % 100,
+           CURRENT_TIMESTAMP - make_interval(secs => i)
+    FROM generate_series(CAST(:start AS bigint), CAST(:stop AS bigint)) AS i
+"""
+
+
+async def aenumerate(iterator):
+    index = 0
+    async for item in iterator:
+        yield index, item
+        index += 1
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def stream(wallet_id: int, format_: StatementFormat, gzip: bool) -> dict:
+    rss = peak_rss_mb()
+    first_rows = None
+    # CSV header is sent before the query is executed
+    header_chunks = 1 if format_ == StatementFormat.csv else 0
+    size = 0
+    start = time.perf_counter()
+    async for index, chunk in aenumerate(statement_chunks(wallet_id=wallet_id, format_=format_, gzip=gzip)):
+        if first_rows is None and index == header_chunks:
+            first_rows = time.perf_counter() - start
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    return {'mode': 'stream', 'format': format_, 'gzip': gzip, 'first_rows_ms': round(first_rows * 1000, 1),
+            'elapsed_sec': round(elapsed, 2), 'mb': round(size / 2 ** 20, 1),
+            'peak_rss_growth_mb': round(peak_rss_mb() - rss, 1)}
+
+
+async def fetch_all(wallet_id: int) -> dict:
+    rss = peak_rss_mb()
+    start = time.perf_counter()
+    query = STATEMENT_ROWS.format(conditions='wallet_id = :wallet_id')
+    rows = await database.fetch_all(query=query, values={'wallet_id': wallet_id})
+    elapsed = time.perf_counter() - start
+    return {'mode': 'fetch_all', 'rows': len(rows), 'first_rows_ms': round(elapsed * 1000, 1),
+            'elapsed_sec': round(elapsed, 2), 'peak_rss_growth_mb': round(peak_rss_mb() - rss, 1)}
+
+
+async def main(args):
+    await init_db()
+    user, = await seed_users(1)
+    for start in range(0, args.rows, CHUNK):
+        await database.execute(query=SEED_HISTORY, values={'wallet_id': user.wallet_id, 'start': start,
+                                                           'stop': min(args.rows, start + CHUNK) - 1})
+    await database.execute('ANALYZE public.transactions')
+    for format_ in args.format:
+        for gzip in sorted({False, args.gzip}):
+            print(json.dumps(await stream(user.wallet_id, StatementFormat(format_), gzip)))
+    if args.fetch_all:
+        print(json.dumps(await fetch_all(user.wallet_id)))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--format', nargs='+', default=['ndjson', 'csv'], choices=[f.value for f in StatementFormat])
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--no-fetch-all', dest='fetch_all', action='store_false')
+    asyncio.run(main(args=parser.parse_args()))
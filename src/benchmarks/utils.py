@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+from typing import List, Dict, Tuple
+
+from asyncpg.connection import Connection
+
+from src.main.crud import create_user, create_transaction
+from src.main.model import UserRequest, UserResponse
+
+
+class StatementCounter:
+    """Counts statements (round trips) sent through asyncpg connections, including BEGIN/SAVEPOINT/COMMIT"""
+    def __init__(self):
+        self.count = 0
+
+    @contextmanager
+    def patched(self):
+        execute, _execute = Connection.execute, Connection._execute
+
+        async def counted_execute(conn, *args, **kwargs):
+            self.count += 1
+            return await execute(conn, *args, **kwargs)
+
+        async def counted__execute(conn, *args, **kwargs):
+            self.count += 1
+            return await _execute(conn, *args, **kwargs)
+
+        Connection.execute, Connection._execute = counted_execute, counted__execute
+        try:
+            yield self
+        finally:
+            Connection.execute, Connection._execute = execute, _execute
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(latencies: List[float], percentiles: Tuple[float, ...] = (50, 95, 99)) -> Dict[str, float]:
+    """p50/p95/p99 (p99.9 is reported as p999) of latencies given in seconds, reported in milliseconds"""
+    return {f'p{p:g}'.replace('.', ''): round(percentile(latencies, p) * 1000, 3) for p in percentiles}
+
+
+async def seed_users(count: int, balance: str = None) -> List[UserResponse]:
+    """Creates users with an optional opening deposit"""
+    users = []
+    for i in range(count):
+        user = await create_user(request=UserRequest(first_name=f'bench{i}', last_name='bench'))
+        if balance is not None:
+            await create_transaction(to_user_id=user.user_id, amount=balance)
+        users.append(user)
+    return users
+
+
+class Timer:
+    """Measures wall time of a block"""
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,61 @@
+"""Compares request latency of synchronous deposits with accepting them into the write-behind queue
+
+A burst of deposits is sent with a concurrency higher than the connection pool. For the queue the time until
+the workers applied every accepted deposit is reported as well.
+
+Usage: python -m src.benchmarks.write_behind --deposits 5000 --concurrency 100 --users 100 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from src.benchmarks.utils import latency_summary, seed_users
+from src.main.crud import create_transaction
+from src.main.settings import database, init_db, settings, spawn
+from src.main.write_behind import write_behind, enqueue_operation
+
+PENDING = "SELECT count(*) FROM public.operations WHERE status = 'pending'"
+
+
+async def burst(operation, user_ids, deposits: int, concurrency: int):
+    latencies = []
+
+    async def worker(offset: int, count: int):
+        for i in range(count):
+            start = time.perf_counter()
+            await operation(to_user_id=user_ids[(offset + i) % len(user_ids)], amount='1')
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(spawn(worker(n, deposits // concurrency)) for n in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+async def main(args):
+    await init_db()
+    user_ids = [user.user_id for user in await seed_users(args.users)]
+    latencies, elapsed = await burst(create_transaction, user_ids, args.deposits, args.concurrency)
+    print(json.dumps({'mode': 'sync', 'deposits': len(latencies), 'elapsed_sec': round(elapsed, 3),
+                      **latency_summary(latencies)}))
+    settings.write_behind_batch_size = args.batch_size
+    write_behind.start(workers=args.workers)
+    start = time.perf_counter()
+    latencies, elapsed = await burst(enqueue_operation, user_ids, args.deposits, args.concurrency)
+    while await database.fetch_val(PENDING):
+        await asyncio.sleep(0.01)
+    drained = time.perf_counter() - start
+    await write_behind.stop()
+    print(json.dumps({'mode': 'write_behind', 'deposits': len(latencies), 'elapsed_sec': round(elapsed, 3),
+                      'drained_sec': round(drained, 3), **latency_summary(latencies)}))
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deposits', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100)
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,220 @@
+"""Admission control in front of the routes
+
+A request holds one of admission_concurrency slots (the size of the connection pool by default) while it's handled.
+When all of them are taken it waits in a queue of at most admission_queue_size requests, for admission_queue_timeout
+seconds at most. Writes are admitted before reads and reads before bulk requests (statements, batches and onboarding);
+a write arriving at a full queue takes the place of the last queued request of a lower priority. Requests which can't
+be queued or waited too long get 503 with Retry-After at once, instead of piling up in front of the pool until clients
+time out. Routes in admission_endpoint_limits have their own limit on top of it.
+
+With admission_target_latency greater than 0 the limit adapts (AIMD): after every limit requests it's multiplied by
+admission_decrease if their mean latency exceeded the target and grows by one otherwise, staying between
+admission_min_concurrency and admission_concurrency.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Deque, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+from starlette.responses import PlainTextResponse
+from starlette.routing import Match
+
+from src.main.metrics import Counter, Gauge
+from src.main.settings import settings
+from src.main.utils.constants import WALLET_STATEMENT, TRANSFERS_BATCH, ONBOARD_USERS, METRICS, RETRY_STATS
+
+ADMISSION_REJECTIONS = Counter('admission_rejections_total', 'Requests rejected by admission control',
+                               ('priority', 'reason'))
+ADMISSION_LIMIT = Gauge('admission_limit', 'Concurrency limit of requests', ('limiter',))
+ADMISSION_IN_FLIGHT = Gauge('admission_in_flight', 'Admitted requests in progress', ('limiter',))
+ADMISSION_QUEUED = Gauge('admission_queued', 'Requests waiting to be admitted', ('limiter',))
+
+BULK_ROUTES = (WALLET_STATEMENT, TRANSFERS_BATCH, ONBOARD_USERS)
+# Monitoring has to answer when the service is overloaded
+EXEMPT_ROUTES = (METRICS, RETRY_STATS)
+
+
+class Priority(IntEnum):
+    """Requests of lower values are admitted first"""
+    write = 0
+    read = 1
+    bulk = 2
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """Limit of concurrent requests with a bounded queue of waiting ones ordered by priority"""
+    def __init__(self, name: str, limit: int, queue_size: int, min_limit: Optional[int] = None,
+                 target_latency: float = 0, decrease: float = 0.8):
+        self.name = name
+        self.limit = self.max_limit = limit
+        self.min_limit = limit if min_limit is None else min(min_limit, limit)
+        self.queue_size = queue_size
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.in_flight = 0
+        self.queued = 0
+        # Moving average of handling time in seconds, it estimates Retry-After
+        self.latency = 0.0
+        self._window: List[float] = []
+        self._waiters: Dict[Priority, Deque[asyncio.Future]] = {priority: deque() for priority in Priority}
+        self._limit_gauge = ADMISSION_LIMIT.labels(name)
+        self._in_flight_gauge = ADMISSION_IN_FLIGHT.labels(name)
+        self._queued_gauge = ADMISSION_QUEUED.labels(name)
+        self._limit_gauge.set(limit)
+
+    @property
+    def adaptive(self) -> bool:
+        return self.target_latency > 0 and self.min_limit < self.max_limit
+
+    def retry_after(self) -> int:
+        """Seconds until requests queued now are likely handled"""
+        return max(1, math.ceil(self.latency * (self.queued + 1) / self.limit))
+
+    async def acquire(self, priority: Priority, deadline: float):
+        """Takes a slot, waiting in the queue until deadline (of time.monotonic) at most, raises Rejected if it can't"""
+        if self.in_flight < self.limit and not self.queued:
+            self.in_flight += 1
+            self._in_flight_gauge.set(self.in_flight)
+            return
+        if self.queued >= self.queue_size and not self._displace(priority):
+            raise Rejected('queue_full', self.retry_after())
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise Rejected('timeout', self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        self.queued += 1
+        self._queued_gauge.set(self.queued)
+        try:
+            await asyncio.wait((waiter,), timeout=timeout)
+        except asyncio.CancelledError:
+            self._abandon(priority, waiter)
+            raise
+        if not waiter.done():
+            self._abandon(priority, waiter)
+            raise Rejected('timeout', self.retry_after())
+        if not waiter.result():
+            raise Rejected('displaced', self.retry_after())
+
+    def release(self, elapsed: Optional[float] = None, adapt: bool = True):
+        """Frees a slot of a request handled in elapsed seconds, None if it wasn't handled"""
+        self.in_flight -= 1
+        if elapsed is not None:
+            self._observe(elapsed, adapt)
+        self._wake()
+
+    def _wake(self):
+        for waiters in self._waiters.values():
+            while waiters and self.in_flight < self.limit:
+                self.queued -= 1
+                self.in_flight += 1
+                waiters.popleft().set_result(True)
+        self._in_flight_gauge.set(self.in_flight)
+        self._queued_gauge.set(self.queued)
+
+    def _displace(self, priority: Priority) -> bool:
+        """Rejects the last queued request of a lower priority than the given one, if there is one"""
+        for lower in reversed(Priority):
+            if lower <= priority:
+                return False
+            if self._waiters[lower]:
+                self.queued -= 1
+                self._waiters[lower].pop().set_result(False)
+                return True
+        return False
+
+    def _abandon(self, priority: Priority, waiter: asyncio.Future):
+        if waiter.done():
+            # Admitted or displaced meanwhile, a slot it was given is passed on
+            if not waiter.cancelled() and waiter.result():
+                self.release()
+            return
+        waiter.cancel()
+        self._waiters[priority].remove(waiter)
+        self.queued -= 1
+        self._queued_gauge.set(self.queued)
+
+    def _observe(self, elapsed: float, adapt: bool):
+        self.latency += (elapsed - self.latency) * 0.1
+        if not adapt or not self.adaptive:
+            return
+        self._window.append(elapsed)
+        if len(self._window) < self.limit:
+            return
+        if sum(self._window) / len(self._window) > self.target_latency:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._window.clear()
+        self._limit_gauge.set(self.limit)
+
+
+class AdmissionMiddleware:
+    """Admits requests to routes of the app according to their priority and limits of their routes
+
+    Routes are matched before the router does it, requests which match none are passed on.
+    """
+    def __init__(self, app):
+        self.app = app
+        adaptive = settings.admission_target_latency > 0
+        self.limiter = Limiter('all', limit=settings.admission_concurrency or settings.pool_max,
+                               queue_size=settings.admission_queue_size,
+                               min_limit=settings.admission_min_concurrency if adaptive else None,
+                               target_latency=settings.admission_target_latency,
+                               decrease=settings.admission_decrease)
+        self.endpoint_limiters = {path: Limiter(path, limit=limit, queue_size=settings.admission_queue_size)
+                                  for path, limit in settings.admission_endpoint_limits.items()}
+
+    @staticmethod
+    def route(scope) -> Optional[APIRoute]:
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route if isinstance(route, APIRoute) and route.path not in EXEMPT_ROUTES else None
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        route = self.route(scope)
+        if route is None:
+            return await self.app(scope, receive, send)
+        if route.path in BULK_ROUTES:
+            priority = Priority.bulk
+        else:
+            priority = Priority.read if scope['method'] in ('GET', 'HEAD') else Priority.write
+        limiters = [limiter for limiter in (self.endpoint_limiters.get(route.path), self.limiter)
+                    if limiter is not None]
+        deadline = time.monotonic() + settings.admission_queue_timeout
+        admitted = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire(priority, deadline)
+                admitted.append(limiter)
+        except Rejected as e:
+            for limiter in admitted:
+                limiter.release()
+            ADMISSION_REJECTIONS.labels(priority.name, e.reason).inc()
+            # Rejections are observed by metrics of the route
+            scope['endpoint'] = route.endpoint
+            response = PlainTextResponse('Service is overloaded, retry later', status_code=503,
+                                         headers={'Retry-After': str(e.retry_after)})
+            return await response(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed = time.perf_counter() - start
+            for limiter in admitted:
+                # Bulk requests take long by design, they don't drive the adaptive limit
+                limiter.release(elapsed, adapt=priority != Priority.bulk)
@@ -1,30 +1,79 @@
+from datetime import datetime
+from typing import Optional
+
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, Header
 from fastapi.exceptions import RequestValidationError
 from starlette import status
 from starlette.requests import Request
-from starlette.responses import PlainTextResponse
+from starlette.responses import PlainTextResponse, StreamingResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from src.main.crud import create_transaction, create_user
-from src.main.model import UserResponse, UserRequest, DepositRequest, Transaction, TransferRequest
-from src.main.settings import settings, database, init_db
-from src.main.utils.constants import CREATE_USER, DEPOSIT_MONEY, TRANSFER_MONEY
+from src.main.admission import AdmissionMiddleware
+from src.main.coalescer import deposit_coalescer
+from src.main.crud import create_transactions_batch, get_transactions_page, get_wallet_id, \
+    warm_up_statements
+from src.main.engine import engine, PostgresEngine
+from src.main.fast_path import FastPathMiddleware, register as register_fast_route
+from src.main.hot_wallets import make_wallet_hot
+from src.main.idempotency import IdempotencyKeyReused, idempotency_keys_expiry
+from src.main.ledger import ledger_maintenance
+from src.main.metrics import MetricsMiddleware, metrics_server, render
+from src.main.model import UserResponse, UserRequest, DepositRequest, Transaction, TransferRequest, \
+    RetryStatsResponse, BatchRequest, BatchResponse, HotWalletRequest, HotWalletResponse, OperationResponse, \
+    BalanceResponse, TransactionPage, TransactionType, OnboardingJob, ReconciliationStatus
+from src.main.onboarding import OnboardingFormat, UploadStreamingResponse, onboard, mapping_lines, get_job
+from src.main.reconciliation import reconciler, get_status
+from src.main.queries import compile_queries
+from src.main.replicas import ReplicaMiddleware, read_router
+from src.main.retry import retry_stats
+from src.main.settings import settings, warm_up_pool
+from src.main.statements import StatementFormat, MEDIA_TYPES, statement_chunks
+from src.main.utils.constants import CREATE_USER, DEPOSIT_MONEY, TRANSFER_MONEY, RETRY_STATS, \
+    TRANSFERS_BATCH, HOT_WALLET, QUEUE_DEPOSIT_MONEY, QUEUE_TRANSFER_MONEY, OPERATION, WALLET_BALANCE, \
+    WALLET_TRANSACTIONS, PAGE_SIZE, MAX_PAGE_SIZE, WALLET_STATEMENT, IDEMPOTENCY_KEY_MAX_LENGTH, METRICS, YES, \
+    ONBOARD_USERS, ONBOARDING_JOB, JOB_ID_MAX_LENGTH, RECONCILIATION
 from src.main.utils.logger import get_console_logger
+from src.main.write_behind import write_behind, enqueue_operation, get_operation
 
 logger = get_console_logger(name=__name__)
 
 app = FastAPI(title=settings.app_title)
+app.add_middleware(FastPathMiddleware)
+app.add_middleware(ReplicaMiddleware)
+if settings.admission == YES:
+    app.add_middleware(AdmissionMiddleware)
+if settings.metrics == YES:
+    app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event("startup")
 async def startup():
-    await init_db()
+    if settings.metrics_port is not None:
+        await metrics_server.start(host=settings.metrics_host, port=settings.metrics_port)
+    await engine.connect()
+    compile_queries()
+    if isinstance(engine, PostgresEngine):
+        await read_router.connect()
+        if settings.warm_up == YES:
+            await warm_up_pool(connections=settings.pool_min, statements=warm_up_statements())
+        write_behind.start(workers=settings.write_behind_workers)
+        # With several workers maintenance runs in one of them only
+        if settings.background_tasks == YES:
+            ledger_maintenance.start()
+            idempotency_keys_expiry.start()
+            reconciler.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await database.disconnect()
+    await write_behind.stop()
+    await ledger_maintenance.stop()
+    await idempotency_keys_expiry.stop()
+    await reconciler.stop()
+    await read_router.disconnect()
+    await engine.disconnect()
+    await metrics_server.stop()
 
 
 @app.exception_handler(StarletteHTTPException)
@@ -45,20 +94,178 @@ def validation_exception_handler(request, exc):
 @app.post(path=CREATE_USER, status_code=status.HTTP_201_CREATED, response_model=UserResponse)
 async def create_client(request: UserRequest):
     """Creates client with an assigned wallet"""
-    return await create_user(request=request)
+    return await engine.create_user(request=request)
+
+
+async def deposit(request: DepositRequest, idempotency_key: Optional[str]) -> Transaction:
+    if settings.coalesce_window_ms > 0 and idempotency_key is None and isinstance(engine, PostgresEngine):
+        return await deposit_coalescer.submit(user_id=request.user_id, amount=request.amount)
+    try:
+        return await engine.create_transaction(to_user_id=request.user_id, amount=request.amount,
+                                               idempotency_key=idempotency_key)
+    except IdempotencyKeyReused as e:
+        raise StarletteHTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+
+async def transfer(request: TransferRequest, idempotency_key: Optional[str]) -> Transaction:
+    try:
+        return await engine.create_transaction(to_user_id=request.to_user_id, amount=request.amount,
+                                               from_user_id=request.from_user_id, idempotency_key=idempotency_key)
+    except IdempotencyKeyReused as e:
+        raise StarletteHTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
 
 
 @app.post(path=DEPOSIT_MONEY, response_model=Transaction)
-async def deposit_money(request: DepositRequest):
-    """Creates user deposit"""
-    return await create_transaction(to_user_id=request.user_id, amount=request.amount)
+async def deposit_money(request: DepositRequest,
+                        idempotency_key: Optional[str] = Header(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)):
+    """Creates user deposit. A request repeated with the same Idempotency-Key returns the original result"""
+    return await deposit(request, idempotency_key)
 
 
 @app.post(path=TRANSFER_MONEY, response_model=Transaction)
-async def transfer_money(request: TransferRequest):
-    """Creates money transfer"""
-    return await create_transaction(to_user_id=request.to_user_id, amount=request.amount,
-                                    from_user_id=request.from_user_id)
+async def transfer_money(request: TransferRequest,
+                         idempotency_key: Optional[str] = Header(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)):
+    """Creates money transfer. A request repeated with the same Idempotency-Key returns the original result"""
+    return await transfer(request, idempotency_key)
+
+
+register_fast_route(DEPOSIT_MONEY, DepositRequest, deposit, deposit_money)
+register_fast_route(TRANSFER_MONEY, TransferRequest, transfer, transfer_money)
+
+
+def check_write_behind_workers():
+    # Without workers accepted operations would stay pending forever
+    if settings.write_behind_workers <= 0:
+        raise StarletteHTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                     detail='Queued operations are not applied, WRITE_BEHIND_WORKERS is 0')
+
+
+@app.post(path=QUEUE_DEPOSIT_MONEY, status_code=status.HTTP_202_ACCEPTED, response_model=OperationResponse)
+async def queue_deposit_money(request: DepositRequest):
+    """Accepts user deposit to be performed in the background"""
+    check_write_behind_workers()
+    return await enqueue_operation(to_user_id=request.user_id, amount=request.amount)
+
+
+@app.post(path=QUEUE_TRANSFER_MONEY, status_code=status.HTTP_202_ACCEPTED, response_model=OperationResponse)
+async def queue_transfer_money(request: TransferRequest):
+    """Accepts money transfer to be performed in the background"""
+    check_write_behind_workers()
+    return await enqueue_operation(to_user_id=request.to_user_id, amount=request.amount,
+                                   from_user_id=request.from_user_id)
+
+
+@app.get(path=OPERATION, response_model=OperationResponse)
+async def operation_status(operation_id: int):
+    """Returns status of accepted deposit or transfer"""
+    operation = await get_operation(operation_id=operation_id)
+    if operation is None:
+        raise StarletteHTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                     detail=f'Cannot find operation {operation_id}')
+    return operation
+
+
+@app.post(path=TRANSFERS_BATCH, response_model=BatchResponse)
+async def transfers_batch(request: BatchRequest):
+    """Performs a batch of deposits and transfers in one database transaction"""
+    return await create_transactions_batch(items=request.items, mode=request.mode)
+
+
+@app.post(path=HOT_WALLET, response_model=HotWalletResponse)
+async def hot_wallet(request: HotWalletRequest):
+    """Splits user wallet balance into slots so concurrent deposits to it don't wait for each other"""
+    return await make_wallet_hot(request=request)
+
+
+@app.get(path=WALLET_BALANCE, response_model=BalanceResponse)
+async def wallet_balance(user_id: int):
+    """Returns balance of user wallet"""
+    balance = await engine.get_balance(user_id=user_id)
+    if balance is None:
+        raise StarletteHTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                     detail=f'Cannot find wallet of user {user_id}')
+    return balance
+
+
+@app.get(path=WALLET_TRANSACTIONS, response_model=TransactionPage)
+async def wallet_transactions(user_id: int, limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                              cursor: str = None, type: TransactionType = None, since: datetime = None,
+                              until: datetime = None):
+    """Returns page of wallet transactions, newest first. Pass next_cursor of a page to get the next one"""
+    try:
+        page = await get_transactions_page(user_id=user_id, limit=limit, cursor=cursor, type_=type, since=since,
+                                           until=until)
+    except ValueError as e:
+        raise StarletteHTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if page is None:
+        raise StarletteHTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                     detail=f'Cannot find wallet of user {user_id}')
+    return page
+
+
+@app.get(path=WALLET_STATEMENT)
+async def wallet_statement(user_id: int, format: StatementFormat = StatementFormat.ndjson, gzip: bool = False,
+                           since: datetime = None, until: datetime = None):
+    """Streams whole wallet history, oldest first, as NDJSON or CSV"""
+    wallet_id = await get_wallet_id(user_id=user_id)
+    if wallet_id is None:
+        raise StarletteHTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                     detail=f'Cannot find wallet of user {user_id}')
+    headers = {'Content-Encoding': 'gzip'} if gzip else None
+    return StreamingResponse(statement_chunks(wallet_id=wallet_id, format_=format, gzip=gzip, since=since,
+                                              until=until),
+                             media_type=MEDIA_TYPES[format], headers=headers)
+
+
+@app.post(path=ONBOARD_USERS)
+async def onboard_users(request: Request, job_id: str = Query(..., min_length=1, max_length=JOB_ID_MAX_LENGTH),
+                        format: OnboardingFormat = OnboardingFormat.csv):
+    """Creates users of the streamed CSV or NDJSON and their wallets, streams back user and wallet ids as NDJSON.
+    Send the same input with the same job_id to resume a failed job"""
+    return UploadStreamingResponse(mapping_lines(onboard(job_id=job_id, chunks=request.stream(), format_=format)),
+                                   media_type=MEDIA_TYPES[StatementFormat.ndjson])
+
+
+@app.get(path=ONBOARDING_JOB, response_model=OnboardingJob)
+async def onboarding_job(job_id: str):
+    """Returns status and number of committed records of an onboarding job"""
+    job = await get_job(job_id=job_id)
+    if job is None:
+        raise StarletteHTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Cannot find job {job_id}')
+    return job
+
+
+@app.get(path=RECONCILIATION, response_model=ReconciliationStatus)
+async def reconciliation_status():
+    """Returns how far the ledger is reconciled and wallets whose balance differs from it"""
+    return await get_status()
+
+
+@app.get(path=METRICS, response_class=PlainTextResponse)
+async def get_metrics():
+    """Returns metrics in the Prometheus text format"""
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get(path=RETRY_STATS, response_model=RetryStatsResponse)
+async def get_retry_stats():
+    """Returns numbers of retried and finally failed transactions per SQLSTATE"""
+    return retry_stats.as_dict()
+
+
+# Routes served by the database alone, the memory engine keeps users, wallets and the ledger by itself
+DATABASE_ROUTES = (QUEUE_DEPOSIT_MONEY, QUEUE_TRANSFER_MONEY, OPERATION, TRANSFERS_BATCH, HOT_WALLET,
+                   WALLET_TRANSACTIONS, WALLET_STATEMENT, ONBOARD_USERS, ONBOARDING_JOB, RECONCILIATION)
+
+
+def unregister_database_routes():
+    """Removes routes which would read or change state other than the one of the storage engine"""
+    app.router.routes = [route for route in app.router.routes if getattr(route, 'path', None) not in DATABASE_ROUTES]
+    app.openapi_schema = None
+
+
+if not isinstance(engine, PostgresEngine):
+    unregister_database_routes()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import asyncio
+from typing import List, Tuple, Optional
+
+from src.main.crud import create_transactions_batch
+from src.main.model import Transaction, DepositRequest, BatchMode, BatchItemStatus
+from src.main.settings import settings, spawn
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+class DepositCoalescer:
+    """Merges deposits arriving within a short window into one database transaction
+
+    Deposits to the same wallet become one balance update, ledger rows are inserted with one statement and every
+    caller gets its own transaction id back.
+    """
+    def __init__(self):
+        self._pending: List[Tuple[DepositRequest, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Running batches are referenced so they aren't garbage collected
+        self._running = set()
+        self.flushes = 0
+
+    async def submit(self, user_id: int, amount: str) -> Transaction:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((DepositRequest(user_id=user_id, amount=amount), future))
+        if len(self._pending) >= settings.coalesce_max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(settings.coalesce_window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            self.flushes += 1
+            # The batch runs on its own connection, not on the one of the request that happened to fill it
+            task = spawn(self._execute(pending))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _execute(pending: List[Tuple[DepositRequest, asyncio.Future]]):
+        try:
+            response = await create_transactions_batch(items=[item for item, _ in pending], mode=BatchMode.best_effort)
+        except Exception as e:
+            logger.warning(f'Coalesced batch of {len(pending)} deposits failed: {e}')
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(pending, response.results):
+            if future.done():
+                continue
+            if result.status == BatchItemStatus.applied:
+                future.set_result(result.transaction)
+            else:
+                future.set_exception(ValueError(result.error))
+
+
+deposit_coalescer = DepositCoalescer()
@@ -1,104 +1,386 @@
-from decimal import Decimal
-from typing import Dict
+import base64
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Union, Optional, Tuple
 
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, tuple_, bindparam
 
-from src.main.model import Transaction, wallets, transactions, TransactionType, UserRequest, users, UserResponse
-from src.main.settings import database
+from src.main.model import Transaction, wallets, transactions, TransactionType, UserRequest, users, UserResponse, \
+    DepositRequest, TransferRequest, BatchMode, BatchResponse, BatchItemResult, BatchItemStatus, BalanceResponse, \
+    TransactionRecord, TransactionPage
+from src.main import idempotency, money
+from src.main.cache import TTLCache
+from src.main.hot_wallets import get_hot_wallets, credit_hot_wallet, debit_hot_wallet, consolidate_slots, \
+    slots_balance
+from src.main.money import Amount, Money, parse_amount, to_decimal
+from src.main.queries import Query, fetch_all, fetch_one, execute
+from src.main.metrics import count_rejections, rejection_reason, REJECTIONS, LOCK_WAIT, INSERT, UPDATE, EXECUTE
+from src.main.replicas import read_database
+from src.main.retry import retry_on_conflict
+from src.main.settings import settings, transaction
+from src.main.utils.constants import YES, STATUS_TO_WALLET_NOT_FOUND, STATUS_FROM_WALLET_NOT_FOUND, \
+    STATUS_INSUFFICIENT_FUNDS, STATUS_HOT_WALLET, LOCK_WALLETS, LOCK_REGULAR_WALLETS, WALLET_IDS, INSERT_TRANSACTIONS, \
+    UPDATE_BALANCES, INSERT_USER, INSERT_WALLET, CALL_EXECUTE_TRANSACTION
 from src.main.utils.logger import get_console_logger
 
 logger = get_console_logger(name=__name__)
 
 
-@database.transaction()
+# Wallet of a user never changes, so ids of wallets are cached by user id
+wallet_id_cache = TTLCache(maxsize=settings.wallet_id_cache_size, ttl=float('inf'))
+
+# Statements of operations are compiled once, see src.main.queries
+INSERT_USER_QUERY = Query(INSERT_USER)
+INSERT_WALLET_QUERY = Query(INSERT_WALLET)
+WALLET_IDS_QUERY = Query(WALLET_IDS)
+LOCK_WALLETS_QUERY = Query(LOCK_WALLETS)
+LOCK_REGULAR_WALLETS_QUERY = Query(LOCK_REGULAR_WALLETS)
+INSERT_TRANSACTIONS_QUERY = Query(INSERT_TRANSACTIONS)
+UPDATE_BALANCES_QUERY = Query(UPDATE_BALANCES)
+EXECUTE_TRANSACTION_QUERY = Query(CALL_EXECUTE_TRANSACTION)
+GET_USER_QUERY = Query(users.select().where(and_(users.c.first_name == bindparam('first_name'),
+                                                 users.c.last_name == bindparam('last_name'))))
+GET_WALLET_QUERY = Query(select([wallets.c.id, wallets.c.user_id,
+                                 (wallets.c.balance + slots_balance()).label('balance'), wallets.c.slots])
+                         .where(wallets.c.user_id == bindparam('user_id')))
+GET_BALANCE_QUERY = Query(select([wallets.c.id, (wallets.c.balance + slots_balance()).label('balance')])
+                          .where(wallets.c.user_id == bindparam('user_id')))
+GET_TRANSACTION_QUERY = Query(transactions.select().where(transactions.c.wallet_id == bindparam('wallet_id')))
+GET_TRANSACTION_OF_TYPE_QUERY = Query(transactions.select()
+                                      .where(and_(transactions.c.wallet_id == bindparam('wallet_id'),
+                                                  transactions.c.type == bindparam('type'))))
+
+
+@transaction
 async def create_user(request: UserRequest) -> UserResponse:
     """Inserts user and corresponding wallet"""
-    query = users.insert().values(**request.dict())
-    user_id = await database.execute(query)
-    query = wallets.insert().values(user_id=user_id)
-    wallet_id = await database.execute(query)
+    user_id = await execute(INSERT_USER_QUERY, values=request.dict())
+    wallet_id = await execute(INSERT_WALLET_QUERY, values={'user_id': user_id})
+    wallet_id_cache.set(user_id, wallet_id)
     return UserResponse(**request.dict(), user_id=user_id, wallet_id=wallet_id)
 
 
-@database.transaction()
-async def insert_transaction(wallet_id: int, type: TransactionType, amount: Decimal) -> int:
-    query = transactions.insert().values(wallet_id=wallet_id, type=type, amount=amount)
-    return await database.execute(query)
+async def get_wallet_ids(user_ids: Iterable[int]) -> Dict[int, int]:
+    """Maps user ids to ids of their wallets, users without a wallet are left out"""
+    wallet_ids = {}
+    missing = []
+    for user_id in user_ids:
+        wallet_id = wallet_id_cache.get(user_id)
+        if wallet_id is None:
+            missing.append(user_id)
+        else:
+            wallet_ids[user_id] = wallet_id
+    if missing:
+        for row in await fetch_all(WALLET_IDS_QUERY, values={'user_ids': missing}):
+            wallet_id_cache.set(row['user_id'], row['id'])
+            wallet_ids[row['user_id']] = row['id']
+    return wallet_ids
 
 
-@database.transaction()
-async def update_balance(user_id: int, amount: Decimal) -> Decimal:
-    query = (wallets.update()
-             .where(wallets.c.user_id == user_id)
-             .values(balance=wallets.c.balance + amount)
-             .returning(wallets.c.balance))
-    return await database.execute(query)
+def warm_up_statements() -> List[Tuple[str, Dict]]:
+    """Statements of deposits and transfers with empty arrays, executing them prepares them without touching rows"""
+    money_type = money.sql_type()
+    return [(WALLET_IDS, {'user_ids': []}),
+            (LOCK_REGULAR_WALLETS, {'wallet_ids': []}),
+            (INSERT_TRANSACTIONS.format(money=money_type), {'wallet_ids': [], 'types': [], 'amounts': []}),
+            (UPDATE_BALANCES.format(money=money_type), {'wallet_ids': [], 'deltas': []})]
 
 
 async def get_user(first_name: str, last_name: str) -> Dict:
-    query = users.select().where(and_(users.c.first_name == first_name,
-                                      users.c.last_name == last_name))
-    user_row = await database.fetch_one(query)
-    return dict(user_row._mapping)
+    user_row = await fetch_one(GET_USER_QUERY, values={'first_name': first_name, 'last_name': last_name},
+                               database_=await read_database())
+    return dict(user_row)
 
 
-async def get_wallet(user_id: int) -> Dict:
-    query = wallets.select().where(wallets.c.user_id == user_id)
-    wallet_row = await database.fetch_one(query)
-    return dict(wallet_row._mapping)
+async def get_wallet(user_id: int) -> Optional[Dict]:
+    wallet_row = await fetch_one(GET_WALLET_QUERY, values={'user_id': user_id}, database_=await read_database())
+    if wallet_row is None:
+        return None
+    return {**dict(wallet_row), 'balance': to_decimal(wallet_row['balance'])}
 
 
 async def get_transaction(wallet_id: int, type_: TransactionType = None) -> Dict:
-    query = transactions.select().where(transactions.c.wallet_id == wallet_id)
+    if type_ is None:
+        query, values = GET_TRANSACTION_QUERY, {'wallet_id': wallet_id}
+    else:
+        query, values = GET_TRANSACTION_OF_TYPE_QUERY, {'wallet_id': wallet_id, 'type': type_.value}
+    wallet_row = await fetch_one(query, values=values, database_=await read_database())
+    return {**dict(wallet_row), 'amount': to_decimal(wallet_row['amount'])}
+
+
+async def get_wallet_id(user_id: int) -> Optional[int]:
+    return (await get_wallet_ids([user_id])).get(user_id)
+
+
+async def get_balance(user_id: int) -> Optional[BalanceResponse]:
+    row = await fetch_one(GET_BALANCE_QUERY, values={'user_id': user_id}, database_=await read_database())
+    if row is None:
+        return None
+    return BalanceResponse(user_id=user_id, wallet_id=row['id'], balance=to_decimal(row['balance']))
+
+
+def encode_cursor(transaction_timestamp: datetime, transaction_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{transaction_timestamp.isoformat()}|{transaction_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Returns timestamp and id of the last transaction of the previous page"""
+    try:
+        timestamp, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(transaction_id)
+    except ValueError:
+        raise ValueError(f'Invalid cursor {cursor}')
+
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Timestamps are stored without time zone"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def get_transactions_page(user_id: int, limit: int, cursor: str = None, type_: TransactionType = None,
+                                since: datetime = None, until: datetime = None) -> Optional[TransactionPage]:
+    """Returns transactions of user wallet, newest first, starting after the cursor
+
+    The page continues from the last returned (timestamp, id) instead of skipping rows with an offset, so every
+    page is an index range scan of at most limit + 1 rows.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    wallet_id = await get_wallet_id(user_id=user_id)
+    if wallet_id is None:
+        return None
+    query = (select([transactions.c.id, transactions.c.type, transactions.c.amount,
+                     transactions.c.transaction_timestamp])
+             .where(transactions.c.wallet_id == wallet_id)
+             .order_by(transactions.c.transaction_timestamp.desc(), transactions.c.id.desc())
+             .limit(limit + 1))
     if type_ is not None:
         query = query.where(transactions.c.type == type_)
-    wallet_row = await database.fetch_one(query)
-    return dict(wallet_row._mapping)
+    if since is not None:
+        query = query.where(transactions.c.transaction_timestamp >= naive_utc(since))
+    if until is not None:
+        query = query.where(transactions.c.transaction_timestamp < naive_utc(until))
+    if position is not None:
+        # The timestamp predicate is implied by the row comparison but only a plain one prunes ledger partitions
+        query = (query.where(transactions.c.transaction_timestamp <= position[0])
+                 .where(tuple_(transactions.c.transaction_timestamp, transactions.c.id) < tuple_(*position)))
+    rows = await (await read_database()).fetch_all(query)
+    items = [TransactionRecord(transaction_id=row['id'], type=row['type'], amount=to_decimal(row['amount']),
+                               transaction_timestamp=row['transaction_timestamp']) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last.transaction_timestamp, last.transaction_id)
+    return TransactionPage(items=items, next_cursor=next_cursor)
 
 
-@database.transaction()
-async def create_transaction(to_user_id: int, amount: str, from_user_id: int = None) -> Transaction:
-    """Performs deposit and transfer operation"""
-    amt = Decimal(amount)
+@retry_on_conflict
+@count_rejections
+async def create_transaction(to_user_id: int, amount: str, from_user_id: int = None,
+                             idempotency_key: str = None) -> Transaction:
+    """Performs deposit and transfer operation
+
+    An operation repeated with the same idempotency_key returns the original result without being performed again
+    """
+    amt = amount.value if isinstance(amount, Amount) else parse_amount(amount)
     if amt <= 0:
         raise ValueError(f'Amount should be positive. Given value {amount}')
     if from_user_id is not None and from_user_id == to_user_id:
         raise ValueError(f'Cannot perform operation for the same user {from_user_id}')
-    to_wallet_id = None
-    from_wallet_id = None
-    # Lock wallets involved in operation
-    if from_user_id is None:
-        query = select([wallets.c.id]).where(wallets.c.user_id == to_user_id).with_for_update()
-        to_wallet_id = await database.execute(query)
-        if to_wallet_id is None:
-            raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
-    else:
-        from_wallet_balance = None
-        query = select(wallets).where(wallets.c.user_id.in_([from_user_id, to_user_id])).with_for_update()
-        for row in await database.fetch_all(query):
-            row_dict = dict(row._mapping)
-            if row_dict['user_id'] == to_user_id:
-                to_wallet_id = row_dict['id']
-            else:
-                from_wallet_id = row_dict['id']
-                from_wallet_balance = row_dict['balance']
-        if to_wallet_id is None:
-            raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
-        if from_wallet_id is None:
+    if idempotency_key is not None:
+        return await idempotent_transaction(key=idempotency_key, to_user_id=to_user_id, amt=amt,
+                                            from_user_id=from_user_id)
+    return await perform_transaction(to_user_id=to_user_id, amt=amt, from_user_id=from_user_id)
+
+
+async def idempotent_transaction(key: str, to_user_id: int, amt: Money, from_user_id: int = None) -> Transaction:
+    operation = idempotency.fingerprint(to_user_id=to_user_id, amount=to_decimal(amt), from_user_id=from_user_id)
+    stored = idempotency.idempotency_cache.get(key)
+    if stored is None:
+        stored = await idempotency.get_stored(key)
+    if stored is None:
+        stored = await claim_and_perform_transaction(key=key, operation=operation, to_user_id=to_user_id, amt=amt,
+                                                     from_user_id=from_user_id)
+    idempotency.idempotency_cache.set(key, stored)
+    return idempotency.replay(key, operation, stored)
+
+
+@transaction
+async def claim_and_perform_transaction(key: str, operation: str, to_user_id: int, amt: Money,
+                                        from_user_id: int = None) -> Tuple[str, Transaction]:
+    """Stores the key together with the ledger rows. A concurrent request with the same key waits for this one
+    and returns its result"""
+    if not await idempotency.claim(key, operation):
+        return await idempotency.get_stored(key)
+    result = await perform_transaction(to_user_id=to_user_id, amt=amt, from_user_id=from_user_id)
+    await idempotency.save(key, result)
+    return operation, result
+
+
+async def perform_transaction(to_user_id: int, amt: Money, from_user_id: int = None) -> Transaction:
+    if settings.single_statement == YES:
+        return await single_statement_transaction(to_user_id=to_user_id, amt=amt, from_user_id=from_user_id)
+    return await multi_statement_transaction(to_user_id=to_user_id, amt=amt, from_user_id=from_user_id)
+
+
+async def single_statement_transaction(to_user_id: int, amt: Money, from_user_id: int = None) -> Transaction:
+    """Locks wallets, checks balance, inserts ledger rows and updates balances in one server-side call"""
+    with EXECUTE.time():
+        row = await fetch_one(EXECUTE_TRANSACTION_QUERY, values={'to_user_id': to_user_id, 'amount': amt,
+                                                                 'from_user_id': from_user_id})
+    status = row['status']
+    if status == STATUS_HOT_WALLET:
+        return await multi_statement_transaction(to_user_id=to_user_id, amt=amt, from_user_id=from_user_id)
+    if status == STATUS_TO_WALLET_NOT_FOUND:
+        raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
+    if status == STATUS_FROM_WALLET_NOT_FOUND:
+        raise ValueError(f'Cannot find wallet of user {from_user_id} to perform credit')
+    if status == STATUS_INSUFFICIENT_FUNDS:
+        raise ValueError(
+            f'Not enough money on user {from_user_id} account. Balance {to_decimal(row["from_balance"])}. '
+            f'Amount {to_decimal(amt)}')
+    return Transaction(debit_transaction_id=row['debit_transaction_id'],
+                       credit_transaction_id=row['credit_transaction_id'])
+
+
+@transaction
+async def multi_statement_transaction(to_user_id: int, amt: Money, from_user_id: int = None) -> Transaction:
+    """Performs deposit and transfer operation statement by statement"""
+    user_ids = [to_user_id] if from_user_id is None else [to_user_id, from_user_id]
+    wallet_ids = await get_wallet_ids(user_ids)
+    to_wallet_id = wallet_ids.get(to_user_id)
+    from_wallet_id = wallet_ids.get(from_user_id)
+    # Regular wallets are locked by primary key, always in the order of ids so opposite transfers can't deadlock.
+    # Hot wallets aren't locked, their slots are updated instead
+    with LOCK_WAIT.time():
+        rows = await fetch_all(LOCK_REGULAR_WALLETS_QUERY, values={'wallet_ids': sorted(wallet_ids.values())})
+    balances = {row['id']: row['balance'] for row in rows}
+    hot_wallets = {}
+    if len(balances) < len(user_ids):
+        hot_wallets = await get_hot_wallets([user_id for user_id in user_ids
+                                             if wallet_ids.get(user_id) not in balances])
+    if to_wallet_id not in balances and to_user_id not in hot_wallets:
+        raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
+    if from_user_id is not None:
+        if from_wallet_id not in balances and from_user_id not in hot_wallets:
             raise ValueError(f'Cannot find wallet of user {from_user_id} to perform credit')
-        else:
-            if from_wallet_balance - amt < 0:
-                raise ValueError(
-                    f'Not enough money on user {from_user_id} account. Balance {from_wallet_balance}. Amount {amt}')
-    # Insert transactions
-    credit_id = None
-    from_balance = None
+        elif from_user_id in hot_wallets:
+            await debit_hot_wallet(*hot_wallets[from_user_id], amount=amt, user_id=from_user_id)
+        elif balances[from_wallet_id] - amt < 0:
+            raise ValueError(f'Not enough money on user {from_user_id} account. '
+                             f'Balance {to_decimal(balances[from_wallet_id])}. Amount {to_decimal(amt)}')
+    # Both ledger rows are inserted with one statement, ids are returned in the order of rows
+    ledger = [(to_wallet_id, TransactionType.debit)]
     if from_user_id is not None:
-        debit_id = await insert_transaction(wallet_id=to_wallet_id, type=TransactionType.debit, amount=amt)
-        credit_id = await insert_transaction(wallet_id=from_wallet_id, type=TransactionType.credit, amount=amt)
-        to_balance = await update_balance(user_id=to_user_id, amount=amt)
-        from_balance = await update_balance(user_id=from_user_id, amount=-amt)
-    else:
-        debit_id = await insert_transaction(wallet_id=to_wallet_id, type=TransactionType.debit, amount=amt)
-        to_balance = await update_balance(user_id=to_user_id, amount=amt)
-    return Transaction(debit_transaction_id=debit_id, credit_transaction_id=credit_id)
+        ledger.append((from_wallet_id, TransactionType.credit))
+    with INSERT.time():
+        rows = await fetch_all(INSERT_TRANSACTIONS_QUERY, values={'wallet_ids': [wallet_id for wallet_id, _ in ledger],
+                                                                  'types': [type_.value for _, type_ in ledger],
+                                                                  'amounts': [amt] * len(ledger)})
+    transaction_ids = [row['id'] for row in rows]
+    deltas = {}
+    with UPDATE.time():
+        if to_user_id in hot_wallets:
+            await credit_hot_wallet(*hot_wallets[to_user_id], amount=amt)
+        else:
+            deltas[to_wallet_id] = amt
+        if from_user_id is not None and from_user_id not in hot_wallets:
+            deltas[from_wallet_id] = -amt
+        if deltas:
+            await execute(UPDATE_BALANCES_QUERY, values={'wallet_ids': list(deltas), 'deltas': list(deltas.values())})
+    return Transaction(debit_transaction_id=transaction_ids[0],
+                       credit_transaction_id=transaction_ids[1] if from_user_id is not None else None)
+
+
+@retry_on_conflict
+@transaction
+async def create_transactions_batch(items: List[Union[TransferRequest, DepositRequest]],
+                                    mode: BatchMode = BatchMode.all_or_nothing) -> BatchResponse:
+    """Performs deposits and transfers in order with a fixed number of statements
+
+    Every wallet involved is locked once, balances are checked in Python against running balances (so items can
+    depend on earlier items), ledger rows are inserted with one statement and each wallet's net change is applied
+    with one update.
+    """
+    user_ids = set()
+    for item in items:
+        if isinstance(item, TransferRequest):
+            user_ids.update((item.from_user_id, item.to_user_id))
+        else:
+            user_ids.add(item.user_id)
+    wallet_ids = await get_wallet_ids(user_ids)
+    balances = {}
+    hot_wallet_ids = set()
+    for row in await fetch_all(LOCK_WALLETS_QUERY, values={'wallet_ids': sorted(wallet_ids.values())}):
+        balances[row['id']] = row['balance']
+        if row['slots'] > 0:
+            hot_wallet_ids.add(row['id'])
+    wallet_ids = {user_id: wallet_id for user_id, wallet_id in wallet_ids.items() if wallet_id in balances}
+    # Money of hot wallets paying in the batch is moved from their slots to the locked base balance
+    consolidated = {}
+    paying_hot_wallet_ids = {wallet_ids.get(item.from_user_id) for item in items
+                             if isinstance(item, TransferRequest)} & hot_wallet_ids
+    if paying_hot_wallet_ids:
+        consolidated = await consolidate_slots(paying_hot_wallet_ids)
+        for wallet_id, amount in consolidated.items():
+            balances[wallet_id] += amount
+    deltas = defaultdict(int, consolidated)
+    ledger = []
+    results = []
+    for index, item in enumerate(items):
+        amt = item.amount.value if isinstance(item.amount, Amount) else parse_amount(item.amount)
+        try:
+            if isinstance(item, TransferRequest):
+                to_user_id, from_user_id = item.to_user_id, item.from_user_id
+                if from_user_id == to_user_id:
+                    raise ValueError(f'Cannot perform operation for the same user {from_user_id}')
+            else:
+                to_user_id, from_user_id = item.user_id, None
+            if to_user_id not in wallet_ids:
+                raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
+            if from_user_id is not None:
+                if from_user_id not in wallet_ids:
+                    raise ValueError(f'Cannot find wallet of user {from_user_id} to perform credit')
+                from_wallet_balance = balances[wallet_ids[from_user_id]]
+                if from_wallet_balance - amt < 0:
+                    raise ValueError(f'Not enough money on user {from_user_id} account. '
+                                     f'Balance {to_decimal(from_wallet_balance)}. Amount {to_decimal(amt)}')
+        except ValueError as e:
+            REJECTIONS.labels(rejection_reason(e)).inc()
+            if mode == BatchMode.all_or_nothing:
+                results = [BatchItemResult(status=BatchItemStatus.aborted) for _ in items]
+                results[index] = BatchItemResult(status=BatchItemStatus.rejected, error=str(e))
+                ledger = []
+                deltas = consolidated
+                break
+            results.append(BatchItemResult(status=BatchItemStatus.rejected, error=str(e)))
+            continue
+        to_wallet_id = wallet_ids[to_user_id]
+        balances[to_wallet_id] += amt
+        deltas[to_wallet_id] += amt
+        ledger.append((index, to_wallet_id, TransactionType.debit, amt))
+        if from_user_id is not None:
+            from_wallet_id = wallet_ids[from_user_id]
+            balances[from_wallet_id] -= amt
+            deltas[from_wallet_id] -= amt
+            ledger.append((index, from_wallet_id, TransactionType.credit, amt))
+        results.append(BatchItemResult(status=BatchItemStatus.applied))
+    if deltas:
+        await execute(UPDATE_BALANCES_QUERY,
+                      values={'wallet_ids': list(deltas.keys()), 'deltas': list(deltas.values())})
+    if not ledger:
+        return BatchResponse(applied=0, results=results)
+    values = {'wallet_ids': [row[1] for row in ledger],
+              'types': [row[2].value for row in ledger],
+              'amounts': [row[3] for row in ledger]}
+    # Ids are returned in the order of the inserted rows
+    rows = await fetch_all(INSERT_TRANSACTIONS_QUERY, values=values)
+    transaction_ids = [row['id'] for row in rows]
+    ids_by_item = defaultdict(dict)
+    for (index, _, type_, _), transaction_id in zip(ledger, transaction_ids):
+        ids_by_item[index][type_] = transaction_id
+    for index, ids in ids_by_item.items():
+        results[index].transaction = Transaction(debit_transaction_id=ids[TransactionType.debit],
+                                                 credit_transaction_id=ids.get(TransactionType.credit))
+    return BatchResponse(applied=len(ids_by_item), results=results)
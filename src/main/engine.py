@@ -0,0 +1,407 @@
+import asyncio
+import json
+import os
+import re
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from src.main import crud
+from src.main.idempotency import fingerprint, replay
+from src.main.metrics import count_rejections
+from src.main.model import UserRequest, UserResponse, Transaction, TransactionType, BalanceResponse
+from src.main.settings import settings, database, init_db
+from src.main.utils.constants import MEMORY, POSTGRES
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+class StorageEngine(ABC):
+    """Storage of users, wallets and the ledger"""
+
+    @abstractmethod
+    async def connect(self):
+        pass
+
+    @abstractmethod
+    async def disconnect(self):
+        pass
+
+    @abstractmethod
+    async def create_user(self, request: UserRequest) -> UserResponse:
+        pass
+
+    @abstractmethod
+    async def create_transaction(self, to_user_id: int, amount: str, from_user_id: int = None,
+                                 idempotency_key: str = None) -> Transaction:
+        pass
+
+    @abstractmethod
+    async def get_wallet(self, user_id: int) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    async def get_balance(self, user_id: int) -> Optional[BalanceResponse]:
+        pass
+
+
+class PostgresEngine(StorageEngine):
+    """Database storage, see crud"""
+
+    async def connect(self):
+        await init_db()
+
+    async def disconnect(self):
+        await database.disconnect()
+
+    async def create_user(self, request: UserRequest) -> UserResponse:
+        return await crud.create_user(request=request)
+
+    async def create_transaction(self, to_user_id: int, amount: str, from_user_id: int = None,
+                                 idempotency_key: str = None) -> Transaction:
+        return await crud.create_transaction(to_user_id=to_user_id, amount=amount, from_user_id=from_user_id,
+                                             idempotency_key=idempotency_key)
+
+    async def get_wallet(self, user_id: int) -> Optional[Dict]:
+        return await crud.get_wallet(user_id=user_id)
+
+    async def get_balance(self, user_id: int) -> Optional[BalanceResponse]:
+        return await crud.get_balance(user_id=user_id)
+
+
+class WriteAheadLog:
+    """Append-only file of JSON records. Records appended while a write is in progress are written and fsynced
+    together with the next one
+
+    After a failed write it's unknown what reached the disk, so the log fails every record appended later too (error
+    is set); the process has to be restarted to recover from what's on disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._buffer: List[str] = []
+        self._waiters: List[asyncio.Future] = []
+        self._flushing: Optional[asyncio.Task] = None
+        self.records = 0
+        self.error: Optional[Exception] = None
+
+    def append(self, record: list) -> asyncio.Future:
+        """Returns future resolved once the record is on disk"""
+        waiter = asyncio.get_running_loop().create_future()
+        if self.error is not None:
+            waiter.set_exception(self.error)
+            return waiter
+        self._buffer.append(json.dumps(record) + '\n')
+        self.records += 1
+        self._waiters.append(waiter)
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush())
+        return waiter
+
+    async def _flush(self):
+        while self._buffer:
+            data, waiters = ''.join(self._buffer).encode(), self._waiters
+            self._buffer, self._waiters = [], []
+            try:
+                if self.error is not None:
+                    raise self.error
+                await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+            except Exception as e:
+                self.error = e
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                waiter.set_result(None)
+        self._flushing = None
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def close(self):
+        if self._flushing is not None:
+            await self._flushing
+        self._file.close()
+
+    @staticmethod
+    def read(path: str) -> List[list]:
+        records = []
+        with open(path, 'rb') as file:
+            for line in file:
+                # The last record may have been written partially
+                if not line.endswith(b'\n'):
+                    break
+                records.append(json.loads(line))
+        return records
+
+
+class MemoryEngine(StorageEngine):
+    """Keeps users, wallets and the ledger in process memory, optionally persisted to data_dir
+
+    Wallets are kept in arrays indexed by id and the ledger is append-only. An operation is validated, applied and
+    appended to the write-ahead log without yielding to the event loop, so operations can't interleave and no locks
+    are needed. The caller is answered once its log record is fsynced. If the log can't be written the operation is
+    rolled back and the caller gets the error; as the log fails every later record too, rolled back operations are
+    always the last ones applied. Snapshot n holds the state from before
+    log n, recovery loads the latest snapshot and replays the logs following it.
+    """
+    FILE_NAME = re.compile(r'^(snapshot|wal)-(\d+)\.(json|log)$')
+
+    def __init__(self, data_dir: str = None, snapshot_every: int = 0):
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.generation = 0
+        self.wal: Optional[WriteAheadLog] = None
+        self._snapshotting: Optional[asyncio.Task] = None
+        self._reset()
+
+    def _reset(self):
+        self.first_names: List[str] = []
+        self.last_names: List[str] = []
+        self.wallet_ids = array('q')  # by user id - 1
+        self.wallet_user_ids = array('q')  # by wallet id - 1
+        self.balances: List[Decimal] = []  # by wallet id - 1
+        self.ledger_wallet_ids = array('q')  # by transaction id - 1
+        self.ledger_types = bytearray()
+        self.ledger_amounts: List[Decimal] = []
+        self.ledger_timestamps = array('d')
+        # Idempotency keys in the order they were used: key -> (fingerprint, transaction, timestamp)
+        self.idempotency_keys: OrderedDict = OrderedDict()
+
+    def _path(self, kind: str, generation: int) -> str:
+        return os.path.join(self.data_dir, f'{kind}-{generation:08d}.{"json" if kind == "snapshot" else "log"}')
+
+    def _generations(self, kind: str) -> List[int]:
+        return sorted(int(match.group(2)) for match in map(self.FILE_NAME.match, os.listdir(self.data_dir))
+                      if match and match.group(1) == kind)
+
+    async def connect(self):
+        self._reset()
+        if self.data_dir is None:
+            return
+        os.makedirs(self.data_dir, exist_ok=True)
+        snapshots = self._generations('snapshot')
+        start = snapshots[-1] if snapshots else 0
+        if snapshots:
+            self._load_snapshot(self._path('snapshot', start))
+        logs = [generation for generation in self._generations('wal') if generation >= start]
+        for generation in logs:
+            for record in WriteAheadLog.read(self._path('wal', generation)):
+                self._replay(record)
+        self.generation = max(logs + [start]) + 1
+        self.wal = WriteAheadLog(self._path('wal', self.generation))
+        logger.info(f'Recovered {len(self.wallet_ids)} users and {len(self.ledger_wallet_ids)} transactions')
+
+    async def disconnect(self):
+        if self._snapshotting is not None:
+            await self._snapshotting
+        if self.wal is not None:
+            await self.wal.close()
+            self.wal = None
+
+    def _log(self, record: list) -> Optional[asyncio.Future]:
+        if self.wal is None:
+            return None
+        durable = self.wal.append(record)
+        if self.snapshot_every and self.wal.records >= self.snapshot_every and self._snapshotting is None:
+            self._snapshotting = asyncio.ensure_future(self.snapshot())
+        return durable
+
+    def _replay(self, record: list):
+        if record[0] == 'u':
+            self._add_user(record[1], record[2])
+        else:
+            result = self._add_transaction(record[1], record[2], Decimal(record[3]), record[4])
+            if len(record) > 5:
+                self._add_idempotency_key(record[5], record[6], result, record[4])
+
+    def _add_user(self, first_name: str, last_name: str) -> UserResponse:
+        self.first_names.append(first_name)
+        self.last_names.append(last_name)
+        user_id = wallet_id = len(self.first_names)
+        self.wallet_ids.append(wallet_id)
+        self.wallet_user_ids.append(user_id)
+        self.balances.append(Decimal(0))
+        return UserResponse(first_name=first_name, last_name=last_name, user_id=user_id, wallet_id=wallet_id)
+
+    def _add_ledger_row(self, wallet_id: int, type_: TransactionType, amount: Decimal, timestamp: float) -> int:
+        self.ledger_wallet_ids.append(wallet_id)
+        self.ledger_types.append(type_ == TransactionType.credit)
+        self.ledger_amounts.append(amount)
+        self.ledger_timestamps.append(timestamp)
+        return len(self.ledger_wallet_ids)
+
+    def _add_transaction(self, to_wallet_id: int, from_wallet_id: Optional[int], amount: Decimal,
+                         timestamp: float) -> Transaction:
+        debit_id = self._add_ledger_row(to_wallet_id, TransactionType.debit, amount, timestamp)
+        self.balances[to_wallet_id - 1] += amount
+        credit_id = None
+        if from_wallet_id is not None:
+            credit_id = self._add_ledger_row(from_wallet_id, TransactionType.credit, amount, timestamp)
+            self.balances[from_wallet_id - 1] -= amount
+        return Transaction(debit_transaction_id=debit_id, credit_transaction_id=credit_id)
+
+    def _add_idempotency_key(self, key: str, operation: str, result: Transaction, timestamp: float):
+        self.idempotency_keys[key] = (operation, result, timestamp)
+        # A reused expired key becomes the newest one, so the oldest key stays first
+        self.idempotency_keys.move_to_end(key)
+        expired = timestamp - settings.idempotency_key_ttl
+        while next(iter(self.idempotency_keys.values()))[2] < expired:
+            self.idempotency_keys.popitem(last=False)
+
+    def _undo_user(self, user: UserResponse):
+        """Removes the user and the users created after it"""
+        count = user.user_id - 1
+        for values in (self.first_names, self.last_names, self.wallet_ids, self.wallet_user_ids, self.balances):
+            del values[count:]
+
+    def _undo_transaction(self, to_wallet_id: int, from_wallet_id: Optional[int], amount: Decimal,
+                          result: Transaction, idempotency_key: Optional[str]):
+        """Reverts balances changed by the transaction and removes its ledger rows and the rows added after them"""
+        for wallet_id, delta in ((to_wallet_id, -amount), (from_wallet_id, amount)):
+            # Wallets of users rolled back already are gone
+            if wallet_id is not None and wallet_id <= len(self.balances):
+                self.balances[wallet_id - 1] += delta
+        count = result.debit_transaction_id - 1
+        for values in (self.ledger_wallet_ids, self.ledger_types, self.ledger_amounts, self.ledger_timestamps):
+            del values[count:]
+        stored = self.idempotency_keys.get(idempotency_key)
+        if stored is not None and stored[1] is result:
+            del self.idempotency_keys[idempotency_key]
+
+    def _wallet_id(self, user_id: int) -> Optional[int]:
+        return self.wallet_ids[user_id - 1] if 0 < user_id <= len(self.wallet_ids) else None
+
+    async def create_user(self, request: UserRequest) -> UserResponse:
+        user = self._add_user(request.first_name, request.last_name)
+        durable = self._log(['u', request.first_name, request.last_name])
+        if durable is not None:
+            try:
+                await durable
+            except Exception:
+                self._undo_user(user)
+                raise
+        return user
+
+    @count_rejections
+    async def create_transaction(self, to_user_id: int, amount: str, from_user_id: int = None,
+                                 idempotency_key: str = None) -> Transaction:
+        amt = Decimal(amount)
+        if amt <= 0:
+            raise ValueError(f'Amount should be positive. Given value {amount}')
+        if from_user_id is not None and from_user_id == to_user_id:
+            raise ValueError(f'Cannot perform operation for the same user {from_user_id}')
+        operation = None
+        if idempotency_key is not None:
+            operation = fingerprint(to_user_id=to_user_id, amount=amt, from_user_id=from_user_id)
+            stored = self.idempotency_keys.get(idempotency_key)
+            if stored is not None and stored[2] >= time.time() - settings.idempotency_key_ttl:
+                return replay(idempotency_key, operation, stored[:2])
+        to_wallet_id = self._wallet_id(to_user_id)
+        if to_wallet_id is None:
+            raise ValueError(f'Cannot find wallet of user {to_user_id} to perform deposit')
+        from_wallet_id = None
+        if from_user_id is not None:
+            from_wallet_id = self._wallet_id(from_user_id)
+            if from_wallet_id is None:
+                raise ValueError(f'Cannot find wallet of user {from_user_id} to perform credit')
+            from_wallet_balance = self.balances[from_wallet_id - 1]
+            if from_wallet_balance - amt < 0:
+                raise ValueError(
+                    f'Not enough money on user {from_user_id} account. Balance {from_wallet_balance}. Amount {amt}')
+        timestamp = time.time()
+        result = self._add_transaction(to_wallet_id, from_wallet_id, amt, timestamp)
+        record = ['t', to_wallet_id, from_wallet_id, str(amt), timestamp]
+        if idempotency_key is not None:
+            self._add_idempotency_key(idempotency_key, operation, result, timestamp)
+            record += [idempotency_key, operation]
+        durable = self._log(record)
+        if durable is not None:
+            try:
+                await durable
+            except Exception:
+                self._undo_transaction(to_wallet_id, from_wallet_id, amt, result, idempotency_key)
+                raise
+        return result
+
+    async def get_wallet(self, user_id: int) -> Optional[Dict]:
+        wallet_id = self._wallet_id(user_id)
+        if wallet_id is None:
+            return None
+        return {'id': wallet_id, 'user_id': user_id, 'balance': self.balances[wallet_id - 1], 'slots': 0}
+
+    async def get_balance(self, user_id: int) -> Optional[BalanceResponse]:
+        wallet_id = self._wallet_id(user_id)
+        if wallet_id is None:
+            return None
+        return BalanceResponse(user_id=user_id, wallet_id=wallet_id, balance=self.balances[wallet_id - 1])
+
+    async def snapshot(self):
+        """Writes the state to snapshot n + 1, continues logging to log n + 1 and removes older files"""
+        try:
+            if self.wal.error is not None:
+                return
+            state = {'first_names': list(self.first_names), 'last_names': list(self.last_names),
+                     'balances': [str(balance) for balance in self.balances],
+                     'ledger_wallet_ids': self.ledger_wallet_ids.tolist(),
+                     'ledger_types': list(self.ledger_types),
+                     'ledger_amounts': [str(amount) for amount in self.ledger_amounts],
+                     'ledger_timestamps': self.ledger_timestamps.tolist(),
+                     'idempotency_keys': [[key, operation, result.debit_transaction_id,
+                                           result.credit_transaction_id, timestamp]
+                                          for key, (operation, result, timestamp) in self.idempotency_keys.items()]}
+            previous, self.generation = self.wal, self.generation + 1
+            self.wal = WriteAheadLog(self._path('wal', self.generation))
+            generation = self.generation
+            await previous.close()
+            if previous.error is not None:
+                # The state may hold operations rolled back since, and nothing is logged anymore
+                self.wal.error = previous.error
+                return
+            await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, state, generation)
+            for kind in ('snapshot', 'wal'):
+                for old in self._generations(kind):
+                    if old < generation:
+                        os.remove(self._path(kind, old))
+        finally:
+            self._snapshotting = None
+
+    def _write_snapshot(self, state: dict, generation: int):
+        path = self._path('snapshot', generation)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _load_snapshot(self, path: str):
+        with open(path) as file:
+            state = json.load(file)
+        for first_name, last_name in zip(state['first_names'], state['last_names']):
+            self._add_user(first_name, last_name)
+        self.balances = [Decimal(balance) for balance in state['balances']]
+        self.ledger_wallet_ids = array('q', state['ledger_wallet_ids'])
+        self.ledger_types = bytearray(state['ledger_types'])
+        self.ledger_amounts = [Decimal(amount) for amount in state['ledger_amounts']]
+        self.ledger_timestamps = array('d', state['ledger_timestamps'])
+        for key, operation, debit_id, credit_id, timestamp in state.get('idempotency_keys', []):
+            self._add_idempotency_key(key, operation, Transaction(debit_transaction_id=debit_id,
+                                                                  credit_transaction_id=credit_id), timestamp)
+
+
+def create_engine() -> StorageEngine:
+    if settings.storage_engine == MEMORY:
+        return MemoryEngine(data_dir=settings.memory_data_dir, snapshot_every=settings.memory_snapshot_every)
+    if settings.storage_engine != POSTGRES:
+        raise ValueError(f'Unknown storage engine {settings.storage_engine}')
+    return PostgresEngine()
+
+
+engine = create_engine()
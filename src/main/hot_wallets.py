@@ -0,0 +1,107 @@
+import random
+from decimal import Decimal, ROUND_DOWN
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import select, func
+
+from src.main.model import wallets, wallet_slots, HotWalletRequest, HotWalletResponse
+from src.main.money import Money, to_decimal
+from src.main.settings import database, transaction
+from src.main.utils.constants import CONSOLIDATE_SLOTS
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+@transaction
+async def make_wallet_hot(request: HotWalletRequest) -> HotWalletResponse:
+    """Splits wallet balance into slots so concurrent deposits don't wait for each other
+
+    The number of slots can be increased but not decreased
+    """
+    query = (select([wallets.c.id, wallets.c.slots])
+             .where(wallets.c.user_id == request.user_id)
+             .with_for_update())
+    row = await database.fetch_one(query)
+    if row is None:
+        raise ValueError(f'Cannot find wallet of user {request.user_id}')
+    if request.slots < row['slots']:
+        raise ValueError(f'Cannot decrease number of slots of user {request.user_id} wallet from {row["slots"]} '
+                         f'to {request.slots}')
+    new_slots = [{'wallet_id': row['id'], 'slot': slot, 'balance': 0} for slot in range(row['slots'], request.slots)]
+    if new_slots:
+        await database.execute(wallet_slots.insert().values(new_slots))
+        await database.execute(wallets.update().where(wallets.c.id == row['id']).values(slots=request.slots))
+    return HotWalletResponse(**request.dict(), wallet_id=row['id'])
+
+
+async def get_hot_wallets(user_ids: Iterable[int]) -> Dict[int, Tuple[int, int]]:
+    """Maps user ids to (wallet id, number of slots) of their hot wallets, without locking them"""
+    query = (select([wallets.c.id, wallets.c.user_id, wallets.c.slots])
+             .where(wallets.c.user_id.in_(list(user_ids)))
+             .where(wallets.c.slots > 0))
+    return {row['user_id']: (row['id'], row['slots']) for row in await database.fetch_all(query)}
+
+
+async def credit_hot_wallet(wallet_id: int, slots: int, amount: Money):
+    """Adds money to a random slot, only this slot row is locked"""
+    query = (wallet_slots.update()
+             .where(wallet_slots.c.wallet_id == wallet_id)
+             .where(wallet_slots.c.slot == random.randrange(slots))
+             .values(balance=wallet_slots.c.balance + amount))
+    await database.execute(query)
+
+
+async def debit_hot_wallet(wallet_id: int, slots: int, amount: Money, user_id: int):
+    """Takes money from a random slot holding enough of it
+
+    Otherwise locks the wallet and all its slots and spreads what is left evenly across the slots
+    """
+    query = (wallet_slots.update()
+             .where(wallet_slots.c.wallet_id == wallet_id)
+             .where(wallet_slots.c.slot == random.randrange(slots))
+             .where(wallet_slots.c.balance >= amount)
+             .values(balance=wallet_slots.c.balance - amount)
+             .returning(wallet_slots.c.slot))
+    if await database.execute(query) is not None:
+        return
+    query = select([wallets.c.balance]).where(wallets.c.id == wallet_id).with_for_update()
+    base_balance = await database.execute(query)
+    query = (select([wallet_slots.c.slot, wallet_slots.c.balance])
+             .where(wallet_slots.c.wallet_id == wallet_id)
+             .order_by(wallet_slots.c.slot)
+             .with_for_update())
+    slot_rows = await database.fetch_all(query)
+    balance = base_balance + sum(row['balance'] for row in slot_rows)
+    if balance - amount < 0:
+        raise ValueError(f'Not enough money on user {user_id} account. Balance {to_decimal(balance)}. '
+                         f'Amount {to_decimal(amount)}')
+    remaining = balance - amount
+    if isinstance(remaining, int):
+        share = remaining // len(slot_rows)
+    else:
+        share = (remaining / len(slot_rows)).quantize(Decimal(1).scaleb(remaining.as_tuple().exponent),
+                                                      rounding=ROUND_DOWN)
+    await database.execute(wallets.update().where(wallets.c.id == wallet_id).values(balance=0))
+    await database.execute(wallet_slots.update().where(wallet_slots.c.wallet_id == wallet_id).values(balance=share))
+    await database.execute(wallet_slots.update()
+                           .where(wallet_slots.c.wallet_id == wallet_id)
+                           .where(wallet_slots.c.slot == 0)
+                           .values(balance=remaining - share * (len(slot_rows) - 1)))
+    logger.debug(f'Rebalanced {len(slot_rows)} slots of wallet {wallet_id}')
+
+
+async def consolidate_slots(wallet_ids: Iterable[int]) -> Dict[int, Money]:
+    """Locks slots of the wallets and moves their money into the base balance
+
+    Returns moved amounts; the caller has to add them to the base balance of the wallets
+    """
+    rows = await database.fetch_all(query=CONSOLIDATE_SLOTS, values={'wallet_ids': list(wallet_ids)})
+    return {row['wallet_id']: row['balance'] for row in rows}
+
+
+def slots_balance():
+    """Sum of slots of a wallet, correlated with the wallets table"""
+    return (select([func.coalesce(func.sum(wallet_slots.c.balance), 0)])
+            .where(wallet_slots.c.wallet_id == wallets.c.id)
+            .scalar_subquery())
@@ -0,0 +1,92 @@
+import asyncio
+from decimal import Decimal
+from typing import Optional, Tuple
+
+from src.main.cache import TTLCache
+from src.main.model import Transaction
+from src.main.settings import database, settings, spawn
+from src.main.utils.constants import CLAIM_IDEMPOTENCY_KEY, GET_IDEMPOTENCY_KEY, SAVE_IDEMPOTENCY_KEY, \
+    EXPIRE_IDEMPOTENCY_KEYS
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+# Committed results by key, so retries of recent requests don't reach the database
+idempotency_cache = TTLCache(maxsize=settings.idempotency_cache_size, ttl=settings.idempotency_cache_ttl)
+
+
+class IdempotencyKeyReused(ValueError):
+    """Key was already used for a different operation"""
+
+
+def fingerprint(to_user_id: int, amount: Decimal, from_user_id: int = None) -> str:
+    return f'{to_user_id}:{from_user_id or ""}:{format(amount.normalize(), "f")}'
+
+
+def replay(key: str, operation: str, stored: Tuple[str, Transaction]) -> Transaction:
+    """Result of the operation stored under the key"""
+    stored_operation, result = stored
+    if stored_operation != operation:
+        raise IdempotencyKeyReused(f'Idempotency key {key} was used for a different operation')
+    return result
+
+
+async def get_stored(key: str) -> Optional[Tuple[str, Transaction]]:
+    row = await database.fetch_one(query=GET_IDEMPOTENCY_KEY, values={'key': key})
+    if row is None:
+        return None
+    return row['fingerprint'], Transaction(debit_transaction_id=row['debit_transaction_id'],
+                                           credit_transaction_id=row['credit_transaction_id'])
+
+
+async def claim(key: str, operation: str) -> bool:
+    """Inserts the key within the current transaction. False if it was committed by another one"""
+    return await database.execute(query=CLAIM_IDEMPOTENCY_KEY, values={'key': key, 'fingerprint': operation}) \
+        is not None
+
+
+async def save(key: str, result: Transaction):
+    await database.execute(query=SAVE_IDEMPOTENCY_KEY,
+                           values={'key': key, 'debit_id': result.debit_transaction_id,
+                                   'credit_id': result.credit_transaction_id})
+
+
+async def expire_idempotency_keys() -> int:
+    """Deletes keys older than idempotency_key_ttl in batches, returns their number"""
+    expired = 0
+    while True:
+        deleted = await database.fetch_val(query=EXPIRE_IDEMPOTENCY_KEYS,
+                                           values={'ttl': settings.idempotency_key_ttl,
+                                                   'limit': settings.idempotency_expiry_batch_size})
+        expired += deleted
+        if deleted < settings.idempotency_expiry_batch_size:
+            return expired
+
+
+class IdempotencyKeysExpiry:
+    """Deletes expired idempotency keys, periodically"""
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if settings.idempotency_expiry_interval > 0:
+            self._task = spawn(self._work())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(settings.idempotency_expiry_interval)
+            try:
+                expired = await expire_idempotency_keys()
+                if expired:
+                    logger.info(f'Expired {expired} idempotency keys')
+            except Exception:
+                logger.exception('Cannot expire idempotency keys')
+
+
+idempotency_keys_expiry = IdempotencyKeysExpiry()
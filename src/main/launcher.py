@@ -0,0 +1,159 @@
+"""Runs the service with several worker processes serving one socket
+
+The schema is created once, before the workers start, so they don't run any DDL. The budget of DB_CONNECTIONS
+database connections is divided between the workers and, within a worker, evenly between its pool of the primary and
+the pools of REPLICA_URLS; every worker opens all its connections and warms them up before it accepts requests. With
+METRICS_PORT every worker serves its own metrics on METRICS_PORT + its index, so each one can be scraped. On SIGTERM
+or SIGINT the workers stop accepting connections, finish requests in progress and close their pools. Workers still
+running after GRACEFUL_TIMEOUT seconds are killed. A worker which exits on its own is restarted, after a delay which
+doubles with every exit in a row (up to RESTART_DELAY_MAX seconds) unless it ran for WORKER_STABLE_AFTER seconds.
+
+Usage: python -m src.main.launcher --workers 4 --connections 80 --host 0.0.0.0 --port 8000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+
+from src.main.settings import settings, database, init_db
+from src.main.utils.constants import YES, NO
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+APP = 'src.main.app:app'
+
+RESTART_DELAY_MIN = 0.5
+RESTART_DELAY_MAX = 30
+WORKER_STABLE_AFTER = 60
+
+
+def pool_size(connections: int, workers: int, replicas: int = 0) -> int:
+    """Number of connections of every pool of every worker, one pool of the primary and one per replica"""
+    pools = workers * (1 + replicas)
+    if connections < pools:
+        raise ValueError(f'Budget of {connections} connections is too small for {workers} workers '
+                         f'with {replicas} replicas')
+    return connections // pools
+
+
+def worker_environment(index: int, size: int, replicas: int = 0,
+                       metrics_port: Optional[int] = None) -> Dict[str, str]:
+    """Settings of a worker. Maintenance tasks run in the first one only"""
+    environment = {'POOL_MIN': str(size), 'POOL_MAX': str(size), 'RUN_MIGRATIONS': NO,
+                   'BACKGROUND_TASKS': YES if index == 0 else NO}
+    if replicas:
+        environment.update({'REPLICA_POOL_MIN': str(size), 'REPLICA_POOL_MAX': str(size)})
+    if metrics_port is not None:
+        environment['METRICS_PORT'] = str(metrics_port + index)
+    return environment
+
+
+def restart_delay(previous: float, uptime: float) -> float:
+    """Seconds before a worker which exited after uptime seconds is restarted, previous is the delay of its last
+    restart or 0 if it had none"""
+    if not previous or uptime >= WORKER_STABLE_AFTER:
+        return RESTART_DELAY_MIN
+    return min(previous * 2, RESTART_DELAY_MAX)
+
+
+def serve(config: uvicorn.Config, sock: socket.socket):
+    # Out of the process group of the launcher, so Ctrl+C in a terminal reaches the launcher only and workers
+    # get a single SIGTERM
+    os.setpgrp()
+    config.configure_logging()
+    uvicorn.Server(config=config).run(sockets=[sock])
+
+
+async def migrate():
+    await init_db()
+    await database.disconnect()
+
+
+class Launcher:
+    def __init__(self, workers: int, connections: int, host: str, port: int, graceful_timeout: float,
+                 metrics_port: Optional[int] = None):
+        self.workers = workers
+        self.replicas = len(settings.replica_urls)
+        self.size = pool_size(connections, workers, self.replicas)
+        self.metrics_port = metrics_port
+        self.graceful_timeout = graceful_timeout
+        self.config = uvicorn.Config(APP, host=host, port=port, lifespan='on')
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: List[multiprocessing.Process] = []
+        self.started: List[float] = [0.0] * workers
+        # Delay of the last restart of every worker and when a worker which exited is due to be restarted
+        self.delays: List[float] = [0.0] * workers
+        self.restarts: Dict[int, float] = {}
+        self.stopping = False
+
+    def start_worker(self, index: int, sock: socket.socket) -> multiprocessing.Process:
+        # Spawned processes inherit the environment, settings of the worker are read from it when it imports the app
+        os.environ.update(worker_environment(index, self.size, self.replicas, self.metrics_port))
+        if self.metrics_port is not None:
+            os.environ['METRICS_HOST'] = self.config.host
+        process = self.context.Process(target=serve, args=(self.config, sock), name=f'worker-{index}')
+        process.start()
+        self.started[index] = time.monotonic()
+        logger.info(f'Started worker {index} (pid {process.pid}) with {self.size} connections per pool')
+        return process
+
+    def handle_exit(self, sig, frame):
+        self.stopping = True
+
+    def run(self):
+        asyncio.run(migrate())
+        sock = self.config.bind_socket()
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+        self.processes = [self.start_worker(index, sock) for index in range(self.workers)]
+        while not self.stopping:
+            for index, process in enumerate(self.processes):
+                if process.is_alive() or self.stopping:
+                    continue
+                now = time.monotonic()
+                if index not in self.restarts:
+                    self.delays[index] = restart_delay(self.delays[index], now - self.started[index])
+                    self.restarts[index] = now + self.delays[index]
+                    logger.error(f'Worker {index} (pid {process.pid}) exited with code {process.exitcode}, '
+                                 f'restarting it in {self.delays[index]} s')
+                elif now >= self.restarts[index]:
+                    del self.restarts[index]
+                    self.processes[index] = self.start_worker(index, sock)
+            time.sleep(0.5)
+        self.stop()
+        sock.close()
+
+    def stop(self):
+        logger.info(f'Stopping {len(self.processes)} workers')
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f'Killing worker {process.name} (pid {process.pid}) after {self.graceful_timeout} s')
+                process.kill()
+                process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=settings.workers)
+    parser.add_argument('--connections', type=int, default=settings.db_connections,
+                        help='database connections of all workers together')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--graceful-timeout', type=float, default=settings.graceful_timeout)
+    parser.add_argument('--metrics-port', type=int, default=settings.metrics_port,
+                        help='metrics of worker N are served on this port + N')
+    args = parser.parse_args()
+    Launcher(workers=args.workers, connections=args.connections, host=args.host, port=args.port,
+             graceful_timeout=args.graceful_timeout, metrics_port=args.metrics_port).run()
@@ -0,0 +1,131 @@
+"""Maintenance of the partitioned ledger
+
+Usage: python -m src.main.ledger archive --before 2026-01-01
+       python -m src.main.ledger export --before 2026-01-01 --directory /var/backups/ledger
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import re
+from datetime import date
+from typing import List, Optional, Tuple
+
+from src.main.settings import database, settings, transaction, spawn, init_db
+from src.main.utils.constants import CREATE_TRANSACTION_PARTITIONS, LEDGER_PARTITIONS
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+PARTITION_NAME = re.compile(r'^transactions_p(\d{4})_(\d{2})$')
+
+
+class LedgerMaintenance:
+    """Creates ledger partitions ahead of time, periodically"""
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if settings.ledger_maintenance_interval > 0:
+            self._task = spawn(self._work())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(settings.ledger_maintenance_interval)
+            try:
+                await ensure_partitions()
+            except Exception:
+                logger.exception('Cannot create ledger partitions')
+
+
+ledger_maintenance = LedgerMaintenance()
+
+
+async def ensure_partitions(months_ahead: int = None) -> List[str]:
+    """Creates missing monthly partitions up to months_ahead months ahead, returns their names"""
+    if months_ahead is None:
+        months_ahead = settings.ledger_partitions_ahead
+    rows = await database.fetch_all(query=CREATE_TRANSACTION_PARTITIONS, values={'months_ahead': months_ahead})
+    created = [row[0] for row in rows]
+    if created:
+        logger.info(f'Created ledger partitions {", ".join(created)}')
+    return created
+
+
+def partition_bounds(name: str) -> Tuple[date, date]:
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        raise ValueError(f'{name} is not a monthly ledger partition')
+    year, month = map(int, match.groups())
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+
+async def cold_partitions(before: date) -> List[str]:
+    """Monthly partitions of the ledger holding only transactions older than before"""
+    names = [row['name'] for row in await database.fetch_all(LEDGER_PARTITIONS)]
+    return sorted(name for name in names if PARTITION_NAME.match(name) and partition_bounds(name)[1] <= before)
+
+
+@transaction
+async def archive_partition(name: str):
+    """Moves partition from the ledger to transactions_archive, its rows aren't copied"""
+    start, end = partition_bounds(name)
+    await database.execute(f'ALTER TABLE public.transactions DETACH PARTITION public.{name}')
+    await database.execute(f"ALTER TABLE public.transactions_archive ATTACH PARTITION public.{name} "
+                           f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+@transaction
+async def export_partition(name: str, directory: str) -> str:
+    """Writes partition to a gzip compressed CSV file and drops it, returns path of the file
+
+    The partition is locked against writes during the export and detached and dropped in the same transaction once
+    the file is on disk. If the export fails the partition stays in the ledger and the partial file is removed.
+    """
+    partition_bounds(name)
+    path = os.path.join(directory, f'{name}.csv.gz')
+    await database.execute(f'LOCK TABLE public.{name} IN SHARE MODE')
+    try:
+        with open(path, 'wb') as file:
+            with gzip.GzipFile(fileobj=file, mode='wb') as compressed:
+                async def write(data: bytes):
+                    compressed.write(data)
+
+                async with database.connection() as connection:
+                    await connection.raw_connection.copy_from_table(name, schema_name='public', output=write,
+                                                                    format='csv', header=True)
+            file.flush()
+            os.fsync(file.fileno())
+        await database.execute(f'ALTER TABLE public.transactions DETACH PARTITION public.{name}')
+        await database.execute(f'DROP TABLE public.{name}')
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path
+
+
+async def main(args):
+    await init_db()
+    for name in await cold_partitions(before=args.before):
+        if args.command == 'archive':
+            await archive_partition(name)
+            logger.info(f'Archived {name}')
+        else:
+            logger.info(f'Exported {name} to {await export_partition(name, args.directory)}')
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['archive', 'export'])
+    parser.add_argument('--before', type=date.fromisoformat, required=True,
+                        help='partitions ending on or before this date are cold')
+    parser.add_argument('--directory', default='.', help='where exported partitions are written')
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,295 @@
+"""Counters, gauges and histograms rendered in the Prometheus text format at /metrics
+
+Metrics are only updated from the event loop thread, so they need no locks. Label values are resolved to a child
+once, hot paths keep the child and update it directly.
+"""
+import asyncio
+import functools
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.main.utils.backend import asyncpg_pool
+
+# Upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY: List['Metric'] = []
+# Called before every render, to set gauges read from elsewhere
+COLLECTORS: List[Callable[[], None]] = []
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    @abstractmethod
+    def _child(self):
+        """New child of a combination of label values"""
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Lines of all children"""
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}',
+                          *self.samples()])
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labelnames, values)} {child.value}'
+                for values, child in list(self._children.items())]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child: '_Histogram'):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # The last one counts observations above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        """Context manager observing duration of its block"""
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self) -> _Histogram:
+        return _Histogram(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames + ("le",), values + (le,))} '
+                             f'{cumulative}')
+            labels = format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {child.sum}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    for collect in COLLECTORS:
+        collect()
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class MetricsServer:
+    """Serves metrics of this process on its own port
+
+    Workers of the launcher share one socket, so /metrics there returns the metrics of whichever worker accepted the
+    connection. Every worker answers any request on its own port with its metrics instead.
+    """
+    def __init__(self):
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> Optional[int]:
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @staticmethod
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Request line and headers, a scrape has no body
+            await reader.readuntil(b'\r\n\r\n')
+            body = render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer()
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time of handling HTTP requests', ('method', 'path'))
+REQUESTS = Counter('http_requests_total', 'Handled HTTP requests', ('method', 'path', 'status'))
+STAGE_SECONDS = Histogram('stage_duration_seconds', 'Time spent in stages of deposits and transfers', ('stage',))
+REJECTIONS = Counter('rejections_total', 'Rejected deposits and transfers', ('reason',))
+RETRIES = Counter('transaction_retries_total', 'Transactions retried after a conflict', ('sqlstate',))
+
+VALIDATION = STAGE_SECONDS.labels('validation')
+POOL_WAIT = STAGE_SECONDS.labels('pool_wait')
+LOCK_WAIT = STAGE_SECONDS.labels('lock_wait')
+INSERT = STAGE_SECONDS.labels('insert')
+UPDATE = STAGE_SECONDS.labels('update')
+EXECUTE = STAGE_SECONDS.labels('execute_transaction')
+COMMIT = STAGE_SECONDS.labels('commit')
+
+# Prefixes of error messages of rejected operations
+REJECTION_REASONS = (
+    ('Not enough money', 'insufficient_funds'),
+    ('Cannot find wallet', 'missing_wallet'),
+    ('Cannot perform operation for the same user', 'same_user'),
+    ('Amount should be positive', 'invalid_amount'),
+    ('Idempotency key', 'idempotency_key_reused'),
+)
+
+
+def rejection_reason(error: Exception) -> str:
+    message = str(error)
+    for prefix, reason in REJECTION_REASONS:
+        if message.startswith(prefix):
+            return reason
+    return 'other'
+
+
+def count_rejections(func):
+    """Counts ValueErrors raised by the decorated operation by reason"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except ValueError as e:
+            REJECTIONS.labels(rejection_reason(e)).inc()
+            raise
+    return wrapper
+
+
+def pool_gauges(database):
+    """Size of the connection pool of the database, connections in use and idle ones, read when rendered"""
+    size = Gauge('db_pool_size', 'Open database connections')
+    idle = Gauge('db_pool_idle', 'Idle database connections')
+    in_use = Gauge('db_pool_in_use', 'Database connections in use')
+    maximum = Gauge('db_pool_max', 'Maximum number of database connections')
+
+    def collect():
+        pool = asyncpg_pool(database)
+        size.set(pool.get_size() if pool else 0)
+        idle.set(pool.get_idle_size() if pool else 0)
+        in_use.set(pool.get_size() - pool.get_idle_size() if pool else 0)
+        maximum.set(pool.get_max_size() if pool else 0)
+
+    COLLECTORS.append(collect)
+
+
+class MetricsMiddleware:
+    """Observes duration of HTTP requests per route, so paths with ids share one series"""
+    def __init__(self, app):
+        self.app = app
+        self._paths: Dict[Callable, str] = {}
+
+    def path(self, scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if endpoint not in self._paths:
+            self._paths = {route.endpoint: route.path for route in scope['app'].routes if hasattr(route, 'endpoint')}
+        return self._paths.get(endpoint, 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            path = self.path(scope)
+            REQUEST_SECONDS.labels(scope['method'], path).observe(time.perf_counter() - start)
+            REQUESTS.labels(scope['method'], path, str(status)).inc()
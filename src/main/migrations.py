@@ -0,0 +1,108 @@
+"""Schema migrations which can't be done by init_db. Run them with the service stopped
+
+Usage: python -m src.main.migrations partition-ledger [--keep-legacy]
+       CURRENCY=USD python -m src.main.migrations money-minor-units
+"""
+import argparse
+import asyncio
+
+from src.main import money
+from src.main.queries import invalidate_queries
+from src.main.settings import database, settings, transaction, init_db
+from src.main.utils.constants import LEDGER_LAYOUT, PARTITIONED, TRANSACTIONS, TRANSACTIONS_DEFAULT_PARTITION, \
+    TRANSACTIONS_ARCHIVE, TRANSACTIONS_WALLET_INDEX, TRANSACTIONS_WALLET_TYPE_INDEX, \
+    CREATE_TRANSACTION_PARTITIONS_FROM, COPY_LEGACY_TRANSACTIONS, SYNC_TRANSACTIONS_ID, MONEY_LAYOUT, MINOR_UNITS, \
+    MONEY_COLUMNS, TABLE_EXISTS, COUNT_INEXACT_AMOUNTS, CONVERT_TO_MINOR_UNITS, DROP_NUMERIC_EXECUTE_TRANSACTION, \
+    EXECUTE_TRANSACTION
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+@transaction
+async def partition_ledger(keep_legacy: bool = False) -> bool:
+    """Replaces single transactions table by the partitioned one, keeping ids of transactions
+
+    Rows are copied, so the whole migration runs in one transaction. The old table is dropped unless keep_legacy,
+    then it stays as transactions_legacy. Returns False if the ledger is already partitioned.
+    """
+    if await database.fetch_val(LEDGER_LAYOUT) == PARTITIONED:
+        return False
+    await database.execute('ALTER TABLE public.transactions RENAME TO transactions_legacy')
+    # Names of the indexes and of the sequence would clash with the ones of the new table
+    await database.execute('ALTER SEQUENCE IF EXISTS public.transactions_id_seq RENAME TO transactions_legacy_id_seq')
+    await database.execute('ALTER INDEX IF EXISTS public.transactions_wallet_idx '
+                           'RENAME TO transactions_legacy_wallet_idx')
+    await database.execute('ALTER INDEX IF EXISTS public.transactions_wallet_type_idx '
+                           'RENAME TO transactions_legacy_wallet_type_idx')
+    await database.execute(TRANSACTIONS.format(money=await database.fetch_val(MONEY_LAYOUT)))
+    await database.execute(TRANSACTIONS_DEFAULT_PARTITION)
+    await database.execute(TRANSACTIONS_ARCHIVE)
+    await database.execute(TRANSACTIONS_WALLET_INDEX)
+    await database.execute(TRANSACTIONS_WALLET_TYPE_INDEX)
+    oldest = await database.fetch_val('SELECT min(transaction_timestamp) FROM public.transactions_legacy')
+    await database.fetch_all(query=CREATE_TRANSACTION_PARTITIONS_FROM,
+                             values={'months_ahead': settings.ledger_partitions_ahead,
+                                     'from_date': oldest.date() if oldest else None})
+    copied = await database.fetch_val(COPY_LEGACY_TRANSACTIONS)
+    await database.execute(SYNC_TRANSACTIONS_ID)
+    if not keep_legacy:
+        await database.execute('DROP TABLE public.transactions_legacy')
+    # Statements prepared for the old table can't be executed anymore
+    async with database.connection() as connection:
+        await connection.raw_connection.reload_schema_state()
+    await invalidate_queries()
+    logger.info(f'Copied {copied} transactions to the partitioned ledger')
+    return True
+
+
+@transaction
+async def money_minor_units() -> bool:
+    """Converts balances and ledger amounts to minor units of settings.currency stored as bigint
+
+    Nothing is converted if any value has more decimal places than the currency or doesn't fit in bigint. Returns
+    False if amounts are already stored as minor units.
+    """
+    if await database.fetch_val(MONEY_LAYOUT) == MINOR_UNITS:
+        return False
+    places = money.scale()
+    if places is None:
+        raise ValueError('Set CURRENCY to convert amounts to its minor units')
+    columns = [(table, column) for table, column in MONEY_COLUMNS
+               if await database.fetch_val(query=TABLE_EXISTS, values={'table': table})]
+    for table, column in columns:
+        inexact = await database.fetch_val(COUNT_INEXACT_AMOUNTS.format(table=table, column=column,
+                                                                        factor=10 ** places))
+        if inexact:
+            raise ValueError(f'{inexact} values of {table}.{column} have more than {places} decimal places '
+                             f'or are out of range')
+    # The function can't change types of its arguments in place
+    await database.execute(DROP_NUMERIC_EXECUTE_TRANSACTION)
+    for table, column in columns:
+        await database.execute(CONVERT_TO_MINOR_UNITS.format(table=table, column=column, factor=10 ** places))
+    await database.execute(EXECUTE_TRANSACTION.format(money=MINOR_UNITS))
+    async with database.connection() as connection:
+        await connection.raw_connection.reload_schema_state()
+    await invalidate_queries()
+    logger.info(f'Converted {len(columns)} columns to minor units of {settings.currency}')
+    return True
+
+
+MIGRATIONS = {'partition-ledger': partition_ledger, 'money-minor-units': money_minor_units}
+
+
+async def main(args):
+    await init_db(check_money_layout=False)
+    options = {'keep_legacy': args.keep_legacy} if args.migration == 'partition-ledger' else {}
+    if await MIGRATIONS[args.migration](**options):
+        logger.info(f'Migration {args.migration} done')
+    else:
+        logger.info(f'Migration {args.migration} was already applied')
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('migration', choices=list(MIGRATIONS))
+    parser.add_argument('--keep-legacy', action='store_true', help='keep the old table as transactions_legacy')
+    asyncio.run(main(args=parser.parse_args()))
@@ -1,9 +1,15 @@
+from datetime import datetime
 from decimal import Decimal, InvalidOperation
 from enum import Enum
-from typing import Optional
+from typing import Optional, Dict, List, Union
 
-from pydantic import BaseModel, validator
-from sqlalchemy import String, Column, Integer, Numeric, DateTime, MetaData, Table
+from pydantic import BaseModel, validator, conlist
+from sqlalchemy import String, Column, Integer, Numeric, DateTime, MetaData, Table, SmallInteger, BigInteger
+from sqlalchemy.types import TypeDecorator
+
+from src.main.metrics import VALIDATION
+from src.main.money import Amount, parse_amount, scale
+from src.main.utils.constants import BATCH_MAX_ITEMS, MAX_WALLET_SLOTS
 
 metadata = MetaData()
 
@@ -23,13 +29,15 @@ class MoneyRequest(BaseModel):
 
     @validator('amount')
     def amount_positive_number(cls, v):
-        try:
-            amount = Decimal(v)
-            if amount <= 0:
-                raise ValueError
-        except (ValueError, InvalidOperation):
-            raise ValueError(f'Amount must be a positive number. Given value {v}')
-        return v
+        """Keeps the parsed amount, so it isn't parsed again"""
+        with VALIDATION.time():
+            try:
+                amount = parse_amount(v)
+            except InvalidOperation:
+                amount = None
+            if amount is None or amount <= 0:
+                raise ValueError(f'Amount must be a positive number. Given value {v}')
+            return Amount(v, amount)
 
 
 class DepositRequest(MoneyRequest):
@@ -46,11 +54,158 @@ class Transaction(BaseModel):
     credit_transaction_id: Optional[int]
 
 
+class BatchMode(str, Enum):
+    all_or_nothing = 'all_or_nothing'
+    best_effort = 'best_effort'
+
+
+class BatchRequest(BaseModel):
+    mode: BatchMode = BatchMode.all_or_nothing
+    items: conlist(Union[TransferRequest, DepositRequest], min_items=1, max_items=BATCH_MAX_ITEMS)
+
+
+class BatchItemStatus(str, Enum):
+    applied = 'applied'
+    rejected = 'rejected'
+    aborted = 'aborted'
+
+
+class BatchItemResult(BaseModel):
+    status: BatchItemStatus
+    transaction: Optional[Transaction]
+    error: Optional[str]
+
+
+class BatchResponse(BaseModel):
+    applied: int
+    results: List[BatchItemResult]
+
+
+class HotWalletRequest(BaseModel):
+    user_id: int
+    slots: int
+
+    @validator('slots')
+    def slots_in_range(cls, v):
+        if not 1 <= v <= MAX_WALLET_SLOTS:
+            raise ValueError(f'Number of slots must be between 1 and {MAX_WALLET_SLOTS}. Given value {v}')
+        return v
+
+
+class HotWalletResponse(HotWalletRequest):
+    wallet_id: int
+
+
+class RetryStatsResponse(BaseModel):
+    retries: Dict[str, int]
+    exhausted: Dict[str, int]
+
+
+class OperationStatus(str, Enum):
+    pending = 'pending'
+    applied = 'applied'
+    rejected = 'rejected'
+
+
+class OperationResponse(BaseModel):
+    operation_id: int
+    status: OperationStatus
+    transaction: Optional[Transaction]
+    error: Optional[str]
+
+
 class TransactionType(str, Enum):
     credit = 'credit'
     debit = 'debit'
 
 
+class BalanceResponse(BaseModel):
+    user_id: int
+    wallet_id: int
+    balance: Decimal
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class TransactionRecord(BaseModel):
+    transaction_id: int
+    type: TransactionType
+    amount: Decimal
+    transaction_timestamp: datetime
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class TransactionPage(BaseModel):
+    items: List[TransactionRecord]
+    next_cursor: Optional[str]
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class OnboardingStatus(str, Enum):
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+class OnboardingJob(BaseModel):
+    job_id: str
+    status: OnboardingStatus
+    records: int
+    error: Optional[str]
+    started_at: datetime
+    updated_at: datetime
+
+
+class WalletMismatch(BaseModel):
+    wallet_id: int
+    mismatch: Decimal
+    verified_at: Optional[datetime]
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class ReconciliationReport(BaseModel):
+    transaction_id: int
+    rows: int
+    wallets: int
+    mismatches: List[WalletMismatch]
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class ReconciliationStatus(BaseModel):
+    transaction_id: int
+    updated_at: datetime
+    mismatches: List[WalletMismatch]
+
+    class Config:
+        json_encoders = {Decimal: str}
+
+
+class MoneyType(TypeDecorator):
+    """numeric column or, with settings.currency set, bigint column of minor units passed as int"""
+    impl = Numeric
+    cache_ok = True
+
+    def __init__(self):
+        super().__init__(asdecimal=True)
+
+    def bind_processor(self, dialect):
+        process = self.impl.dialect_impl(dialect).bind_processor(dialect)
+        return lambda value: value if scale() is not None or process is None else process(value)
+
+    def result_processor(self, dialect, coltype):
+        process = self.impl.dialect_impl(dialect).result_processor(dialect, coltype)
+        return lambda value: value if scale() is not None or process is None else process(value)
+
+
 users = Table(
     'users',
     metadata,
@@ -64,15 +219,39 @@ wallets = Table(
     metadata,
     Column('id', Integer, primary_key=True),
     Column('user_id', Integer),
-    Column('balance', Numeric(asdecimal=True)),
+    Column('balance', MoneyType()),
+    Column('slots', SmallInteger),
+)
+
+wallet_slots = Table(
+    'wallet_slots',
+    metadata,
+    Column('wallet_id', Integer, primary_key=True),
+    Column('slot', SmallInteger, primary_key=True),
+    Column('balance', MoneyType()),
 )
 
 transactions = Table(
     'transactions',
     metadata,
-    Column('id', Integer, primary_key=True),
+    Column('id', BigInteger, primary_key=True),
     Column('wallet_id', Integer),
     Column('type', String),
-    Column('amount', Numeric(asdecimal=True)),
+    Column('amount', MoneyType()),
     Column('transaction_timestamp', DateTime),
 )
+
+operations = Table(
+    'operations',
+    metadata,
+    Column('id', BigInteger, primary_key=True),
+    Column('to_user_id', BigInteger),
+    Column('from_user_id', BigInteger),
+    Column('amount', Numeric(asdecimal=True)),
+    Column('status', String),
+    Column('error', String),
+    Column('debit_transaction_id', BigInteger),
+    Column('credit_transaction_id', BigInteger),
+    Column('accepted_at', DateTime),
+    Column('processed_at', DateTime),
+)
@@ -0,0 +1,66 @@
+"""Amounts of money as Decimals or, with settings.currency set, as integral minor units of the currency (cents)
+
+In the minor units mode amounts are parsed once, when a request is validated, and carried as int. Balances and
+ledger amounts are stored in bigint columns and converted back to decimals only at the JSON boundary.
+"""
+from decimal import Decimal, Context, MAX_PREC, MAX_EMAX, MIN_EMIN
+from typing import Optional, Union
+
+from src.main.settings import settings
+from src.main.utils.constants import CURRENCY_SCALES, MAX_MINOR_UNITS, MINOR_UNITS, NUMERIC
+
+Money = Union[Decimal, int]
+
+# Context which never rounds, scaling an amount by it is exact
+EXACT = Context(prec=MAX_PREC, Emax=MAX_EMAX, Emin=MIN_EMIN)
+
+
+class Amount(str):
+    """Amount as given in a request together with its parsed value, so it isn't parsed again"""
+    def __new__(cls, amount: str, value: Money):
+        self = super().__new__(cls, amount)
+        self.value = value
+        return self
+
+
+def scale() -> Optional[int]:
+    """Number of decimal places of settings.currency, None if amounts are Decimals"""
+    return CURRENCY_SCALES[settings.currency] if settings.currency is not None else None
+
+
+def sql_type() -> str:
+    return NUMERIC if settings.currency is None else MINOR_UNITS
+
+
+def to_minor_units(amount: Decimal, places: int) -> int:
+    """Exact conversion, raises ValueError if amount has more decimal places or doesn't fit in bigint"""
+    # Checked first, so an exponent like 1E+999999 doesn't build a huge integer
+    if amount.adjusted() + places >= len(str(MAX_MINOR_UNITS)):
+        raise ValueError(f'Amount {amount} is out of range')
+    scaled = amount.scaleb(places, EXACT)
+    units = int(scaled)
+    if units != scaled:
+        raise ValueError(f'Amount {amount} has more than {places} decimal places of {settings.currency}')
+    if abs(units) > MAX_MINOR_UNITS:
+        raise ValueError(f'Amount {amount} is out of range')
+    return units
+
+
+def parse_amount(amount: str) -> Money:
+    """Amount as Decimal or, with a currency, as its minor units
+
+    Raises InvalidOperation if amount isn't a number and ValueError if it's out of range or too precise.
+    """
+    value = Decimal(amount)
+    if not value.is_finite():
+        raise ValueError(f'Amount must be a finite number. Given value {amount}')
+    places = scale()
+    return value if places is None else to_minor_units(value, places)
+
+
+def to_decimal(value: Money) -> Decimal:
+    """Amount or balance read from the database (or parsed) as Decimal of the major unit"""
+    places = scale()
+    if places is None:
+        return value
+    return Decimal(int(value)).scaleb(-places)
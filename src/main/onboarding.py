@@ -0,0 +1,272 @@
+"""Bulk onboarding of users from CSV or NDJSON, one record per line (quoted CSV fields may contain line breaks)
+
+Every record creates a user and its wallet, a record with a balance also gets an opening deposit to the ledger.
+Records are loaded in chunks of onboarding_chunk_size: ids are reserved from the sequences at once and rows are
+written to users, wallets and transactions with binary COPY. Each chunk is committed in its own transaction together
+with the progress of its job, so a job which failed is resumed by running it again with the same id and input:
+records already committed are skipped.
+
+Usage: python -m src.main.onboarding users.csv --job-id partner-2024 [--format ndjson] [--output mapping.ndjson]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import time
+from operator import itemgetter
+from decimal import InvalidOperation
+from enum import Enum
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from starlette.responses import StreamingResponse
+
+from src.main.model import OnboardingStatus, TransactionType
+from src.main.money import Money, parse_amount
+from src.main.settings import database, settings, transaction, init_db
+from src.main.utils.constants import RESERVE_IDS, START_ONBOARDING_JOB, ADVANCE_ONBOARDING_JOB, \
+    FINISH_ONBOARDING_JOB, GET_ONBOARDING_JOB, NAME_MAX_LENGTH
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+Record = Tuple[str, str, Optional[Money]]
+
+
+class OnboardingFormat(str, Enum):
+    csv = 'csv'
+    ndjson = 'ndjson'
+
+
+def parse_record(number: int, first_name, last_name, balance) -> Record:
+    """Checks a record like the database would, so a chunk isn't rolled back because of one of its records"""
+    if not first_name or not last_name or not isinstance(first_name, str) or not isinstance(last_name, str):
+        raise ValueError(f'Record {number}: first_name and last_name are required')
+    if len(first_name) > NAME_MAX_LENGTH or len(last_name) > NAME_MAX_LENGTH:
+        raise ValueError(f'Record {number}: first_name and last_name are limited to {NAME_MAX_LENGTH} characters')
+    if balance is None or balance == '':
+        return first_name, last_name, None
+    try:
+        amount = parse_amount(str(balance))
+    except InvalidOperation:
+        amount = None
+    except ValueError as e:
+        raise ValueError(f'Record {number}: {e}')
+    if amount is None or amount < 0:
+        raise ValueError(f'Record {number}: balance must be a non-negative number. Given value {balance}')
+    return first_name, last_name, amount or None
+
+
+class RecordReader:
+    """Parses lines of the input into records, numbered from 1. CSV starts with a header naming the columns
+    first_name, last_name and optionally balance"""
+    def __init__(self, format_: OnboardingFormat):
+        self.format = format_
+        self.records = 0
+        self.columns: Optional[Dict[str, int]] = None
+        self.fields: Optional[Callable[[List[str]], tuple]] = None
+        # Lines of a CSV record whose quoted field goes on in the next line, and the number of quotes in them
+        self._record: List[str] = []
+        self._quotes = 0
+
+    def parse(self, lines: List[bytes]) -> List[Record]:
+        if self.format == OnboardingFormat.csv:
+            return self.parse_csv(row for row in csv.reader(self.csv_records(lines)) if row)
+        text = b'\n'.join(lines).decode()
+        return self.parse_ndjson(line for line in text.split('\n') if line.strip())
+
+    def finish(self) -> List[Record]:
+        """Parses a CSV record left with an unterminated quoted field at the end of the input"""
+        rest, self._record, self._quotes = ''.join(self._record), [], 0
+        return self.parse_csv(row for row in csv.reader([rest]) if row) if rest else []
+
+    def csv_records(self, lines: List[bytes]) -> List[str]:
+        """Joins lines of records with quoted fields containing line breaks. A record isn't complete while its
+        number of quotes is odd, so it's kept until the following lines (of the next chunk, too) close the field"""
+        records = []
+        for line in lines:
+            line = line.decode() + '\n'
+            self._record.append(line)
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                records.append(''.join(self._record))
+                self._record, self._quotes = [], 0
+        return records
+
+    def parse_csv(self, rows: Iterable[List[str]]) -> List[Record]:
+        records = []
+        for row in rows:
+            if self.columns is None:
+                self.columns = {name.strip(): index for index, name in enumerate(row)}
+                if 'first_name' not in self.columns or 'last_name' not in self.columns:
+                    raise ValueError('CSV header has to name columns first_name and last_name')
+                first, last, balance = (self.columns.get(name) for name in ('first_name', 'last_name', 'balance'))
+                self.fields = itemgetter(first, last, balance) if balance is not None else \
+                    (lambda values: (values[first], values[last], None))
+                continue
+            self.records += 1
+            if len(row) != len(self.columns):
+                raise ValueError(f'Record {self.records}: has {len(row)} fields instead of {len(self.columns)}')
+            records.append(parse_record(self.records, *self.fields(row)))
+        return records
+
+    def parse_ndjson(self, lines: Iterable[str]) -> List[Record]:
+        records = []
+        for line in lines:
+            self.records += 1
+            try:
+                # Floats are kept as written, so balances aren't rounded
+                item = json.loads(line, parse_float=str)
+            except ValueError:
+                raise ValueError(f'Record {self.records}: invalid JSON')
+            if not isinstance(item, dict):
+                raise ValueError(f'Record {self.records}: has to be a JSON object')
+            records.append(parse_record(self.records, item.get('first_name'), item.get('last_name'),
+                                        item.get('balance')))
+        return records
+
+
+async def read_records(chunks: AsyncIterator[bytes], format_: OnboardingFormat) -> AsyncIterator[List[Record]]:
+    """Yields records of every received chunk of the input, a line split between chunks is parsed with the next one"""
+    reader = RecordReader(format_)
+    rest = b''
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield reader.parse(lines)
+    if rest.strip():
+        yield reader.parse([rest])
+    records = reader.finish()
+    if records:
+        yield records
+
+
+@transaction
+async def load_chunk(job_id: str, done: int, records: List[Record]) -> List[Tuple[int, int]]:
+    """Copies users, their wallets and opening deposits of records following the first done records of the job,
+    returns their user and wallet ids"""
+    count = len(records)
+    async with database.connection() as connection:
+        raw = connection.raw_connection
+        user_ids = await raw.fetchval(RESERVE_IDS, 'public.users', count)
+        wallet_ids = await raw.fetchval(RESERVE_IDS, 'public.wallets', count)
+        await raw.copy_records_to_table(
+            'users', schema_name='public', columns=('id', 'first_name', 'last_name'),
+            records=[(user_id, first_name, last_name)
+                     for user_id, (first_name, last_name, _) in zip(user_ids, records)])
+        zero = parse_amount('0')
+        await raw.copy_records_to_table(
+            'wallets', schema_name='public', columns=('id', 'user_id', 'balance'),
+            records=[(wallet_id, user_id, balance or zero)
+                     for wallet_id, user_id, (_, _, balance) in zip(wallet_ids, user_ids, records)])
+        deposits = [(wallet_id, TransactionType.debit.value, balance)
+                    for wallet_id, (_, _, balance) in zip(wallet_ids, records) if balance is not None]
+        if deposits:
+            await raw.copy_records_to_table('transactions', schema_name='public',
+                                            columns=('wallet_id', 'type', 'amount'), records=deposits)
+        if await raw.execute(ADVANCE_ONBOARDING_JOB, job_id, done, count) != 'UPDATE 1':
+            raise ValueError(f'Job {job_id} is run concurrently')
+    return list(zip(user_ids, wallet_ids))
+
+
+async def onboard(job_id: str, chunks: AsyncIterator[bytes],
+                  format_: OnboardingFormat = OnboardingFormat.csv) -> AsyncIterator[List[Tuple[int, int, int]]]:
+    """Loads records of the input in chunks, yields number, user id and wallet id of records of every committed chunk
+
+    Records committed by a previous run of the job are skipped, so they aren't yielded again.
+    """
+    done = skip = await database.fetch_val(query=START_ONBOARDING_JOB, values={'job_id': job_id})
+    size = settings.onboarding_chunk_size
+    pending: List[Record] = []
+    try:
+        async for records in read_records(chunks, format_):
+            if skip:
+                skipped = min(skip, len(records))
+                records = records[skipped:]
+                skip -= skipped
+            pending.extend(records)
+            while len(pending) >= size:
+                chunk, pending = pending[:size], pending[size:]
+                ids = await load_chunk(job_id, done, chunk)
+                yield [(done + index, user_id, wallet_id) for index, (user_id, wallet_id) in enumerate(ids, 1)]
+                done += len(chunk)
+        if pending:
+            ids = await load_chunk(job_id, done, pending)
+            yield [(done + index, user_id, wallet_id) for index, (user_id, wallet_id) in enumerate(ids, 1)]
+            done += len(pending)
+    except Exception as e:
+        await finish_job(job_id, OnboardingStatus.failed, error=str(e))
+        logger.error(f'Onboarding job {job_id} failed after {done} records: {e}')
+        raise
+    await finish_job(job_id, OnboardingStatus.done)
+    logger.info(f'Onboarding job {job_id} done, {done} records')
+
+
+async def finish_job(job_id: str, status: OnboardingStatus, error: str = None):
+    await database.execute(query=FINISH_ONBOARDING_JOB, values={'job_id': job_id, 'status': status, 'error': error})
+
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    row = await database.fetch_one(query=GET_ONBOARDING_JOB, values={'job_id': job_id})
+    return dict(row._mapping) if row is not None else None
+
+
+def encode_mapping(ids: List[Tuple[int, int, int]]) -> str:
+    return ''.join(f'{{"record": {number}, "user_id": {user_id}, "wallet_id": {wallet_id}}}\n'
+                   for number, user_id, wallet_id in ids)
+
+
+async def mapping_lines(chunks: AsyncIterator[List[Tuple[int, int, int]]]) -> AsyncIterator[bytes]:
+    """Encodes the mapping as NDJSON. The status code is sent already, so an error is reported as the last line"""
+    try:
+        async for ids in chunks:
+            yield encode_mapping(ids).encode()
+    except ValueError as e:
+        yield (json.dumps({'error': str(e)}) + '\n').encode()
+    except Exception as e:
+        # Database errors, like a lost connection, end the mapping the same way, so it isn't just cut short
+        logger.exception('Onboarding failed while streaming the mapping')
+        yield (json.dumps({'error': f'{type(e).__name__}: {e}'}) + '\n').encode()
+
+
+class UploadStreamingResponse(StreamingResponse):
+    """Streams the response while the request body is still being read
+
+    StreamingResponse listens for the disconnect of the client meanwhile, which would consume messages of the body.
+    """
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def file_chunks(path: str, size: int = 1 << 20) -> AsyncIterator[bytes]:
+    with open(path, 'rb') as file:
+        while chunk := file.read(size):
+            yield chunk
+
+
+async def main(args):
+    await init_db()
+    start = time.perf_counter()
+    records = 0
+    output = open(args.output, 'w') if args.output else None
+    try:
+        async for ids in onboard(args.job_id, file_chunks(args.path), args.format):
+            records += len(ids)
+            if output:
+                output.write(encode_mapping(ids))
+            logger.info(f'Job {args.job_id}: record {ids[-1][0]} committed, '
+                        f'{records / (time.perf_counter() - start):.0f} records/s')
+    finally:
+        if output:
+            output.close()
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--job-id', required=True, help='id of the job, run it again with the same id to resume it')
+    parser.add_argument('--format', type=OnboardingFormat, choices=list(OnboardingFormat), default=OnboardingFormat.csv)
+    parser.add_argument('--output', help='file of the user_id to wallet_id mapping (NDJSON)')
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,135 @@
+"""Statements compiled once and executed as asyncpg prepared statements
+
+`databases` compiles every query it's given, SQLAlchemy Core expressions as well as text, before asyncpg sees it. A
+Query is compiled the same way (so its SQL is the one `databases` would send) only once per money type, by
+compile_queries at startup or when first executed, and is then executed straight on the asyncpg connection of the
+current `databases` connection. asyncpg prepares the statement once per connection and keeps it in its statement
+cache. With COMPILED_QUERIES=N, a database which isn't PostgreSQL or a version of `databases` whose query lock isn't
+known (see src/main/utils/backend.py), queries go through `databases` instead.
+
+After a schema change invalidate_queries forgets compiled statements and replaces pooled connections, so statements
+prepared for the old schema aren't executed anymore.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import databases
+from databases import Database
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import pypostgresql
+from sqlalchemy.sql import ClauseElement
+
+from src.main import money
+from src.main.settings import settings, database
+from src.main.utils.backend import asyncpg_pool, query_lock
+from src.main.utils.constants import YES
+
+QUERIES: List['Query'] = []
+
+# Methods of databases executing queries like the ones of asyncpg connections
+FALLBACK = {'fetch': 'fetch_all', 'fetchrow': 'fetch_one', 'fetchval': 'execute'}
+
+# Dialect of the asyncpg backend of databases, so compiled SQL is the same as the one it sends
+DIALECT = pypostgresql.dialect(paramstyle='pyformat')
+DIALECT.implicit_returning = True
+DIALECT.supports_native_decimal = True
+
+
+class Compiled:
+    __slots__ = ('sql', 'names', 'defaults', 'processors')
+
+    def __init__(self, statement: Union[str, ClauseElement]):
+        compiled = (text(statement) if isinstance(statement, str) else statement).compile(
+            dialect=DIALECT, compile_kwargs={'render_postcompile': True})
+        self.names: Tuple[str, ...] = tuple(sorted(compiled.params))
+        self.sql: str = compiled.string % {name: f'${i}' for i, name in enumerate(self.names, start=1)}
+        # Values of literals of Core expressions, bound as parameters too
+        self.defaults: Dict[str, Any] = compiled.params
+        self.processors: Dict[str, Callable] = {}
+        for bind in compiled.binds.values():
+            processor = bind.type.dialect_impl(DIALECT).bind_processor(DIALECT)
+            if processor is not None:
+                self.processors[bind.key] = processor
+
+    def args(self, values: Dict[str, Any]) -> List[Any]:
+        args = []
+        for name in self.names:
+            value = values[name] if name in values else self.defaults[name]
+            processor = self.processors.get(name)
+            args.append(value if processor is None else processor(value))
+        return args
+
+
+class Query:
+    """SQL text with :named parameters (and an optional {money} placeholder) or a SQLAlchemy Core expression"""
+    def __init__(self, statement: Union[str, ClauseElement]):
+        self.statement = statement
+        self._formatted = isinstance(statement, str) and '{money}' in statement
+        self._compiled: Dict[str, Compiled] = {}
+        QUERIES.append(self)
+
+    def sql(self) -> Union[str, ClauseElement]:
+        """Statement for the current money type"""
+        return self.statement.format(money=money.sql_type()) if self._formatted else self.statement
+
+    def compiled(self) -> Compiled:
+        compiled = self._compiled.get(money.sql_type())
+        if compiled is None:
+            compiled = self._compiled[money.sql_type()] = Compiled(self.sql())
+        return compiled
+
+    def invalidate(self):
+        self._compiled.clear()
+
+
+def compile_queries():
+    """Compiles all queries for the current money type, so requests don't compile them"""
+    for query in QUERIES:
+        query.compiled()
+
+
+async def invalidate_queries(database_: Database = database):
+    """Forgets compiled queries and expires pooled connections, with statements prepared by them"""
+    for query in QUERIES:
+        query.invalidate()
+    pool = asyncpg_pool(database_)
+    if pool is not None:
+        await pool.expire_connections()
+    elif database_.is_connected:
+        # Connections would keep executing statements prepared for the old schema
+        raise RuntimeError(f'Cannot find the connection pool of databases {databases.__version__}, restart the '
+                           f'service to replace its connections')
+
+
+async def run(method: str, query: Query, values: Optional[Dict[str, Any]], database_: Database):
+    if settings.compiled_queries == YES and database_.url.dialect == 'postgresql':
+        async with database_.connection() as connection:
+            lock = query_lock(connection)
+            if lock is not None:
+                compiled = query.compiled()
+                args = compiled.args(values or {})
+                # Queries of tasks sharing a connection (in a transaction or when testing) are serialized like
+                # databases does
+                async with lock:
+                    return await getattr(connection.raw_connection, method)(compiled.sql, *args)
+    statement = query.sql()
+    if isinstance(statement, ClauseElement):
+        # databases treats values of Core expressions as values of an insert
+        statement, values = statement.params(values or {}), None
+    result = await getattr(database_, FALLBACK[method])(query=statement, values=values)
+    # Rows are returned as mappings, like asyncpg records
+    if method == 'fetch':
+        return [row._mapping for row in result]
+    return result._mapping if method == 'fetchrow' and result is not None else result
+
+
+async def fetch_all(query: Query, values: Dict[str, Any] = None, database_: Database = database) -> List:
+    return await run('fetch', query, values, database_)
+
+
+async def fetch_one(query: Query, values: Dict[str, Any] = None, database_: Database = database):
+    return await run('fetchrow', query, values, database_)
+
+
+async def execute(query: Query, values: Dict[str, Any] = None, database_: Database = database) -> Any:
+    """First column of the first row returned, like databases returns it"""
+    return await run('fetchval', query, values, database_)
@@ -0,0 +1,212 @@
+"""Incremental reconciliation of wallet balances with the ledger
+
+The ledger is replayed into checkpoints of wallets (debits minus credits and the last ledger row taken into account)
+in batches of reconciliation_batch_size ids, pausing reconciliation_pause seconds between batches. A pass reads only
+rows added since the previous one. Balances of wallets replayed by the pass are then compared with their checkpoints
+and differences are stored as mismatches. Repairing a wallet sets its balance to the one of the ledger; after a reset
+the next pass replays the whole ledger again.
+
+Usage: python -m src.main.reconciliation run [--full]
+       python -m src.main.reconciliation repair [--wallet-ids 1 2 3]
+       python -m src.main.reconciliation reset
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from src.main import money
+from src.main.metrics import Counter, Gauge
+from src.main.model import ReconciliationReport, ReconciliationStatus, WalletMismatch
+from src.main.money import to_decimal
+from src.main.retry import retry_on_conflict
+from src.main.settings import database, settings, transaction, spawn, init_db
+from src.main.utils.constants import LEDGER_HORIZON, TRANSACTIONS_IN_PROGRESS, CLEAR_STATS_SNAPSHOT, \
+    GET_RECONCILIATION_STATE, SHARE_RECONCILIATION_STATE, LOCK_RECONCILIATION_STATE, REPLAY_LEDGER, LEDGER_ROWS, \
+    LEDGER_WITH_ARCHIVE_ROWS, TABLE_EXISTS, VERIFY_CHECKPOINTS, WALLET_MISMATCHES, LOCK_WALLETS, LOCK_SLOTS, \
+    LEDGER_BALANCES, REPAIR_BALANCES, CLEAR_MISMATCHES, RESET_CHECKPOINTS, RESET_RECONCILIATION_STATE
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+REPLAYED_ROWS = Counter('reconciliation_replayed_rows_total', 'Ledger rows replayed into checkpoints of wallets')
+MISMATCHED_WALLETS = Gauge('reconciliation_mismatched_wallets', 'Wallets whose balance differs from the ledger')
+
+
+class Reconciler:
+    """Reconciles wallets with the ledger, periodically"""
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if settings.reconciliation_interval > 0:
+            self._task = spawn(self._work())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(settings.reconciliation_interval)
+            try:
+                await reconcile()
+            except Exception:
+                logger.exception('Cannot reconcile wallets with the ledger')
+
+
+reconciler = Reconciler()
+
+
+def mismatch(row) -> WalletMismatch:
+    return WalletMismatch(wallet_id=row['wallet_id'], mismatch=to_decimal(row['mismatch']),
+                          verified_at=row['verified_at'])
+
+
+async def ledger_horizon(reconciled: int = 0) -> int:
+    """Id of the last ledger row, returned once transactions which may still insert rows with lower ids finished
+
+    Ids are assigned when rows are inserted, not when they are committed, so a transaction started earlier may commit
+    a row with a lower id later. Only transactions writing to the ledger are waited for, readers like statement exports
+    aren't. If they don't finish within reconciliation_horizon_timeout, reconciled (the id reconciled so far) is
+    returned, so the pass verifies wallets without replaying new rows.
+    """
+    row = await database.fetch_one(LEDGER_HORIZON)
+    deadline = time.monotonic() + settings.reconciliation_horizon_timeout
+    while True:
+        await database.execute(CLEAR_STATS_SNAPSHOT)
+        if not await database.fetch_val(query=TRANSACTIONS_IN_PROGRESS, values={'since': row['read_at']}):
+            return row['transaction_id']
+        if time.monotonic() >= deadline:
+            logger.warning(f'Ledger writes started before {row["read_at"]} are still in progress, '
+                           f'rows after {reconciled} are left for the next pass')
+            return reconciled
+        await asyncio.sleep(0.01)
+
+
+async def replay(low: int, high: int, ledger: str) -> int:
+    """Adds ledger rows with ids in (low, high] to checkpoints, returns their number"""
+    row = await database.fetch_one(query=REPLAY_LEDGER.format(ledger=ledger), values={'low': low, 'high': high})
+    if not row['moved']:
+        raise ValueError('Ledger is replayed by a concurrent reconciliation')
+    REPLAYED_ROWS.inc(row['rows'])
+    return row['rows']
+
+
+@transaction
+async def verify_batch(after: int, horizon: int) -> List:
+    await database.execute(SHARE_RECONCILIATION_STATE)
+    return await database.fetch_all(query=VERIFY_CHECKPOINTS, values={
+        'after': after, 'horizon': horizon, 'limit': settings.reconciliation_batch_size})
+
+
+async def verify(after: int, horizon: int) -> Tuple[int, List[int]]:
+    """Compares balances of wallets with checkpoints replayed in (after, horizon], returns their number and ids of
+    mismatched ones"""
+    verified = 0
+    mismatched = []
+    while True:
+        rows = await verify_batch(after, horizon)
+        if not rows:
+            return verified, mismatched
+        verified += len(rows)
+        mismatched.extend(row['wallet_id'] for row in rows if row['mismatch'] is not None)
+        after = max(row['transaction_id'] for row in rows)
+        await asyncio.sleep(settings.reconciliation_pause)
+
+
+async def reconcile(full: bool = False) -> ReconciliationReport:
+    """Replays ledger rows added since the previous pass and verifies balances of wallets they belong to, or of all
+    wallets with a checkpoint if full"""
+    replayed = start = await database.fetch_val(GET_RECONCILIATION_STATE)
+    horizon = await ledger_horizon(reconciled=start)
+    archived = await database.fetch_val(query=TABLE_EXISTS, values={'table': 'transactions_archive'})
+    ledger = LEDGER_WITH_ARCHIVE_ROWS if archived else LEDGER_ROWS
+    rows = 0
+    while replayed < horizon:
+        high = min(replayed + settings.reconciliation_batch_size, horizon)
+        rows += await replay(replayed, high, ledger)
+        replayed = high
+        await asyncio.sleep(settings.reconciliation_pause)
+    verified, mismatched = await verify(0 if full else start, horizon)
+    mismatches = await get_mismatches()
+    MISMATCHED_WALLETS.set(len(mismatches))
+    mismatched = set(mismatched)
+    found = [item for item in mismatches if item.wallet_id in mismatched]
+    for item in found:
+        logger.warning(f'Balance of wallet {item.wallet_id} differs from the ledger by {item.mismatch}')
+    logger.info(f'Reconciled {rows} ledger rows up to {horizon}, verified {verified} wallets, '
+                f'{len(found)} mismatched')
+    return ReconciliationReport(transaction_id=max(horizon, start), rows=rows, wallets=verified, mismatches=found)
+
+
+async def get_mismatches() -> List[WalletMismatch]:
+    return [mismatch(row) for row in await database.fetch_all(WALLET_MISMATCHES)]
+
+
+async def get_status() -> ReconciliationStatus:
+    state = await database.fetch_one(GET_RECONCILIATION_STATE)
+    return ReconciliationStatus(transaction_id=state['transaction_id'], updated_at=state['updated_at'],
+                                mismatches=await get_mismatches())
+
+
+@retry_on_conflict
+@transaction
+async def repair(wallet_ids: List[int]) -> List[WalletMismatch]:
+    """Sets balances of wallets to the ones of the ledger, returns previous differences of changed ones
+
+    Wallets and their slots are locked first, so the ledger can't change under them.
+    """
+    wallet_ids = sorted(wallet_ids)
+    await database.fetch_all(query=LOCK_WALLETS, values={'wallet_ids': wallet_ids})
+    await database.fetch_all(query=LOCK_SLOTS, values={'wallet_ids': wallet_ids})
+    replayed = await database.fetch_val(LOCK_RECONCILIATION_STATE)
+    rows = await database.fetch_all(query=LEDGER_BALANCES, values={'replayed': replayed, 'wallet_ids': wallet_ids})
+    balances = {row['wallet_id']: row['balance'] for row in rows}
+    current = {row['wallet_id']: row['current'] for row in rows}
+    changed = [wallet_id for wallet_id in balances if current[wallet_id] != balances[wallet_id]]
+    if changed:
+        as_money = (lambda value: value) if money.scale() is None else int
+        await database.execute(query=REPAIR_BALANCES.format(money=money.sql_type()), values={
+            'wallet_ids': changed, 'balances': [as_money(balances[wallet_id]) for wallet_id in changed]})
+    await database.execute(query=CLEAR_MISMATCHES, values={'wallet_ids': wallet_ids})
+    return [WalletMismatch(wallet_id=wallet_id, mismatch=to_decimal(current[wallet_id] - balances[wallet_id]),
+                           verified_at=None) for wallet_id in changed]
+
+
+@transaction
+async def reset():
+    """Removes checkpoints, so the next pass replays the whole ledger"""
+    await database.execute(LOCK_RECONCILIATION_STATE)
+    await database.execute(RESET_CHECKPOINTS)
+    await database.execute(RESET_RECONCILIATION_STATE)
+
+
+async def main(args):
+    await init_db()
+    try:
+        if args.command == 'run':
+            # The report is the output of the command, logs go to stderr
+            sys.stdout.write((await reconcile(full=args.full)).json() + '\n')
+        elif args.command == 'repair':
+            wallet_ids = args.wallet_ids or [item.wallet_id for item in await get_mismatches()]
+            size = settings.reconciliation_batch_size
+            for start in range(0, len(wallet_ids), size):
+                for item in await repair(wallet_ids[start:start + size]):
+                    logger.info(f'Repaired wallet {item.wallet_id}, its balance differed by {item.mismatch}')
+        else:
+            await reset()
+            logger.info('Checkpoints removed, the next pass replays the whole ledger')
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['run', 'repair', 'reset'])
+    parser.add_argument('--full', action='store_true', help='verify all wallets, not only the ones with new rows')
+    parser.add_argument('--wallet-ids', type=int, nargs='+', help='wallets to repair, mismatched ones by default')
+    asyncio.run(main(args=parser.parse_args()))
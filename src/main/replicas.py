@@ -0,0 +1,184 @@
+"""Routing of reads to streaming replicas
+
+Reads go to a replica lagging at most replica_max_lag seconds, picked round-robin, or to the primary if there is no
+such replica. A read asking for a WAL position (read-your-writes) waits up to replica_wait_timeout for a replica which
+replayed it, then falls back to the primary. Reads in a transaction always go to the primary.
+"""
+import asyncio
+import contextvars
+import time
+from typing import List, Optional, Union
+
+from databases import Database
+from starlette.status import HTTP_202_ACCEPTED
+
+from src.main.metrics import Counter
+from src.main.settings import settings, database, in_transaction, spawn
+from src.main.utils.constants import REPLICA_STATUS, CURRENT_LSN, PRIMARY, LSN_HEADER, MIN_LSN_HEADER, \
+    READ_FROM_HEADER, ONBOARD_USERS
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+# Writes whose response starts before anything is committed, streamed while the rows are written
+STREAMED_WRITES = (ONBOARD_USERS,)
+
+REPLICA_READS = Counter('replica_reads_total', 'Reads by the database serving them', ('target',))
+
+# PRIMARY, a WAL position the replica has to replay before serving reads of the request, or None for any replica
+_consistency: contextvars.ContextVar[Union[str, int, None]] = contextvars.ContextVar('read_consistency',
+                                                                                     default=None)
+
+
+def parse_lsn(lsn: str) -> int:
+    """WAL position like 16/B374D848 as a number"""
+    try:
+        high, low = lsn.split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except ValueError:
+        raise ValueError(f'Invalid LSN {lsn}')
+
+
+class Replica:
+    def __init__(self, database_: Database, name: str):
+        self.database = database_
+        self.name = name
+        self.replay_lsn: Optional[int] = None
+        self.lag: Optional[float] = None
+
+    @property
+    def fresh(self) -> bool:
+        return self.lag is not None and self.lag <= settings.replica_max_lag
+
+    async def refresh(self):
+        """Reads replayed WAL position and lag, a replica which can't be reached or isn't a replica isn't fresh"""
+        try:
+            row = await self.database.fetch_one(REPLICA_STATUS)
+        except Exception:
+            logger.exception(f'Cannot check replica {self.name}')
+            self.lag = None
+            return
+        self.replay_lsn = parse_lsn(row['lsn']) if row['lsn'] is not None else None
+        self.lag = float(row['lag']) if row['lag'] is not None else None
+
+
+class ReadRouter:
+    """Replicas of settings.replica_urls, each with its own pool, checked every replica_check_interval seconds"""
+    def __init__(self):
+        self.replicas: List[Replica] = []
+        self._next = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        for url in settings.replica_urls:
+            replica = Replica(Database(url, min_size=settings.replica_pool_min, max_size=settings.replica_pool_max),
+                              name=url.host)
+            await replica.database.connect()
+            await replica.refresh()
+            self.replicas.append(replica)
+        if self.replicas and settings.replica_check_interval > 0:
+            self._task = spawn(self._work())
+
+    async def disconnect(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for replica in self.replicas:
+            await replica.database.disconnect()
+        self.replicas = []
+
+    async def _work(self):
+        while True:
+            await asyncio.sleep(settings.replica_check_interval)
+            for replica in self.replicas:
+                await replica.refresh()
+
+    def pick(self) -> Optional[Replica]:
+        fresh = [replica for replica in self.replicas if replica.fresh]
+        if not fresh:
+            return None
+        self._next += 1
+        return fresh[self._next % len(fresh)]
+
+    async def database_for(self, min_lsn: int = None) -> Database:
+        """Database serving a read which has to see writes up to min_lsn"""
+        replica = self.pick()
+        if replica is not None and min_lsn is not None:
+            caught_up = [replica for replica in self.replicas
+                         if replica.fresh and replica.replay_lsn is not None and replica.replay_lsn >= min_lsn]
+            replica = caught_up[0] if caught_up else await self.wait_for(replica, min_lsn)
+        if replica is None:
+            REPLICA_READS.labels(PRIMARY).inc()
+            return database
+        REPLICA_READS.labels(replica.name).inc()
+        return replica.database
+
+    @staticmethod
+    async def wait_for(replica: Replica, min_lsn: int) -> Optional[Replica]:
+        """The replica once it replayed min_lsn, None if it didn't within replica_wait_timeout"""
+        deadline = time.monotonic() + settings.replica_wait_timeout
+        while True:
+            await replica.refresh()
+            if replica.replay_lsn is not None and replica.replay_lsn >= min_lsn:
+                return replica
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.005)
+
+
+read_router = ReadRouter()
+
+
+async def read_database() -> Database:
+    """Database serving reads of the current request"""
+    if not read_router.replicas or in_transaction():
+        return database
+    consistency = _consistency.get()
+    if consistency == PRIMARY:
+        REPLICA_READS.labels(PRIMARY).inc()
+        return database
+    return await read_router.database_for(min_lsn=consistency)
+
+
+async def current_lsn() -> str:
+    """WAL position of the primary, a replica which replayed it sees all writes committed before"""
+    return await database.fetch_val(CURRENT_LSN)
+
+
+class ReplicaMiddleware:
+    """Reads X-Read-From: primary and X-Min-LSN of requests; adds X-LSN to responses of committed writes
+
+    A 202 of the write-behind queue and responses of STREAMED_WRITES get no X-LSN: their writes aren't committed when
+    the response starts, so no position taken then would show them.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not read_router.replicas:
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        consistency = None
+        if headers.get(READ_FROM_HEADER.encode(), b'').decode().lower() == PRIMARY:
+            consistency = PRIMARY
+        elif MIN_LSN_HEADER.encode() in headers:
+            try:
+                consistency = parse_lsn(headers[MIN_LSN_HEADER.encode()].decode())
+            except ValueError:
+                # An invalid token can't be honoured by a replica
+                consistency = PRIMARY
+        token = _consistency.set(consistency)
+        write = scope['method'] not in ('GET', 'HEAD', 'OPTIONS') and scope['path'] not in STREAMED_WRITES
+
+        async def send_lsn(message):
+            if write and message['type'] == 'http.response.start' and message['status'] < 300 \
+                    and message['status'] != HTTP_202_ACCEPTED:
+                lsn = await current_lsn()
+                message = {**message, 'headers': [*message.get('headers', []), (LSN_HEADER.encode(), lsn.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_lsn)
+        finally:
+            _consistency.reset(token)
@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import random
+from collections import Counter
+from typing import Dict
+
+from asyncpg import PostgresError
+
+from src.main.metrics import REJECTIONS, RETRIES
+from src.main.settings import settings
+from src.main.utils.constants import RETRYABLE_SQLSTATES, DEADLOCK_DETECTED, SERIALIZATION_FAILURE
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+class RetryStats:
+    """Counters of retried and finally failed transactions per SQLSTATE"""
+    def __init__(self):
+        self.retries = Counter()
+        self.exhausted = Counter()
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        return {'retries': dict(self.retries), 'exhausted': dict(self.exhausted)}
+
+    def reset(self):
+        self.retries.clear()
+        self.exhausted.clear()
+
+
+retry_stats = RetryStats()
+
+# Rejection reasons of transactions which failed after all retries
+CONFLICT_REASONS = {DEADLOCK_DETECTED: 'deadlock', SERIALIZATION_FAILURE: 'serialization_failure'}
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(settings.retry_backoff_max, settings.retry_backoff_base * 2 ** (attempt - 1)))
+
+
+def retry_on_conflict(func):
+    """Retries the decorated transaction after deadlock or serialization failure
+
+    It has to wrap the whole transaction since the failed one is rolled back
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        attempt = 1
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except PostgresError as e:
+                if e.sqlstate not in RETRYABLE_SQLSTATES:
+                    raise
+                if attempt >= settings.retry_attempts:
+                    retry_stats.exhausted[e.sqlstate] += 1
+                    REJECTIONS.labels(CONFLICT_REASONS[e.sqlstate]).inc()
+                    logger.warning(f'{func.__name__} failed after {attempt} attempts: {e}')
+                    raise
+                retry_stats.retries[e.sqlstate] += 1
+                RETRIES.labels(e.sqlstate).inc()
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+    return wrapper
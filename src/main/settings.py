@@ -1,8 +1,22 @@
+import asyncio
+import contextvars
+import functools
+import time
+from typing import Optional, List, Tuple, Dict
+
 from databases import Database
-from pydantic import BaseSettings, PostgresDsn
+from pydantic import BaseSettings, PostgresDsn, validator
 
-from src.main.utils.constants import DATABASE_URL, APP_TITLE, YES, NO, USERS, TRANSACTIONS, WALLETS
-from src.main.utils.logger import get_console_logger
+from src.main.metrics import POOL_WAIT, COMMIT, pool_gauges
+from src.main.utils.constants import DATABASE_URL, APP_TITLE, YES, NO, USERS, TRANSACTIONS, WALLETS, \
+    EXECUTE_TRANSACTION, WALLETS_SLOTS, WALLET_SLOTS, OPERATIONS, OPERATIONS_PENDING_INDEX, TRANSACTIONS_WALLET_INDEX, \
+    TRANSACTIONS_WALLET_TYPE_INDEX, TRANSACTIONS_DEFAULT_PARTITION, TRANSACTIONS_ARCHIVE, \
+    ENSURE_TRANSACTION_PARTITIONS, LEDGER_LAYOUT, PARTITIONED, CREATE_TRANSACTION_PARTITIONS, POSTGRES, \
+    IDEMPOTENCY_KEYS, IDEMPOTENCY_KEYS_CREATED_INDEX, ONBOARDING_JOBS, WALLET_CHECKPOINTS, \
+    WALLET_CHECKPOINTS_TRANSACTION_INDEX, WALLET_CHECKPOINTS_MISMATCH_INDEX, RECONCILIATION_STATE, \
+    INIT_RECONCILIATION_STATE, MONEY_LAYOUT, NUMERIC, MINOR_UNITS, CURRENCY_SCALES, WALLET_STATEMENT, TRANSFERS_BATCH, \
+    ONBOARD_USERS
+from src.main.utils.logger import get_console_logger, configure_logging, TEXT, JSON
 
 logger = get_console_logger(name=__name__)
 
@@ -14,6 +28,80 @@ class Settings(BaseSettings):
     DATABASE_URL: PostgresDsn = DATABASE_URL
     pool_min: int = 5
     pool_max: int = 25
+    workers: int = 1
+    db_connections: int = 80
+    run_migrations: str = YES
+    warm_up: str = YES
+    background_tasks: str = YES
+    graceful_timeout: float = 30
+    replica_urls: List[PostgresDsn] = []
+    replica_pool_min: int = 1
+    replica_pool_max: int = 10
+    replica_max_lag: float = 1
+    replica_check_interval: float = 0.5
+    replica_wait_timeout: float = 0.2
+    single_statement: str = NO
+    compiled_queries: str = YES
+    fast_path: str = NO
+    retry_attempts: int = 5
+    retry_backoff_base: float = 0.005
+    retry_backoff_max: float = 0.1
+    # /queue/* routes reject operations with 503 unless there are workers applying them
+    write_behind_workers: int = 0
+    write_behind_batch_size: int = 100
+    write_behind_poll_interval: float = 0.05
+    write_behind_append_window_ms: float = 2
+    write_behind_append_max_items: int = 500
+    coalesce_window_ms: float = 0
+    coalesce_max_items: int = 500
+    statement_fetch_size: int = 1000
+    onboarding_chunk_size: int = 10000
+    reconciliation_interval: float = 600
+    reconciliation_batch_size: int = 10000
+    reconciliation_pause: float = 0.01
+    reconciliation_horizon_timeout: float = 30
+    admission: str = YES
+    # Defaults to pool_max
+    admission_concurrency: Optional[int] = None
+    admission_queue_size: int = 50
+    admission_queue_timeout: float = 0.3
+    admission_endpoint_limits: Dict[str, int] = {WALLET_STATEMENT: 4, TRANSFERS_BATCH: 4, ONBOARD_USERS: 2}
+    admission_target_latency: float = 0
+    admission_min_concurrency: int = 2
+    admission_decrease: float = 0.8
+    ledger_partitions_ahead: int = 3
+    ledger_maintenance_interval: float = 3600
+    storage_engine: str = POSTGRES
+    memory_data_dir: Optional[str] = None
+    memory_snapshot_every: int = 0
+    metrics: str = YES
+    metrics_host: str = '127.0.0.1'
+    metrics_port: Optional[int] = None
+    log_level: str = 'INFO'
+    # Levels of single loggers by name, like {"src.main.crud": "DEBUG"}
+    log_levels: Dict[str, str] = {}
+    log_format: str = TEXT
+    log_sample_first: int = 0
+    log_sample_every: int = 100
+    wallet_id_cache_size: int = 100000
+    idempotency_key_ttl: float = 86400
+    idempotency_cache_size: int = 10000
+    idempotency_cache_ttl: float = 300
+    idempotency_expiry_interval: float = 60
+    idempotency_expiry_batch_size: int = 1000
+    currency: Optional[str] = None
+
+    @validator('log_format')
+    def known_log_format(cls, v):
+        if v not in (TEXT, JSON):
+            raise ValueError(f'Unknown log format {v}. Known ones are {TEXT}, {JSON}')
+        return v
+
+    @validator('currency')
+    def known_currency(cls, v):
+        if v is not None and v not in CURRENCY_SCALES:
+            raise ValueError(f'Unknown currency {v}. Known ones are {", ".join(CURRENCY_SCALES)}')
+        return v
 
 
 class AsyncDatabase:
@@ -30,12 +118,122 @@ class AsyncDatabase:
 
 
 settings = Settings()
+configure_logging(level=settings.log_level, levels=settings.log_levels, format_=settings.log_format,
+                  sample_first=settings.log_sample_first, sample_every=settings.log_sample_every)
 database = AsyncDatabase(settings=settings).database
+pool_gauges(database)
+
+
+_in_transaction = contextvars.ContextVar('in_transaction', default=False)
+
+
+def transaction(func):
+    """Runs the decorated coroutine in a database transaction (a savepoint when nested)
+
+    `@database.transaction()` shares one `Transaction` object between concurrent calls and may open a root
+    transaction on a different connection than the one the queries inside it use. Here a new transaction is
+    started per call on the connection of the current task.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _in_transaction.get():
+            async with database.connection() as connection:
+                async with connection.transaction():
+                    return await func(*args, **kwargs)
+        # Waiting for a pooled connection and commit are observed for outermost transactions only
+        start = time.perf_counter()
+        async with database.connection() as connection:
+            POOL_WAIT.observe(time.perf_counter() - start)
+            token = _in_transaction.set(True)
+            try:
+                async with connection.transaction():
+                    result = await func(*args, **kwargs)
+                    start = time.perf_counter()
+                COMMIT.observe(time.perf_counter() - start)
+                return result
+            finally:
+                _in_transaction.reset(token)
+    return wrapper
+
+
+def in_transaction() -> bool:
+    """Whether the current task runs in a transaction started by the transaction decorator"""
+    return _in_transaction.get()
 
 
-async def init_db():
-    """Initialises connection and creates tables if they don't exist"""
+def spawn(coro) -> asyncio.Task:
+    """Starts a task with an empty context so it acquires its own pooled connection
+
+    `databases` keeps the current connection in a context variable, which child tasks would otherwise inherit.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+async def warm_up_pool(connections: int, statements: List[Tuple[str, dict]]):
+    """Opens connections of the pool and executes statements on each of them, so they are prepared and cached by
+    the connections before the first request"""
+    warmed = 0
+    all_warmed = asyncio.Event()
+
+    async def warm_up():
+        nonlocal warmed
+        async with database.connection() as connection:
+            for query, values in statements:
+                await connection.execute(query=query, values=values)
+            warmed += 1
+            if warmed == connections:
+                all_warmed.set()
+            # Connections are held until all of them are warm, otherwise the same one would be warmed again
+            await all_warmed.wait()
+
+    await asyncio.gather(*(spawn(warm_up()) for _ in range(connections)))
+
+
+async def init_db(check_money_layout: bool = True):
+    """Initialises connection and, unless settings.run_migrations is NO, creates tables if they don't exist
+
+    Unless check_money_layout is False, fails if amounts are stored differently than settings.currency requires.
+    """
     await database.connect()
+    if settings.run_migrations == YES:
+        await create_schema()
+    layout = await database.fetch_val(MONEY_LAYOUT)
+    money = NUMERIC if settings.currency is None else MINOR_UNITS
+    if check_money_layout and layout != money:
+        if layout == NUMERIC:
+            raise ValueError(f'Amounts are stored as decimals, run python -m src.main.migrations money-minor-units '
+                             f'to store them as minor units of {settings.currency}')
+        raise ValueError('Amounts are stored as minor units, set CURRENCY to their currency')
+
+
+async def create_schema():
+    """Creates tables, indexes and functions if they don't exist. New tables store amounts as minor units if
+    settings.currency is set"""
+    money = NUMERIC if settings.currency is None else MINOR_UNITS
     await database.execute(USERS)
-    await database.execute(WALLETS)
-    await database.execute(TRANSACTIONS)
+    await database.execute(WALLETS.format(money=money))
+    await database.execute(WALLETS_SLOTS)
+    await database.execute(WALLET_SLOTS.format(money=money))
+    await database.execute(TRANSACTIONS.format(money=money))
+    if await database.fetch_val(LEDGER_LAYOUT) == PARTITIONED:
+        await database.execute(TRANSACTIONS_DEFAULT_PARTITION)
+        await database.execute(TRANSACTIONS_ARCHIVE)
+    else:
+        logger.warning('Table transactions is not partitioned, run python -m src.main.migrations partition-ledger')
+    await database.execute(TRANSACTIONS_WALLET_INDEX)
+    await database.execute(TRANSACTIONS_WALLET_TYPE_INDEX)
+    await database.execute(OPERATIONS)
+    await database.execute(OPERATIONS_PENDING_INDEX)
+    await database.execute(IDEMPOTENCY_KEYS)
+    await database.execute(IDEMPOTENCY_KEYS_CREATED_INDEX)
+    await database.execute(ONBOARDING_JOBS)
+    await database.execute(WALLET_CHECKPOINTS.format(money=money))
+    await database.execute(WALLET_CHECKPOINTS_TRANSACTION_INDEX)
+    await database.execute(WALLET_CHECKPOINTS_MISMATCH_INDEX)
+    await database.execute(RECONCILIATION_STATE)
+    await database.execute(INIT_RECONCILIATION_STATE)
+    layout = await database.fetch_val(MONEY_LAYOUT)
+    await database.execute(EXECUTE_TRANSACTION.format(money=layout))
+    await database.execute(ENSURE_TRANSACTION_PARTITIONS)
+    await database.fetch_all(query=CREATE_TRANSACTION_PARTITIONS,
+                             values={'months_ahead': settings.ledger_partitions_ahead})
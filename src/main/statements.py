@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from enum import Enum
+from typing import AsyncIterator, List
+
+from src.main import money
+from src.main.crud import naive_utc
+from src.main.replicas import read_database
+from src.main.settings import settings
+from src.main.utils.constants import STATEMENT_ROWS
+
+
+class StatementFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+MEDIA_TYPES = {StatementFormat.ndjson: 'application/x-ndjson', StatementFormat.csv: 'text/csv'}
+COLUMNS = ['transaction_id', 'type', 'amount', 'transaction_timestamp']
+
+
+def encode_rows(rows: List[tuple], format_: StatementFormat) -> bytes:
+    if money.scale() is not None:
+        rows = [(row[0], row[1], money.to_decimal(row[2]), row[3]) for row in rows]
+    if format_ == StatementFormat.csv:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return buffer.getvalue().encode()
+    return ''.join(json.dumps({'transaction_id': row[0], 'type': row[1], 'amount': str(row[2]),
+                               'transaction_timestamp': row[3].isoformat()}) + '\n' for row in rows).encode()
+
+
+async def statement_rows(wallet_id: int, since: datetime = None, until: datetime = None) -> AsyncIterator[List[tuple]]:
+    """Yields ledger rows of the wallet, oldest first, in batches of statement_fetch_size
+
+    Rows are read with a server-side cursor, so only one batch is held in memory. `database.iterate` doesn't allow
+    to set the batch size, hence the asyncpg cursor of the pooled connection is used directly.
+    """
+    conditions, args = ['wallet_id = $1'], [wallet_id]
+    if since is not None:
+        args.append(naive_utc(since))
+        conditions.append(f'transaction_timestamp >= ${len(args)}')
+    if until is not None:
+        args.append(naive_utc(until))
+        conditions.append(f'transaction_timestamp < ${len(args)}')
+    query = STATEMENT_ROWS.format(conditions=' AND '.join(conditions))
+    async with (await read_database()).connection() as connection:
+        async with connection.transaction():
+            rows = []
+            cursor = connection.raw_connection.cursor(query, *args, prefetch=settings.statement_fetch_size)
+            async for row in cursor:
+                rows.append(tuple(row))
+                if len(rows) == settings.statement_fetch_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+
+
+async def statement_chunks(wallet_id: int, format_: StatementFormat = StatementFormat.ndjson, gzip: bool = False,
+                           since: datetime = None, until: datetime = None) -> AsyncIterator[bytes]:
+    """Yields encoded (and optionally gzip compressed) statement, one chunk per fetched batch"""
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+    if format_ == StatementFormat.csv:
+        chunk = ','.join(COLUMNS).encode() + b'\n'
+        yield compressor.compress(chunk) if compressor else chunk
+    async for rows in statement_rows(wallet_id=wallet_id, since=since, until=until):
+        chunk = encode_rows(rows, format_)
+        if compressor:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,37 @@
+"""Internals of `databases` the service relies on
+
+`databases` exposes neither the asyncpg pool of a Database nor the lock it holds around queries of a shared
+connection. They are read here and nowhere else, and only with versions of `databases` listed in DATABASES_VERSIONS;
+with other ones both functions return None.
+"""
+import asyncio
+from typing import Optional
+
+import databases
+from asyncpg.pool import Pool
+from databases import Database
+from databases.core import Connection
+
+# Versions known to keep the pool in Database._backend._pool and to serialize queries of a connection with
+# Connection._query_lock
+DATABASES_VERSIONS = ('0.5.',)
+
+
+def known_version() -> bool:
+    return databases.__version__.startswith(DATABASES_VERSIONS)
+
+
+def asyncpg_pool(database: Database) -> Optional[Pool]:
+    """asyncpg pool of the database, None until it's connected"""
+    if not known_version():
+        return None
+    pool = getattr(getattr(database, '_backend', None), '_pool', None)
+    return pool if isinstance(pool, Pool) else None
+
+
+def query_lock(connection: Connection) -> Optional[asyncio.Lock]:
+    """Lock databases takes around queries of the connection"""
+    if not known_version():
+        return None
+    lock = getattr(connection, '_query_lock', None)
+    return lock if isinstance(lock, asyncio.Lock) else None
@@ -9,6 +9,29 @@ CREATE_USER = '/create_user/'
 DEPOSIT_MONEY = '/deposit_money/'
 TRANSFER_MONEY = '/transfer_money/'
 
+RETRY_STATS = '/retry_stats/'
+TRANSFERS_BATCH = '/transfers/batch'
+HOT_WALLET = '/hot_wallet/'
+QUEUE_DEPOSIT_MONEY = '/queue/deposit_money/'
+QUEUE_TRANSFER_MONEY = '/queue/transfer_money/'
+OPERATION = '/operations/{operation_id}'
+WALLET_BALANCE = '/wallets/{user_id}/balance'
+WALLET_TRANSACTIONS = '/wallets/{user_id}/transactions'
+WALLET_STATEMENT = '/wallets/{user_id}/statement'
+ONBOARD_USERS = '/users/bulk'
+ONBOARDING_JOB = '/users/bulk/{job_id}'
+RECONCILIATION = '/reconciliation'
+METRICS = '/metrics'
+
+# Limits
+BATCH_MAX_ITEMS = 50000
+MAX_WALLET_SLOTS = 256
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+JOB_ID_MAX_LENGTH = 255
+NAME_MAX_LENGTH = 64
+
 # Test URL
 TEST_URL = 'http://127.0.0.1:8003'
 
@@ -16,7 +39,31 @@ TEST_URL = 'http://127.0.0.1:8003'
 YES = 'Y'
 NO = 'N'
 
-# Tables
+# Headers of read-your-writes: writes return the WAL position of the primary after them, reads may ask to be
+# served by a replica which replayed it or by the primary
+LSN_HEADER = 'x-lsn'
+MIN_LSN_HEADER = 'x-min-lsn'
+READ_FROM_HEADER = 'x-read-from'
+PRIMARY = 'primary'
+
+# Storage engines
+POSTGRES = 'postgres'
+MEMORY = 'memory'
+
+# Types of amount and balance columns: arbitrary precision decimals or integral minor units of settings.currency
+NUMERIC = 'numeric'
+MINOR_UNITS = 'bigint'
+MAX_MINOR_UNITS = 2 ** 63 - 1
+
+# Number of decimal places (minor units) of currencies
+CURRENCY_SCALES = {'USD': 2, 'EUR': 2, 'GBP': 2, 'PLN': 2, 'CHF': 2, 'JPY': 0, 'KWD': 3, 'BHD': 3}
+
+# SQLSTATE codes of errors after which a transaction can be safely retried
+DEADLOCK_DETECTED = '40P01'
+SERIALIZATION_FAILURE = '40001'
+RETRYABLE_SQLSTATES = (DEADLOCK_DETECTED, SERIALIZATION_FAILURE)
+
+# Tables. Amounts and balances are of type {money}, NUMERIC or MINOR_UNITS
 USERS = """
     CREATE TABLE IF NOT EXISTS public.users
     (
@@ -31,7 +78,7 @@ WALLETS = """
     (
         id serial PRIMARY KEY,
         user_id bigint NOT NULL,
-        balance numeric NOT NULL DEFAULT 0,
+        balance {money} NOT NULL DEFAULT 0,
         CONSTRAINT user_uk UNIQUE (user_id),
         CONSTRAINT user_fk FOREIGN KEY (user_id)
             REFERENCES public.users (id) MATCH SIMPLE
@@ -40,18 +87,591 @@ WALLETS = """
     )
 """
 
+# Number of balance slots of a hot wallet, 0 for regular wallets
+WALLETS_SLOTS = """
+    ALTER TABLE public.wallets ADD COLUMN IF NOT EXISTS slots smallint NOT NULL DEFAULT 0
+"""
+
+# Sub-balances of hot wallets. Balance of a wallet is wallets.balance plus the sum of its slots
+WALLET_SLOTS = """
+    CREATE TABLE IF NOT EXISTS public.wallet_slots
+    (
+        wallet_id bigint NOT NULL,
+        slot smallint NOT NULL,
+        balance {money} NOT NULL DEFAULT 0,
+        CONSTRAINT wallet_slots_pk PRIMARY KEY (wallet_id, slot),
+        CONSTRAINT wallet_fk FOREIGN KEY (wallet_id)
+            REFERENCES public.wallets (id) MATCH SIMPLE
+            ON UPDATE NO ACTION
+            ON DELETE NO ACTION,
+        CONSTRAINT balance_ck CHECK (balance >= 0)
+    )
+"""
+
+# Ledger partitioned by month of transaction_timestamp. Monthly partitions are created ahead of time by
+# ensure_transaction_partitions, rows outside of them land in the default partition
 TRANSACTIONS = """
     CREATE TABLE IF NOT EXISTS public.transactions
     (
-        id serial PRIMARY KEY,
+        id bigint GENERATED BY DEFAULT AS IDENTITY,
         wallet_id bigint NOT NULL,
         type varchar(32) NOT NULL,
-        amount numeric NOT NULL,
+        amount {money} NOT NULL,
         transaction_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT transactions_pk PRIMARY KEY (id, transaction_timestamp),
         CONSTRAINT wallet_fk FOREIGN KEY (wallet_id)
             REFERENCES public.wallets (id) MATCH SIMPLE
             ON UPDATE NO ACTION
             ON DELETE NO ACTION,
         CONSTRAINT type_ck CHECK (type in ('credit', 'debit'))
+    ) PARTITION BY RANGE (transaction_timestamp)
+"""
+
+TRANSACTIONS_DEFAULT_PARTITION = """
+    CREATE TABLE IF NOT EXISTS public.transactions_default PARTITION OF public.transactions DEFAULT
+"""
+
+# Cold partitions detached from the ledger
+TRANSACTIONS_ARCHIVE = """
+    CREATE TABLE IF NOT EXISTS public.transactions_archive
+    (LIKE public.transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    PARTITION BY RANGE (transaction_timestamp)
+"""
+
+# History of a wallet is read newest first, optionally filtered by type, with keyset pagination on (timestamp, id)
+TRANSACTIONS_WALLET_INDEX = """
+    CREATE INDEX IF NOT EXISTS transactions_wallet_idx
+    ON public.transactions (wallet_id, transaction_timestamp DESC, id DESC)
+"""
+
+TRANSACTIONS_WALLET_TYPE_INDEX = """
+    CREATE INDEX IF NOT EXISTS transactions_wallet_type_idx
+    ON public.transactions (wallet_id, type, transaction_timestamp DESC, id DESC)
+"""
+
+# Accepted but not yet executed deposits and transfers of the write-behind queue
+OPERATIONS = """
+    CREATE TABLE IF NOT EXISTS public.operations
+    (
+        id bigserial PRIMARY KEY,
+        to_user_id bigint NOT NULL,
+        from_user_id bigint,
+        amount numeric NOT NULL,
+        status varchar(16) NOT NULL DEFAULT 'pending',
+        error text,
+        debit_transaction_id bigint,
+        credit_transaction_id bigint,
+        accepted_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        processed_at timestamp,
+        CONSTRAINT status_ck CHECK (status in ('pending', 'applied', 'rejected'))
+    )
+"""
+
+OPERATIONS_PENDING_INDEX = """
+    CREATE INDEX IF NOT EXISTS operations_pending_idx ON public.operations (id) WHERE status = 'pending'
+"""
+
+# Keys of deposits and transfers which may be retried by clients. A key is claimed before wallets are locked and
+# receives ids of ledger rows in the same transaction
+IDEMPOTENCY_KEYS = """
+    CREATE TABLE IF NOT EXISTS public.idempotency_keys
+    (
+        key varchar(255) PRIMARY KEY,
+        fingerprint text NOT NULL,
+        debit_transaction_id bigint,
+        credit_transaction_id bigint,
+        created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
     )
 """
+
+IDEMPOTENCY_KEYS_CREATED_INDEX = """
+    CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON public.idempotency_keys (created_at)
+"""
+
+# Balances of wallets replayed from the ledger: debits minus credits of rows up to transaction_id, the last ledger row
+# of the wallet taken into account. mismatch is the balance of the wallet minus this one, found by the last verification
+WALLET_CHECKPOINTS = """
+    CREATE TABLE IF NOT EXISTS public.wallet_checkpoints
+    (
+        wallet_id bigint PRIMARY KEY,
+        transaction_id bigint NOT NULL,
+        balance {money} NOT NULL,
+        mismatch {money},
+        verified_at timestamp
+    )
+"""
+
+WALLET_CHECKPOINTS_TRANSACTION_INDEX = """
+    CREATE INDEX IF NOT EXISTS wallet_checkpoints_transaction_idx ON public.wallet_checkpoints (transaction_id)
+"""
+
+WALLET_CHECKPOINTS_MISMATCH_INDEX = """
+    CREATE INDEX IF NOT EXISTS wallet_checkpoints_mismatch_idx ON public.wallet_checkpoints (wallet_id)
+    WHERE mismatch IS NOT NULL
+"""
+
+# Single row: the ledger is replayed into wallet_checkpoints up to transaction_id
+RECONCILIATION_STATE = """
+    CREATE TABLE IF NOT EXISTS public.reconciliation
+    (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        transaction_id bigint NOT NULL DEFAULT 0,
+        updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+INIT_RECONCILIATION_STATE = 'INSERT INTO public.reconciliation DEFAULT VALUES ON CONFLICT (id) DO NOTHING'
+
+# Progress of bulk onboarding jobs: number of records of the input committed so far
+ONBOARDING_JOBS = """
+    CREATE TABLE IF NOT EXISTS public.onboarding_jobs
+    (
+        id varchar(255) PRIMARY KEY,
+        status varchar(16) NOT NULL DEFAULT 'running',
+        records bigint NOT NULL DEFAULT 0,
+        error text,
+        started_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# Queries
+# relkind of the ledger table: 'p' once it is partitioned, 'r' before migration
+LEDGER_LAYOUT = "SELECT CAST(relkind AS text) FROM pg_class WHERE oid = 'public.transactions'::regclass"
+PARTITIONED = 'p'
+
+CREATE_TRANSACTION_PARTITIONS = 'SELECT * FROM ensure_transaction_partitions(:months_ahead)'
+CREATE_TRANSACTION_PARTITIONS_FROM = 'SELECT * FROM ensure_transaction_partitions(:months_ahead, :from_date)'
+
+# Migration of the single table ledger to the partitioned one
+COPY_LEGACY_TRANSACTIONS = """
+    WITH copied AS (
+        INSERT INTO public.transactions (id, wallet_id, type, amount, transaction_timestamp)
+        SELECT id, wallet_id, type, amount, transaction_timestamp FROM public.transactions_legacy
+        RETURNING 1
+    )
+    SELECT count(*) FROM copied
+"""
+
+SYNC_TRANSACTIONS_ID = """
+    SELECT setval(pg_get_serial_sequence('public.transactions', 'id'), max(id))
+    FROM public.transactions_legacy HAVING max(id) IS NOT NULL
+"""
+
+CURRENT_LSN = 'SELECT CAST(pg_current_wal_lsn() AS text)'
+
+# Replayed WAL position of a replica and its lag in seconds, 0 when it replayed everything it received
+REPLICA_STATUS = """
+    SELECT CAST(pg_last_wal_replay_lsn() AS text) AS lsn,
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag
+"""
+
+# Type of amounts and balances, NUMERIC or MINOR_UNITS
+MONEY_LAYOUT = """
+    SELECT data_type FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = 'wallets' AND column_name = 'balance'
+"""
+
+# Migration of amounts and balances to minor units, transactions_archive may not exist
+MONEY_COLUMNS = (('wallets', 'balance'), ('wallet_slots', 'balance'), ('transactions', 'amount'),
+                 ('transactions_archive', 'amount'), ('wallet_checkpoints', 'balance'),
+                 ('wallet_checkpoints', 'mismatch'))
+TABLE_EXISTS = "SELECT to_regclass('public.' || :table) IS NOT NULL"
+
+# Values which would lose precision or overflow bigint when multiplied by factor = 10 ** scale
+COUNT_INEXACT_AMOUNTS = """
+    SELECT count(*) FROM public.{table}
+    WHERE {column} * {factor} <> trunc({column} * {factor}) OR abs({column} * {factor}) > 9223372036854775807
+"""
+
+CONVERT_TO_MINOR_UNITS = """
+    ALTER TABLE public.{table} ALTER COLUMN {column} TYPE bigint USING CAST({column} * {factor} AS bigint)
+"""
+
+DROP_NUMERIC_EXECUTE_TRANSACTION = 'DROP FUNCTION IF EXISTS public.execute_transaction(bigint, numeric, bigint)'
+
+LEDGER_PARTITIONS = """
+    SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'public.transactions'::regclass
+"""
+
+# Arrays are bound as single parameters so batch size isn't limited by the number of query parameters
+INSERT_USER = """
+    INSERT INTO public.users (first_name, last_name) VALUES (:first_name, :last_name) RETURNING id
+"""
+
+INSERT_WALLET = """
+    INSERT INTO public.wallets (user_id) VALUES (:user_id) RETURNING id
+"""
+
+CALL_EXECUTE_TRANSACTION = 'SELECT * FROM execute_transaction(:to_user_id, :amount, :from_user_id)'
+
+WALLET_IDS = """
+    SELECT user_id, id FROM public.wallets WHERE user_id = ANY(CAST(:user_ids AS bigint[]))
+"""
+
+LOCK_WALLETS = """
+    SELECT id, balance, slots FROM public.wallets
+    WHERE id = ANY(CAST(:wallet_ids AS bigint[]))
+    ORDER BY id
+    FOR UPDATE
+"""
+
+# Hot wallets are skipped
+LOCK_REGULAR_WALLETS = """
+    SELECT id, balance FROM public.wallets
+    WHERE id = ANY(CAST(:wallet_ids AS bigint[])) AND slots = 0
+    ORDER BY id
+    FOR UPDATE
+"""
+
+# Ids are drawn up front and returned in the order of the arrays: RETURNING of an insert doesn't guarantee any order,
+# in particular when rows are routed to different partitions
+INSERT_TRANSACTIONS = """
+    WITH ledger AS (
+        SELECT nextval(pg_get_serial_sequence('public.transactions', 'id')) AS id, ord, wallet_id, type, amount
+        FROM unnest(CAST(:wallet_ids AS bigint[]), CAST(:types AS varchar[]), CAST(:amounts AS {money}[]))
+             WITH ORDINALITY AS l(wallet_id, type, amount, ord)
+    ), inserted AS (
+        INSERT INTO public.transactions (id, wallet_id, type, amount)
+        SELECT id, wallet_id, type, amount FROM ledger
+    )
+    SELECT id FROM ledger ORDER BY ord
+"""
+
+UPDATE_BALANCES = """
+    UPDATE public.wallets SET balance = wallets.balance + v.delta
+    FROM unnest(CAST(:wallet_ids AS bigint[]), CAST(:deltas AS {money}[])) AS v(id, delta)
+    WHERE wallets.id = v.id
+"""
+
+# Moves the money of the slots of hot wallets into their base balance, returns the moved amounts
+CONSOLIDATE_SLOTS = """
+    WITH locked AS (
+        SELECT wallet_id, slot, balance FROM public.wallet_slots
+        WHERE wallet_id = ANY(CAST(:wallet_ids AS bigint[]))
+        ORDER BY wallet_id, slot
+        FOR UPDATE
+    ), emptied AS (
+        UPDATE public.wallet_slots s SET balance = 0
+        FROM locked
+        WHERE s.wallet_id = locked.wallet_id AND s.slot = locked.slot
+    )
+    SELECT wallet_id, sum(balance) AS balance FROM locked GROUP BY wallet_id
+"""
+
+# Executed directly by asyncpg, hence positional parameters
+STATEMENT_ROWS = """
+    SELECT id, type, amount, transaction_timestamp FROM public.transactions
+    WHERE {conditions}
+    ORDER BY transaction_timestamp, id
+"""
+
+# Id of the last ledger row and the time it was read at. Rows with lower ids may still be inserted by transactions
+# started before
+LEDGER_HORIZON = """
+    SELECT coalesce(pg_sequence_last_value(CAST(pg_get_serial_sequence('public.transactions', 'id') AS regclass)), 0)
+           AS transaction_id,
+           clock_timestamp() AS read_at
+"""
+
+# Transactions of other sessions started before :since which write to the ledger. An insert locks the ledger
+# before it draws ids, so every transaction which may still commit a row with a lower id holds the lock
+TRANSACTIONS_IN_PROGRESS = """
+    SELECT count(DISTINCT a.pid) FROM pg_stat_activity a
+    JOIN pg_locks l ON l.pid = a.pid
+    WHERE a.xact_start < :since AND a.pid <> pg_backend_pid()
+      AND l.locktype = 'relation' AND l.mode = 'RowExclusiveLock'
+      AND l.relation = CAST('public.transactions' AS regclass)
+"""
+
+# Activity of sessions is read once per transaction unless the snapshot is cleared
+CLEAR_STATS_SNAPSHOT = 'SELECT pg_stat_clear_snapshot()'
+
+GET_RECONCILIATION_STATE = 'SELECT transaction_id, updated_at FROM public.reconciliation'
+# Verification shares the lock, replay and repairs take it exclusively
+SHARE_RECONCILIATION_STATE = 'SELECT transaction_id FROM public.reconciliation FOR SHARE'
+LOCK_RECONCILIATION_STATE = 'SELECT transaction_id FROM public.reconciliation FOR UPDATE'
+
+# Adds debits minus credits of ledger rows in (:low, :high] to checkpoints of their wallets. {ledger} is the ledger
+# with its archive. Updates nothing if a concurrent pass replayed the rows in the meantime
+REPLAY_LEDGER = """
+    WITH moved AS (
+        UPDATE public.reconciliation SET transaction_id = :high, updated_at = CURRENT_TIMESTAMP
+        WHERE transaction_id = :low
+        RETURNING transaction_id
+    ), batch AS (
+        SELECT wallet_id, max(id) AS transaction_id,
+               sum(CASE WHEN type = 'debit' THEN amount ELSE -amount END) AS delta,
+               count(*) AS rows
+        FROM ({ledger}) AS ledger
+        WHERE id > :low AND id <= :high AND EXISTS (SELECT 1 FROM moved)
+        GROUP BY wallet_id
+    ), saved AS (
+        INSERT INTO public.wallet_checkpoints (wallet_id, transaction_id, balance)
+        SELECT wallet_id, transaction_id, delta FROM batch
+        ON CONFLICT (wallet_id) DO UPDATE SET transaction_id = excluded.transaction_id,
+                                              balance = wallet_checkpoints.balance + excluded.balance
+    )
+    SELECT (SELECT count(*) FROM moved) AS moved, CAST(coalesce(sum(rows), 0) AS bigint) AS rows FROM batch
+"""
+LEDGER_ROWS = 'SELECT id, wallet_id, type, amount FROM public.transactions'
+LEDGER_WITH_ARCHIVE_ROWS = f'{LEDGER_ROWS} UNION ALL {LEDGER_ROWS}_archive'
+
+# Compares balances of at most :limit wallets with checkpoints replayed in (:after, :horizon], ordered by the last
+# ledger row. Ledger rows after the horizon are subtracted from the balance of the wallet. Being one statement, it
+# reads balances and ledger rows of one snapshot
+VERIFY_CHECKPOINTS = """
+    WITH later AS (
+        SELECT wallet_id, sum(CASE WHEN type = 'debit' THEN amount ELSE -amount END) AS delta
+        FROM public.transactions WHERE id > :horizon
+        GROUP BY wallet_id
+    ), checked AS (
+        SELECT c.wallet_id,
+               w.balance + coalesce((SELECT sum(s.balance) FROM public.wallet_slots s WHERE s.wallet_id = c.wallet_id),
+                                    0) - coalesce(later.delta, 0) - c.balance AS mismatch
+        FROM public.wallet_checkpoints c
+        JOIN public.wallets w ON w.id = c.wallet_id
+        LEFT JOIN later ON later.wallet_id = c.wallet_id
+        WHERE c.transaction_id > :after AND c.transaction_id <= :horizon
+        ORDER BY c.transaction_id
+        LIMIT :limit
+    )
+    UPDATE public.wallet_checkpoints c SET mismatch = NULLIF(checked.mismatch, 0), verified_at = CURRENT_TIMESTAMP
+    FROM checked WHERE c.wallet_id = checked.wallet_id
+    RETURNING c.wallet_id, c.transaction_id, c.mismatch
+"""
+
+WALLET_MISMATCHES = """
+    SELECT wallet_id, mismatch, verified_at FROM public.wallet_checkpoints WHERE mismatch IS NOT NULL ORDER BY wallet_id
+"""
+
+LOCK_SLOTS = """
+    SELECT 1 FROM public.wallet_slots WHERE wallet_id = ANY(CAST(:wallet_ids AS bigint[])) ORDER BY wallet_id, slot
+    FOR UPDATE
+"""
+
+# Balances of wallets according to the ledger (checkpoint plus rows after :replayed, the end of the replayed ledger)
+# and current ones, with slots
+LEDGER_BALANCES = """
+    WITH later AS (
+        SELECT wallet_id, sum(CASE WHEN type = 'debit' THEN amount ELSE -amount END) AS delta
+        FROM public.transactions WHERE id > :replayed AND wallet_id = ANY(CAST(:wallet_ids AS bigint[]))
+        GROUP BY wallet_id
+    )
+    SELECT w.id AS wallet_id, coalesce(c.balance, 0) + coalesce(later.delta, 0) AS balance,
+           w.balance + coalesce((SELECT sum(s.balance) FROM public.wallet_slots s WHERE s.wallet_id = w.id), 0)
+           AS current
+    FROM public.wallets w
+    LEFT JOIN public.wallet_checkpoints c ON c.wallet_id = w.id
+    LEFT JOIN later ON later.wallet_id = w.id
+    WHERE w.id = ANY(CAST(:wallet_ids AS bigint[]))
+"""
+
+# Sets base balances of wallets so that with their slots they match the ledger
+REPAIR_BALANCES = """
+    UPDATE public.wallets w SET balance = v.balance - coalesce(
+        (SELECT sum(s.balance) FROM public.wallet_slots s WHERE s.wallet_id = w.id), 0)
+    FROM unnest(CAST(:wallet_ids AS bigint[]), CAST(:balances AS {money}[])) AS v(id, balance)
+    WHERE w.id = v.id
+"""
+
+CLEAR_MISMATCHES = """
+    UPDATE public.wallet_checkpoints SET mismatch = NULL, verified_at = CURRENT_TIMESTAMP
+    WHERE wallet_id = ANY(CAST(:wallet_ids AS bigint[]))
+"""
+
+RESET_CHECKPOINTS = 'TRUNCATE public.wallet_checkpoints'
+RESET_RECONCILIATION_STATE = 'UPDATE public.reconciliation SET transaction_id = 0, updated_at = CURRENT_TIMESTAMP'
+
+# Ids of :count rows to be copied into a table with a serial id
+RESERVE_IDS = "SELECT array_agg(nextval(pg_get_serial_sequence($1, 'id'))) FROM generate_series(1, $2)"
+
+# Starts a new job or resumes a failed one, returns the number of records already committed
+START_ONBOARDING_JOB = """
+    INSERT INTO public.onboarding_jobs (id) VALUES (:job_id)
+    ON CONFLICT (id) DO UPDATE SET status = 'running', error = NULL, updated_at = CURRENT_TIMESTAMP
+    RETURNING records
+"""
+
+# Updates nothing if a concurrent run of the job committed records in the meantime
+ADVANCE_ONBOARDING_JOB = """
+    UPDATE public.onboarding_jobs SET records = records + $3, updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1 AND records = $2
+"""
+
+FINISH_ONBOARDING_JOB = """
+    UPDATE public.onboarding_jobs SET status = :status, error = :error, updated_at = CURRENT_TIMESTAMP
+    WHERE id = :job_id
+"""
+
+GET_ONBOARDING_JOB = """
+    SELECT id AS job_id, status, records, error, started_at, updated_at FROM public.onboarding_jobs WHERE id = :job_id
+"""
+
+# Operations accepted together are inserted by one statement. Ids are drawn up front and returned in the order of
+# the arrays, RETURNING of an insert doesn't guarantee any order
+INSERT_OPERATIONS = """
+    WITH accepted AS (
+        SELECT nextval(pg_get_serial_sequence('public.operations', 'id')) AS id, ord, to_user_id, from_user_id, amount
+        FROM unnest(CAST(:to_user_ids AS bigint[]), CAST(:from_user_ids AS bigint[]), CAST(:amounts AS numeric[]))
+             WITH ORDINALITY AS a(to_user_id, from_user_id, amount, ord)
+    ), inserted AS (
+        INSERT INTO public.operations (id, to_user_id, from_user_id, amount)
+        SELECT id, to_user_id, from_user_id, amount FROM accepted
+    )
+    SELECT id FROM accepted ORDER BY ord
+"""
+
+# Pending operations already claimed by another worker are skipped instead of waited for
+CLAIM_OPERATIONS = """
+    SELECT id, to_user_id, from_user_id, amount FROM public.operations
+    WHERE status = 'pending'
+    ORDER BY id
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+"""
+
+FINISH_OPERATIONS = """
+    UPDATE public.operations o
+    SET status = v.status, error = v.error, debit_transaction_id = v.debit_id, credit_transaction_id = v.credit_id,
+        processed_at = CURRENT_TIMESTAMP
+    FROM unnest(CAST(:ids AS bigint[]), CAST(:statuses AS varchar[]), CAST(:errors AS text[]),
+                CAST(:debit_ids AS bigint[]), CAST(:credit_ids AS bigint[]))
+         AS v(id, status, error, debit_id, credit_id)
+    WHERE o.id = v.id
+"""
+
+# Waits for a concurrent transaction holding the same key, returns nothing if it committed
+CLAIM_IDEMPOTENCY_KEY = """
+    INSERT INTO public.idempotency_keys (key, fingerprint) VALUES (:key, :fingerprint)
+    ON CONFLICT (key) DO NOTHING
+    RETURNING key
+"""
+
+GET_IDEMPOTENCY_KEY = """
+    SELECT fingerprint, debit_transaction_id, credit_transaction_id FROM public.idempotency_keys WHERE key = :key
+"""
+
+SAVE_IDEMPOTENCY_KEY = """
+    UPDATE public.idempotency_keys SET debit_transaction_id = :debit_id, credit_transaction_id = :credit_id
+    WHERE key = :key
+"""
+
+# Deletes at most :limit keys older than :ttl seconds, returns their number
+EXPIRE_IDEMPOTENCY_KEYS = """
+    WITH expired AS (
+        DELETE FROM public.idempotency_keys WHERE key IN (
+            SELECT key FROM public.idempotency_keys
+            WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => :ttl)
+            ORDER BY created_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED)
+        RETURNING 1)
+    SELECT count(*) FROM expired
+"""
+
+# Functions
+# Creates monthly partitions from p_from (current month by default) up to p_months_ahead months ahead. A partition is
+# filled with its rows from the default partition before it is attached, otherwise attaching it would fail
+ENSURE_TRANSACTION_PARTITIONS = """
+    CREATE OR REPLACE FUNCTION public.ensure_transaction_partitions(p_months_ahead int, p_from date DEFAULT NULL)
+    RETURNS SETOF text
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        v_month date;
+        v_name text;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'public.transactions'::regclass) <> 'p' THEN
+            RETURN;
+        END IF;
+        PERFORM pg_advisory_xact_lock(hashtext('ensure_transaction_partitions'));
+        v_month := date_trunc('month', coalesce(p_from, CURRENT_DATE));
+        WHILE v_month <= date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead) LOOP
+            v_name := 'transactions_p' || to_char(v_month, 'YYYY_MM');
+            IF to_regclass('public.' || v_name) IS NULL THEN
+                EXECUTE format('CREATE TABLE public.%I '
+                               '(LIKE public.transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+                EXECUTE format('WITH moved AS (DELETE FROM public.transactions_default '
+                               'WHERE transaction_timestamp >= %L AND transaction_timestamp < %L RETURNING *) '
+                               'INSERT INTO public.%I SELECT * FROM moved',
+                               v_month, v_month + interval '1 month', v_name);
+                EXECUTE format('ALTER TABLE public.transactions ATTACH PARTITION public.%I '
+                               'FOR VALUES FROM (%L) TO (%L)', v_name, v_month, v_month + interval '1 month');
+                RETURN NEXT v_name;
+            END IF;
+            v_month := v_month + interval '1 month';
+        END LOOP;
+    END;
+    $$
+"""
+
+EXECUTE_TRANSACTION = """
+    CREATE OR REPLACE FUNCTION public.execute_transaction(
+        p_to_user_id bigint,
+        p_amount {money},
+        p_from_user_id bigint DEFAULT NULL,
+        OUT status varchar,
+        OUT debit_transaction_id bigint,
+        OUT credit_transaction_id bigint,
+        OUT from_balance {money})
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        v_to_wallet_id bigint;
+        v_from_wallet_id bigint;
+        v_row record;
+    BEGIN
+        FOR v_row IN
+            SELECT id, user_id, balance FROM public.wallets
+            WHERE user_id IN (p_to_user_id, p_from_user_id) AND slots = 0
+            ORDER BY id
+            FOR UPDATE
+        LOOP
+            IF v_row.user_id = p_to_user_id THEN
+                v_to_wallet_id := v_row.id;
+            ELSE
+                v_from_wallet_id := v_row.id;
+                from_balance := v_row.balance;
+            END IF;
+        END LOOP;
+        IF (v_to_wallet_id IS NULL OR (p_from_user_id IS NOT NULL AND v_from_wallet_id IS NULL))
+           AND EXISTS (SELECT 1 FROM public.wallets WHERE user_id IN (p_to_user_id, p_from_user_id) AND slots > 0) THEN
+            status := 'hot_wallet';
+            RETURN;
+        END IF;
+        IF v_to_wallet_id IS NULL THEN
+            status := 'to_wallet_not_found';
+            RETURN;
+        END IF;
+        IF p_from_user_id IS NOT NULL THEN
+            IF v_from_wallet_id IS NULL THEN
+                status := 'from_wallet_not_found';
+                RETURN;
+            END IF;
+            IF from_balance - p_amount < 0 THEN
+                status := 'insufficient_funds';
+                RETURN;
+            END IF;
+        END IF;
+        INSERT INTO public.transactions (wallet_id, type, amount)
+        VALUES (v_to_wallet_id, 'debit', p_amount)
+        RETURNING id INTO debit_transaction_id;
+        UPDATE public.wallets SET balance = balance + p_amount WHERE id = v_to_wallet_id;
+        IF p_from_user_id IS NOT NULL THEN
+            INSERT INTO public.transactions (wallet_id, type, amount)
+            VALUES (v_from_wallet_id, 'credit', p_amount)
+            RETURNING id INTO credit_transaction_id;
+            UPDATE public.wallets SET balance = balance - p_amount WHERE id = v_from_wallet_id;
+        END IF;
+        status := 'ok';
+    END;
+    $$
+"""
+
+# Statuses returned by execute_transaction
+STATUS_OK = 'ok'
+STATUS_TO_WALLET_NOT_FOUND = 'to_wallet_not_found'
+STATUS_FROM_WALLET_NOT_FOUND = 'from_wallet_not_found'
+STATUS_INSUFFICIENT_FUNDS = 'insufficient_funds'
+STATUS_HOT_WALLET = 'hot_wallet'
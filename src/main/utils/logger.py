@@ -1,12 +1,128 @@
+"""Logging off the event loop
+
+Loggers of the service share one QueueHandler: the calling thread (the event loop) only puts records on a queue, a
+QueueListener thread formats and writes them to stderr, as text or as JSON lines. Levels and sampling are set by
+configure_logging from settings. With sampling, the first sample_first records of every call site in a second are
+logged and then every sample_every-th one, so a message logged per request can't flood the output. Warnings and
+errors aren't sampled.
+"""
+import atexit
+import json
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, IO, Optional, Set, Tuple
+
+TEXT = 'text'
+JSON = 'json'
+
+TEXT_FORMAT = '%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes the first records of every call site in a second, then every n-th one. Warnings and errors always pass"""
+    def __init__(self, first: int = 0, every: int = 0):
+        super().__init__()
+        self.first = first
+        self.every = every
+        # Numbers of records of call sites in the current second
+        self._second = 0
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.first <= 0 or record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        if second != self._second:
+            # Counts of the previous second are dropped, so call sites don't accumulate
+            self._second = second
+            self._counts.clear()
+        site = (record.pathname, record.lineno)
+        count = self._counts.get(site, 0) + 1
+        self._counts[site] = count
+        return count <= self.first or (self.every > 0 and (count - self.first) % self.every == 0)
+
+
+class LocalQueueHandler(QueueHandler):
+    """Enqueues records as they are, formatting is left to the listener thread
+
+    Records don't leave the process, so they needn't be made picklable.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
 
-def get_console_logger(name: str, log_level: int = logging.DEBUG) -> logging.Logger:
+class _Logging:
+    def __init__(self):
+        self.level = logging.INFO
+        self.levels: Dict[str, int] = {}
+        self.loggers: Set[str] = set()
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.stream = logging.StreamHandler()
+        self.stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+        self.handler = LocalQueueHandler(self.queue)
+        self.sampling = SamplingFilter()
+        self.handler.addFilter(self.sampling)
+        self.listener: Optional[QueueListener] = None
+        # Records still in the queue are written at exit
+        atexit.register(self.stop)
+
+    def start(self):
+        if self.listener is None:
+            self.listener = QueueListener(self.queue, self.stream)
+            self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def level_of(self, name: str) -> int:
+        return self.levels.get(name, self.level)
+
+
+_logging = _Logging()
+
+
+def get_console_logger(name: str, log_level: Optional[int] = None) -> logging.Logger:
+    """Logger writing through the shared queue, configured once however many times it's asked for"""
     logger = logging.getLogger(name)
-    logger.setLevel(level=log_level)
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(level=log_level)
-    console_format = logging.Formatter('%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s')
-    console_handler.setFormatter(console_format)
-    logger.addHandler(console_handler)
+    if name not in _logging.loggers:
+        _logging.start()
+        logger.addHandler(_logging.handler)
+        _logging.loggers.add(name)
+    if log_level is not None:
+        _logging.levels[name] = log_level
+    logger.setLevel(_logging.level_of(name))
     return logger
+
+
+def configure_logging(level: str = 'INFO', levels: Dict[str, str] = None, format_: str = TEXT, sample_first: int = 0,
+                      sample_every: int = 0, stream: Optional[IO] = None):
+    """Sets the level of loggers (levels by logger name override it), the output format, sampling and the stream
+    written to (stderr by default)"""
+    if stream is not None:
+        _logging.stream.setStream(stream)
+    _logging.level = logging.getLevelName(level.upper())
+    _logging.levels.update({name: logging.getLevelName(value.upper()) for name, value in (levels or {}).items()})
+    _logging.stream.setFormatter(JsonFormatter() if format_ == JSON else logging.Formatter(TEXT_FORMAT))
+    _logging.sampling.first = sample_first
+    _logging.sampling.every = sample_every
+    for name in _logging.loggers:
+        logging.getLogger(name).setLevel(_logging.level_of(name))
+
+
+def flush_logs():
+    """Waits until queued records are written"""
+    if _logging.listener is not None:
+        _logging.stop()
+        _logging.start()
@@ -0,0 +1,186 @@
+import asyncio
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+from asyncpg import PostgresError
+
+from src.main.crud import create_transaction, get_wallet_ids
+from src.main.model import Transaction, OperationResponse, OperationStatus, operations
+from src.main.replicas import read_database
+from src.main.settings import database, settings, transaction, spawn
+from src.main.utils.constants import CLAIM_OPERATIONS, FINISH_OPERATIONS, RETRYABLE_SQLSTATES, \
+    LOCK_WALLETS, INSERT_OPERATIONS
+from src.main.utils.logger import get_console_logger
+
+logger = get_console_logger(name=__name__)
+
+
+class WriteBehindQueue:
+    """Background workers draining accepted operations in micro-batches"""
+    def __init__(self):
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def notify(self):
+        """Wakes idle workers up after an operation was accepted"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, workers: int):
+        self._stopping = False
+        # Created here rather than in __init__ so it belongs to the running event loop
+        self._wakeup = asyncio.Event()
+        self._tasks = [spawn(self._work()) for _ in range(workers)]
+        if workers:
+            logger.info(f'Started {workers} write-behind workers')
+
+    async def stop(self):
+        """Lets workers finish their current micro-batch"""
+        self._stopping = True
+        self.notify()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    async def _work(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                finished = await apply_pending_operations(limit=settings.write_behind_batch_size)
+            except Exception:
+                logger.exception('Write-behind micro-batch failed')
+                finished = 0
+            if finished < settings.write_behind_batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.write_behind_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+
+write_behind = WriteBehindQueue()
+
+
+class OperationAppender:
+    """Group commit of accepted operations
+
+    Operations arriving within write_behind_append_window_ms (or until write_behind_append_max_items of them are
+    waiting) are inserted by one statement, so they share one commit and one pooled connection. Every caller gets
+    its id once the insert is committed.
+    """
+    def __init__(self):
+        self._pending: List[Tuple[Tuple[int, Optional[int], Decimal], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Running inserts are referenced so they aren't garbage collected
+        self._running = set()
+        self.flushes = 0
+
+    async def append(self, to_user_id: int, amount: Decimal, from_user_id: int = None) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((to_user_id, from_user_id, amount), future))
+        if len(self._pending) >= settings.write_behind_append_max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(settings.write_behind_append_window_ms / 1000,
+                                                                self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            self.flushes += 1
+            task = spawn(self._insert(pending))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _insert(pending: List[Tuple[Tuple[int, Optional[int], Decimal], asyncio.Future]]):
+        to_user_ids, from_user_ids, amounts = zip(*(operation for operation, _ in pending))
+        try:
+            rows = await database.fetch_all(query=INSERT_OPERATIONS, values={'to_user_ids': list(to_user_ids),
+                                                                             'from_user_ids': list(from_user_ids),
+                                                                             'amounts': list(amounts)})
+        except Exception as e:
+            logger.warning(f'Insert of {len(pending)} accepted operations failed: {e}')
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), row in zip(pending, rows):
+            if not future.done():
+                future.set_result(row['id'])
+        write_behind.notify()
+
+
+operation_appender = OperationAppender()
+
+
+async def enqueue_operation(to_user_id: int, amount: str, from_user_id: int = None) -> OperationResponse:
+    """Stores deposit or transfer to be performed by the workers
+
+    The operation is committed (together with the ones accepted at the same time) before its id is returned, so an
+    accepted operation survives a restart.
+    """
+    operation_id = await operation_appender.append(to_user_id=to_user_id, amount=Decimal(amount),
+                                                   from_user_id=from_user_id)
+    return OperationResponse(operation_id=operation_id, status=OperationStatus.pending)
+
+
+async def get_operation(operation_id: int) -> Optional[OperationResponse]:
+    query = operations.select().where(operations.c.id == operation_id)
+    row = await (await read_database()).fetch_one(query)
+    if row is None:
+        return None
+    transaction_ = None
+    if row['debit_transaction_id'] is not None:
+        transaction_ = Transaction(debit_transaction_id=row['debit_transaction_id'],
+                                   credit_transaction_id=row['credit_transaction_id'])
+    return OperationResponse(operation_id=row['id'], status=row['status'], transaction=transaction_,
+                             error=row['error'])
+
+
+@transaction
+async def apply_operation(to_user_id: int, amount: str, from_user_id: int = None) -> Transaction:
+    """Performs operation in a savepoint so its failure doesn't abort the micro-batch
+
+    Conflicts aren't retried in place because locks of operations applied earlier in the micro-batch are still held.
+    """
+    return await create_transaction.__wrapped__(to_user_id=to_user_id, amount=amount, from_user_id=from_user_id)
+
+
+@transaction
+async def apply_pending_operations(limit: int) -> int:
+    """Performs up to limit pending operations in one transaction, returns number of applied and rejected ones"""
+    rows = await database.fetch_all(query=CLAIM_OPERATIONS, values={'limit': limit})
+    # Wallets of the whole micro-batch are locked up front in the order of their ids, otherwise workers holding
+    # locks of already applied operations would deadlock on each other's wallets
+    user_ids = ({row['to_user_id'] for row in rows} | {row['from_user_id'] for row in rows}) - {None}
+    if user_ids:
+        wallet_ids = await get_wallet_ids(user_ids)
+        await database.fetch_all(query=LOCK_WALLETS, values={'wallet_ids': sorted(wallet_ids.values())})
+    finished = []
+    for row in rows:
+        try:
+            result = await apply_operation(to_user_id=row['to_user_id'], amount=str(row['amount']),
+                                           from_user_id=row['from_user_id'])
+        except ValueError as e:
+            finished.append((row['id'], OperationStatus.rejected, str(e), None, None))
+        except PostgresError as e:
+            if e.sqlstate in RETRYABLE_SQLSTATES:
+                # Remaining operations stay pending and are claimed again after this transaction commits
+                logger.info(f'Write-behind micro-batch stopped after {len(finished)} operations: {e}')
+                break
+            finished.append((row['id'], OperationStatus.rejected, str(e), None, None))
+        else:
+            finished.append((row['id'], OperationStatus.applied, None, result.debit_transaction_id,
+                             result.credit_transaction_id))
+    if finished:
+        ids, statuses, errors, debit_ids, credit_ids = zip(*finished)
+        await database.execute(query=FINISH_OPERATIONS, values={'ids': list(ids),
+                                                                'statuses': [s.value for s in statuses],
+                                                                'errors': list(errors),
+                                                                'debit_ids': list(debit_ids),
+                                                                'credit_ids': list(credit_ids)})
+    return len(finished)
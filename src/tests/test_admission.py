@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from src.main.admission import AdmissionMiddleware, Limiter, Priority, \
+    Rejected
+from src.main.settings import settings
+from src.main.utils.constants import TEST_URL, DEPOSIT_MONEY, METRICS
+
+
+@pytest.mark.asyncio
+async def test_writes_are_admitted_first():
+    limiter = Limiter('test', limit=1, queue_size=2)
+    deadline = time.monotonic() + 1
+    await limiter.acquire(Priority.write, deadline)
+    admitted = []
+
+    async def request(priority):
+        await limiter.acquire(priority, deadline)
+        admitted.append(priority)
+
+    read = asyncio.create_task(request(Priority.read))
+    bulk = asyncio.create_task(request(Priority.bulk))
+    await asyncio.sleep(0)
+    # The queue is full, the write takes the place of the bulk request
+    write = asyncio.create_task(request(Priority.write))
+    with pytest.raises(Rejected, match='displaced'):
+        await bulk
+    with pytest.raises(Rejected, match='queue_full'):
+        await limiter.acquire(Priority.bulk, deadline)
+    limiter.release(0.01)
+    await write
+    limiter.release(0.01)
+    await read
+    assert admitted == [Priority.write, Priority.read]
+    assert (limiter.in_flight, limiter.queued) == (1, 0)
+
+
+@pytest.mark.asyncio
+async def test_limit_adapts_to_latency():
+    limiter = Limiter('test', limit=10, queue_size=0, min_limit=2,
+                      target_latency=0.1, decrease=0.5)
+    for latency, limit in ((0.2, 5), (0.2, 2), (0.2, 2), (0.01, 3)):
+        for _ in range(limiter.limit):
+            await limiter.acquire(Priority.read, time.monotonic())
+        for _ in range(limiter.limit):
+            limiter.release(latency)
+        assert limiter.limit == limit
+
+
+@pytest.mark.asyncio
+async def test_overloaded_route_returns_503(monkeypatch):
+    monkeypatch.setattr(settings, 'admission_concurrency', 1)
+    monkeypatch.setattr(settings, 'admission_queue_size', 1)
+    monkeypatch.setattr(settings, 'admission_queue_timeout', 0.05)
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware)
+    release = asyncio.Event()
+
+    @app.post(DEPOSIT_MONEY)
+    async def deposit():
+        await release.wait()
+        return {}
+
+    @app.get(METRICS)
+    async def metrics():
+        return {}
+
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        first = asyncio.create_task(ac.post(DEPOSIT_MONEY))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(ac.post(DEPOSIT_MONEY))
+        await asyncio.sleep(0.01)
+        response = await ac.post(DEPOSIT_MONEY)
+        assert response.status_code == 503
+        assert int(response.headers['retry-after']) >= 1
+        # Monitoring isn't limited
+        assert (await ac.get(METRICS)).status_code == 200
+        assert (await queued).status_code == 503
+        release.set()
+        assert (await first).status_code == 200
+        assert (await ac.post(DEPOSIT_MONEY)).status_code == 200
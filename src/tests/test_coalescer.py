@@ -0,0 +1,65 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from src.main import coalescer
+from src.main.coalescer import DepositCoalescer
+from src.main.crud import create_user, get_wallet
+from src.main.settings import database, init_db, settings
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    calls = []
+    create_transactions_batch = coalescer.create_transactions_batch
+
+    async def counted(items, mode):
+        calls.append(len(items))
+        return await create_transactions_batch(items=items, mode=mode)
+
+    monkeypatch.setattr(coalescer, 'create_transactions_batch', counted)
+    monkeypatch.setattr(settings, 'coalesce_window_ms', 20)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_deposits_are_coalesced(batches, sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    deposits = DepositCoalescer()
+    results = await asyncio.gather(
+        deposits.submit(user_id=user1.user_id, amount='10'),
+        deposits.submit(user_id=user1.user_id, amount='5'),
+        deposits.submit(user_id=user2.user_id, amount='1'),
+        deposits.submit(user_id=-1, amount='1'),
+        return_exceptions=True)
+    assert batches == [4]
+    debit_ids = {result.debit_transaction_id for result in results[:3]}
+    assert len(debit_ids) == 3
+    assert all(result.credit_transaction_id is None
+               for result in results[:3])
+    assert isinstance(results[3], ValueError)
+    assert str(results[3]) == \
+        'Cannot find wallet of user -1 to perform deposit'
+    wallet_row = await get_wallet(user_id=user1.user_id)
+    assert wallet_row['balance'] == Decimal('15')
+    wallet_row = await get_wallet(user_id=user2.user_id)
+    assert wallet_row['balance'] == Decimal('1')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed(batches, monkeypatch, sample_user1):
+    await init_db()
+    monkeypatch.setattr(settings, 'coalesce_window_ms', 10000)
+    monkeypatch.setattr(settings, 'coalesce_max_items', 2)
+    user = await create_user(request=sample_user1)
+    deposits = DepositCoalescer()
+    await asyncio.wait_for(asyncio.gather(
+        deposits.submit(user_id=user.user_id, amount='1'),
+        deposits.submit(user_id=user.user_id, amount='1')), timeout=5)
+    assert batches == [2]
+    assert deposits.flushes == 1
+    await database.disconnect()
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import asyncpg
+import pytest
+from asyncpg.exceptions import DeadlockDetectedError, UniqueViolationError
+
+from src.main.retry import retry_on_conflict, retry_stats
+from src.main.settings import settings
+from src.main.utils.constants import DEADLOCK_DETECTED, NO
+
+SCRATCH_DATABASE = 'payments_crossing_transfers'
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(settings, 'retry_backoff_base', 0)
+    retry_stats.reset()
+
+
+@pytest.mark.asyncio
+async def test_retry_on_deadlock(no_backoff):
+    calls = []
+
+    @retry_on_conflict
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise DeadlockDetectedError('deadlock detected')
+        return 'done'
+
+    assert await flaky() == 'done'
+    assert len(calls) == 3
+    assert retry_stats.retries[DEADLOCK_DETECTED] == 2
+
+
+@pytest.mark.asyncio
+async def test_retry_exhausted(no_backoff):
+    calls = []
+
+    @retry_on_conflict
+    async def deadlocked():
+        calls.append(1)
+        raise DeadlockDetectedError('deadlock detected')
+
+    with pytest.raises(DeadlockDetectedError):
+        await deadlocked()
+    assert len(calls) == settings.retry_attempts
+    assert retry_stats.exhausted[DEADLOCK_DETECTED] == 1
+
+
+@pytest.mark.asyncio
+async def test_no_retry_on_other_errors(no_backoff):
+    calls = []
+
+    @retry_on_conflict
+    async def duplicate():
+        calls.append(1)
+        raise UniqueViolationError('duplicate key')
+
+    with pytest.raises(UniqueViolationError):
+        await duplicate()
+    assert len(calls) == 1
+
+
+async def execute_on_server(statement):
+    connection = await asyncpg.connect(str(settings.DATABASE_URL))
+    try:
+        await connection.execute(statement)
+    finally:
+        await connection.close()
+
+
+def test_crossing_transfers_keep_total_balance():
+    # Needs real concurrent connections, so it runs outside of the
+    # force_rollback connection used by the rest of the suite, in a
+    # database of its own which is dropped with everything it created
+    url = str(settings.DATABASE_URL).rsplit('/', 1)[0] + '/' + SCRATCH_DATABASE
+    drop = f'DROP DATABASE IF EXISTS {SCRATCH_DATABASE} WITH (FORCE)'
+    asyncio.run(execute_on_server(drop))
+    asyncio.run(execute_on_server(f'CREATE DATABASE {SCRATCH_DATABASE}'))
+    try:
+        result = subprocess.run(
+            [sys.executable, '-m', 'src.benchmarks.crossing_transfers',
+             '--pairs', '5', '--transfers', '2000', '--concurrency', '20'],
+            env={**os.environ, 'TESTING': NO, 'DATABASE_URL': url},
+            capture_output=True, text=True, timeout=600)
+    finally:
+        asyncio.run(execute_on_server(drop))
+    assert result.returncode == 0, result.stdout + result.stderr
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    assert summary['total_before'] == summary['total_after']
+    assert summary['applied'] > 0
@@ -1,13 +1,15 @@
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 import pytest
 
 from src.main.crud import create_user, create_transaction, get_wallet, \
-    get_user, get_transaction
+    get_user, get_transaction, create_transactions_batch, \
+    get_transactions_page, get_wallet_ids, wallet_id_cache
 from src.main.model import UserResponse, DepositRequest, TransferRequest, \
-    TransactionType
-from src.main.app import database
-from src.main.settings import init_db
+    TransactionType, BatchMode, BatchItemStatus
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import YES
 
 
 @pytest.mark.asyncio
@@ -77,3 +79,197 @@ async def test_negative_amount(sample_user1):
         await create_transaction(to_user_id=deposit.user_id,
                                  amount=deposit.amount)
     await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_single_statement_transfer(monkeypatch, sample_user1,
+                                         sample_user2):
+    monkeypatch.setattr(settings, 'single_statement', YES)
+    await init_db()
+    from_user = await create_user(request=sample_user1)
+    to_user = await create_user(request=sample_user2)
+    deposit = await create_transaction(to_user_id=from_user.user_id,
+                                       amount='100')
+    assert deposit.credit_transaction_id is None
+    transfer = await create_transaction(to_user_id=to_user.user_id,
+                                        from_user_id=from_user.user_id,
+                                        amount='20')
+    from_wallet = await get_wallet(user_id=from_user.user_id)
+    to_wallet = await get_wallet(user_id=to_user.user_id)
+    from_transaction = await get_transaction(wallet_id=from_wallet['id'],
+                                             type_=TransactionType.credit)
+    to_transaction = await get_transaction(wallet_id=to_wallet['id'])
+    assert from_transaction['id'] == transfer.credit_transaction_id
+    assert to_transaction['id'] == transfer.debit_transaction_id
+    assert from_wallet['balance'] == Decimal('80')
+    assert to_wallet['balance'] == Decimal('20')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_single_statement_errors(monkeypatch, sample_user1,
+                                       sample_user2):
+    monkeypatch.setattr(settings, 'single_statement', YES)
+    await init_db()
+    from_user = await create_user(request=sample_user1)
+    to_user = await create_user(request=sample_user2)
+    with pytest.raises(ValueError, match='Cannot find wallet of user -1 '
+                                         'to perform deposit'):
+        await create_transaction(to_user_id=-1, amount='1')
+    with pytest.raises(ValueError, match='Cannot find wallet of user -1 '
+                                         'to perform credit'):
+        await create_transaction(to_user_id=to_user.user_id,
+                                 from_user_id=-1, amount='1')
+    with pytest.raises(ValueError, match='Not enough money on user'):
+        await create_transaction(to_user_id=to_user.user_id,
+                                 from_user_id=from_user.user_id, amount='1')
+    from_wallet = await get_wallet(user_id=from_user.user_id)
+    assert from_wallet['balance'] == Decimal('0')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_batch(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    # The transfers depend on the deposit made earlier in the same batch
+    batch = await create_transactions_batch(items=[
+        DepositRequest(user_id=user1.user_id, amount='100'),
+        TransferRequest(from_user_id=user1.user_id, to_user_id=user2.user_id,
+                        amount='30'),
+        TransferRequest(from_user_id=user2.user_id, to_user_id=user1.user_id,
+                        amount='10'),
+    ])
+    assert batch.applied == 3
+    assert [r.status for r in batch.results] == [BatchItemStatus.applied] * 3
+    assert batch.results[0].transaction.credit_transaction_id is None
+    transfer = batch.results[1].transaction
+    credit = await get_transaction(wallet_id=user1.wallet_id,
+                                   type_=TransactionType.credit)
+    assert credit['id'] == transfer.credit_transaction_id
+    assert credit['amount'] == Decimal('30')
+    wallet1 = await get_wallet(user_id=user1.user_id)
+    wallet2 = await get_wallet(user_id=user2.user_id)
+    assert wallet1['balance'] == Decimal('80')
+    assert wallet2['balance'] == Decimal('20')
+    # Every item gets ids of its own ledger rows
+    expected = [(user1.wallet_id, None, '100'),
+                (user2.wallet_id, user1.wallet_id, '30'),
+                (user1.wallet_id, user2.wallet_id, '10')]
+    for result, (to_wallet_id, from_wallet_id, amount) in zip(batch.results,
+                                                              expected):
+        ids = {TransactionType.debit: result.transaction.debit_transaction_id,
+               TransactionType.credit:
+                   result.transaction.credit_transaction_id}
+        for type_, wallet_id in ((TransactionType.debit, to_wallet_id),
+                                 (TransactionType.credit, from_wallet_id)):
+            if wallet_id is None:
+                continue
+            row = await database.fetch_one(
+                'SELECT wallet_id, type, amount FROM public.transactions '
+                'WHERE id = :id', values={'id': ids[type_]})
+            assert (row['wallet_id'], row['type'], row['amount']) == \
+                (wallet_id, type_.value, Decimal(amount))
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_batch_all_or_nothing(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    batch = await create_transactions_batch(items=[
+        DepositRequest(user_id=user1.user_id, amount='10'),
+        TransferRequest(from_user_id=user1.user_id, to_user_id=user2.user_id,
+                        amount='30'),
+    ], mode=BatchMode.all_or_nothing)
+    assert batch.applied == 0
+    assert [r.status for r in batch.results] == [BatchItemStatus.aborted,
+                                                 BatchItemStatus.rejected]
+    assert 'Not enough money' in batch.results[1].error
+    wallet1 = await get_wallet(user_id=user1.user_id)
+    assert wallet1['balance'] == Decimal('0')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_batch_best_effort(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    batch = await create_transactions_batch(items=[
+        DepositRequest(user_id=user1.user_id, amount='10'),
+        TransferRequest(from_user_id=user1.user_id, to_user_id=user2.user_id,
+                        amount='30'),
+        DepositRequest(user_id=-1, amount='10'),
+        TransferRequest(from_user_id=user1.user_id, to_user_id=user2.user_id,
+                        amount='4'),
+    ], mode=BatchMode.best_effort)
+    assert batch.applied == 2
+    assert [r.status for r in batch.results] == [BatchItemStatus.applied,
+                                                 BatchItemStatus.rejected,
+                                                 BatchItemStatus.rejected,
+                                                 BatchItemStatus.applied]
+    assert batch.results[2].error == ('Cannot find wallet of user -1 '
+                                      'to perform deposit')
+    wallet1 = await get_wallet(user_id=user1.user_id)
+    wallet2 = await get_wallet(user_id=user2.user_id)
+    assert wallet1['balance'] == Decimal('6')
+    assert wallet2['balance'] == Decimal('4')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_transactions_pages(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    for amount in range(1, 6):
+        await create_transaction(to_user_id=user1.user_id,
+                                 amount=str(amount))
+    await create_transaction(to_user_id=user2.user_id, amount='1',
+                             from_user_id=user1.user_id)
+    amounts = []
+    cursor = None
+    while True:
+        page = await get_transactions_page(user_id=user1.user_id, limit=2,
+                                           cursor=cursor)
+        assert len(page.items) <= 2
+        amounts.extend(item.amount for item in page.items)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert amounts == [Decimal(a) for a in ('1', '5', '4', '3', '2', '1')]
+    page = await get_transactions_page(user_id=user1.user_id, limit=10,
+                                       type_=TransactionType.credit)
+    assert [item.type for item in page.items] == [TransactionType.credit]
+    page = await get_transactions_page(
+        user_id=user1.user_id, limit=10,
+        since=datetime.now() + timedelta(days=1))
+    assert page.items == [] and page.next_cursor is None
+    assert await get_transactions_page(user_id=-1, limit=10) is None
+    with pytest.raises(ValueError) as e:
+        await get_transactions_page(user_id=user1.user_id, limit=10,
+                                    cursor='abc')
+    assert str(e.value) == 'Invalid cursor abc'
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_wallet_ids_are_cached(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    assert wallet_id_cache.get(user1.user_id) == user1.wallet_id
+    user2 = await create_user(request=sample_user2)
+    wallet_id_cache.clear()
+    assert await get_wallet_ids([user1.user_id, user2.user_id, -1]) == \
+        {user1.user_id: user1.wallet_id, user2.user_id: user2.wallet_id}
+    misses = wallet_id_cache.misses
+    await create_transaction(to_user_id=user1.user_id, amount='3')
+    await create_transaction(to_user_id=user2.user_id, amount='1',
+                             from_user_id=user1.user_id)
+    assert wallet_id_cache.misses == misses
+    assert (await get_wallet(user_id=user1.user_id))['balance'] == 2
+    assert (await get_wallet(user_id=user2.user_id))['balance'] == 1
+    await database.disconnect()
@@ -3,12 +3,12 @@ from decimal import Decimal
 import pytest
 from httpx import AsyncClient
 
-from src.main.app import app, database
+from src.main.app import app
 from src.main.crud import get_wallet
 from src.main.model import DepositRequest, TransferRequest
-from src.main.settings import init_db
+from src.main.settings import database, init_db
 from src.main.utils.constants import CREATE_USER, TEST_URL, DEPOSIT_MONEY, \
-    TRANSFER_MONEY
+    TRANSFER_MONEY, RETRY_STATS, TRANSFERS_BATCH
 
 
 @pytest.fixture
@@ -133,3 +133,71 @@ async def test_transfer_not_enough_money(async_client, sample_user1,
                                                content=transfer_req.json())
         assert deposit_resp.status_code == 500
     await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_retry_stats_endpoint(async_client):
+    resp = await async_client.get(url=RETRY_STATS)
+    assert resp.status_code == 200
+    assert list(resp.json().keys()) == ['retries', 'exhausted']
+
+
+@pytest.mark.asyncio
+async def test_transfers_batch_endpoint(async_client, sample_user1,
+                                        sample_user2):
+    await init_db()
+    user1 = await async_client.post(url=CREATE_USER,
+                                    content=sample_user1.json())
+    user2 = await async_client.post(url=CREATE_USER,
+                                    content=sample_user2.json())
+    items = [{'user_id': user1.json()['user_id'], 'amount': '50'},
+             {'from_user_id': user1.json()['user_id'],
+              'to_user_id': user2.json()['user_id'], 'amount': '20'}]
+    resp = await async_client.post(url=TRANSFERS_BATCH,
+                                   json={'mode': 'best_effort',
+                                         'items': items})
+    assert resp.status_code == 200
+    assert resp.json()['applied'] == 2
+    transfer = resp.json()['results'][1]['transaction']
+    assert transfer['credit_transaction_id'] is not None
+    wallet_row = await get_wallet(user_id=user2.json()['user_id'])
+    assert wallet_row['balance'] == Decimal('20')
+    resp = await async_client.post(url=TRANSFERS_BATCH, json={'items': []})
+    assert resp.status_code == 400
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_wallet_read_endpoints(async_client, sample_user1):
+    await init_db()
+    user = await async_client.post(url=CREATE_USER,
+                                   content=sample_user1.json())
+    user_id = user.json()['user_id']
+    for amount in ('1.10', '2.20', '3.30'):
+        await async_client.post(
+            url=DEPOSIT_MONEY,
+            content=DepositRequest(user_id=user_id, amount=amount).json())
+    resp = await async_client.get(url=f'/wallets/{user_id}/balance')
+    assert resp.status_code == 200
+    assert resp.json() == {'user_id': user_id,
+                           'wallet_id': user.json()['wallet_id'],
+                           'balance': '6.60'}
+    resp = await async_client.get(url=f'/wallets/{user_id}/transactions',
+                                  params={'limit': 2, 'type': 'debit'})
+    assert resp.status_code == 200
+    assert [item['amount'] for item in resp.json()['items']] == \
+        ['3.30', '2.20']
+    resp = await async_client.get(
+        url=f'/wallets/{user_id}/transactions',
+        params={'limit': 2, 'cursor': resp.json()['next_cursor']})
+    assert [item['amount'] for item in resp.json()['items']] == ['1.10']
+    assert resp.json()['next_cursor'] is None
+    resp = await async_client.get(url=f'/wallets/{user_id}/transactions',
+                                  params={'cursor': 'abc'})
+    assert resp.status_code == 400
+    resp = await async_client.get(url=f'/wallets/{user_id}/transactions',
+                                  params={'limit': 0})
+    assert resp.status_code == 400
+    resp = await async_client.get(url='/wallets/-1/balance')
+    assert resp.status_code == 404
+    await database.disconnect()
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import runpy
+import uuid
+from decimal import Decimal
+
+import pytest
+import uvicorn
+from httpx import AsyncClient
+
+from src.main import app as app_module, engine as engine_module, fast_path
+from src.main.engine import PostgresEngine, MemoryEngine, WriteAheadLog
+from src.main.idempotency import IdempotencyKeyReused
+from src.main.model import Transaction
+from src.main.settings import settings
+from src.main.utils.constants import TEST_URL, CREATE_USER, \
+    DEPOSIT_MONEY, TRANSFERS_BATCH, WALLET_BALANCE
+
+
+@pytest.fixture(params=['postgres', 'memory'])
+async def engine(request):
+    engine = PostgresEngine() if request.param == 'postgres' \
+        else MemoryEngine()
+    await engine.connect()
+    yield engine
+    await engine.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_deposit_and_transfer(engine, sample_user1, sample_user2):
+    user1 = await engine.create_user(request=sample_user1)
+    user2 = await engine.create_user(request=sample_user2)
+    assert user1.first_name == sample_user1.first_name
+    assert user1.wallet_id != user2.wallet_id
+    deposit = await engine.create_transaction(to_user_id=user1.user_id,
+                                              amount='10.5')
+    assert deposit.credit_transaction_id is None
+    transfer = await engine.create_transaction(to_user_id=user2.user_id,
+                                               amount='4',
+                                               from_user_id=user1.user_id)
+    assert transfer.debit_transaction_id > deposit.debit_transaction_id
+    assert transfer.credit_transaction_id > transfer.debit_transaction_id
+    wallet1 = await engine.get_wallet(user_id=user1.user_id)
+    wallet2 = await engine.get_wallet(user_id=user2.user_id)
+    assert wallet1['id'] == user1.wallet_id
+    assert wallet1['balance'] == Decimal('6.5')
+    assert wallet2['balance'] == Decimal('4')
+
+
+@pytest.mark.asyncio
+async def test_invalid_operations(engine, sample_user1, sample_user2):
+    user1 = await engine.create_user(request=sample_user1)
+    user2 = await engine.create_user(request=sample_user2)
+    with pytest.raises(ValueError, match='Amount should be positive'):
+        await engine.create_transaction(to_user_id=user1.user_id,
+                                        amount='0')
+    with pytest.raises(ValueError, match='same user'):
+        await engine.create_transaction(to_user_id=user1.user_id,
+                                        amount='1',
+                                        from_user_id=user1.user_id)
+    with pytest.raises(ValueError, match='Cannot find wallet of user -1'):
+        await engine.create_transaction(to_user_id=-1, amount='1')
+    with pytest.raises(ValueError, match='Not enough money'):
+        await engine.create_transaction(to_user_id=user2.user_id,
+                                        amount='1',
+                                        from_user_id=user1.user_id)
+    assert await engine.get_wallet(user_id=-1) is None
+    wallet1 = await engine.get_wallet(user_id=user1.user_id)
+    assert wallet1['balance'] == 0
+
+
+@pytest.mark.asyncio
+async def test_idempotency_key(engine, sample_user1):
+    user = await engine.create_user(request=sample_user1)
+    key = str(uuid.uuid4())
+    first = await engine.create_transaction(to_user_id=user.user_id,
+                                            amount='2', idempotency_key=key)
+    second = await engine.create_transaction(to_user_id=user.user_id,
+                                             amount='2', idempotency_key=key)
+    assert first == second
+    with pytest.raises(IdempotencyKeyReused):
+        await engine.create_transaction(to_user_id=user.user_id, amount='3',
+                                        idempotency_key=key)
+    assert (await engine.get_wallet(user_id=user.user_id))['balance'] == 2
+
+
+@pytest.mark.asyncio
+async def test_memory_engine_concurrent_transfers(sample_user1,
+                                                  sample_user2, tmp_path):
+    # Tests share one connection to the database, so only the memory engine
+    # runs operations concurrently here
+    engine = MemoryEngine(data_dir=str(tmp_path))
+    await engine.connect()
+    user1 = await engine.create_user(request=sample_user1)
+    user2 = await engine.create_user(request=sample_user2)
+    await engine.create_transaction(to_user_id=user1.user_id, amount='10')
+    results = await asyncio.gather(
+        *[engine.create_transaction(to_user_id=user2.user_id, amount='1',
+                                    from_user_id=user1.user_id)
+          for _ in range(15)],
+        return_exceptions=True)
+    assert sum(not isinstance(r, Exception) for r in results) == 10
+    wallet1 = await engine.get_wallet(user_id=user1.user_id)
+    wallet2 = await engine.get_wallet(user_id=user2.user_id)
+    assert wallet1['balance'] == 0
+    assert wallet2['balance'] == 10
+    await engine.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_memory_engine_recovers_from_log(sample_user1, sample_user2,
+                                               tmp_path):
+    engine = MemoryEngine(data_dir=str(tmp_path))
+    await engine.connect()
+    user1 = await engine.create_user(request=sample_user1)
+    user2 = await engine.create_user(request=sample_user2)
+    await engine.create_transaction(to_user_id=user1.user_id, amount='7')
+    transfer = await engine.create_transaction(
+        to_user_id=user2.user_id, amount='2.5', from_user_id=user1.user_id,
+        idempotency_key='transfer-1')
+    path = engine.wal.path
+    await engine.disconnect()
+    # A record cut by a crash is ignored
+    with open(path, 'a') as file:
+        file.write('["t", 1, null, "100"')
+    recovered = MemoryEngine(data_dir=str(tmp_path))
+    await recovered.connect()
+    assert (await recovered.get_wallet(user_id=user1.user_id))['balance'] \
+        == Decimal('4.5')
+    assert (await recovered.get_wallet(user_id=user2.user_id))['balance'] \
+        == Decimal('2.5')
+    assert await recovered.create_transaction(
+        to_user_id=user2.user_id, amount='2.5', from_user_id=user1.user_id,
+        idempotency_key='transfer-1') == transfer
+    next_deposit = await recovered.create_transaction(
+        to_user_id=user2.user_id, amount='1')
+    assert next_deposit.debit_transaction_id == 4
+    await recovered.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_memory_engine_recovers_from_snapshot(sample_user1, tmp_path):
+    engine = MemoryEngine(data_dir=str(tmp_path), snapshot_every=5)
+    await engine.connect()
+    user = await engine.create_user(request=sample_user1)
+    for _ in range(12):
+        await engine.create_transaction(to_user_id=user.user_id, amount='1')
+    await engine.disconnect()
+    files = sorted(os.listdir(tmp_path))
+    assert sum(name.startswith('snapshot-') for name in files) == 1
+    assert len(files) == 2
+    recovered = MemoryEngine(data_dir=str(tmp_path))
+    await recovered.connect()
+    assert (await recovered.get_wallet(user_id=user.user_id))['balance'] \
+        == 12
+    assert len(recovered.ledger_wallet_ids) == 12
+    await recovered.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_memory_engine_rolls_back_when_log_fails(monkeypatch,
+                                                       sample_user1,
+                                                       sample_user2,
+                                                       tmp_path):
+    engine = MemoryEngine(data_dir=str(tmp_path))
+    await engine.connect()
+    user1 = await engine.create_user(request=sample_user1)
+    await engine.create_transaction(to_user_id=user1.user_id, amount='5')
+
+    def fail(data):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(engine.wal, '_write', fail)
+    results = await asyncio.gather(
+        engine.create_user(request=sample_user2),
+        engine.create_transaction(to_user_id=user1.user_id, amount='1',
+                                  idempotency_key='deposit-1'),
+        engine.create_transaction(to_user_id=2, amount='1',
+                                  from_user_id=user1.user_id),
+        return_exceptions=True)
+    assert all(isinstance(result, OSError) for result in results)
+    # The log fails every later record, nothing becomes visible
+    with pytest.raises(OSError):
+        await engine.create_transaction(to_user_id=user1.user_id,
+                                        amount='1')
+    assert (await engine.get_wallet(user_id=user1.user_id))['balance'] == 5
+    assert await engine.get_wallet(user_id=2) is None
+    assert len(engine.ledger_wallet_ids) == 1
+    assert 'deposit-1' not in engine.idempotency_keys
+    await engine.disconnect()
+
+
+def test_reused_idempotency_key_becomes_newest(monkeypatch):
+    monkeypatch.setattr(settings, 'idempotency_key_ttl', 10)
+    engine = MemoryEngine()
+    result = Transaction(debit_transaction_id=1)
+    engine._add_idempotency_key('a', 'op', result, 100)
+    engine._add_idempotency_key('b', 'op', result, 105)
+    engine._add_idempotency_key('a', 'op', result, 112)
+    # b is the oldest key now and expires first
+    engine._add_idempotency_key('c', 'op', result, 116)
+    assert list(engine.idempotency_keys) == ['a', 'c']
+
+
+@pytest.mark.asyncio
+async def test_memory_engine_serves_its_own_routes_only(monkeypatch,
+                                                        sample_user1):
+    engine = MemoryEngine()
+    await engine.connect()
+    monkeypatch.setattr(app_module, 'engine', engine)
+    monkeypatch.setattr(app_module.app.router, 'routes',
+                        list(app_module.app.router.routes))
+    app_module.unregister_database_routes()
+    async with AsyncClient(app=app_module.app, base_url=TEST_URL) as ac:
+        user = (await ac.post(CREATE_USER,
+                              content=sample_user1.json())).json()
+        await ac.post(DEPOSIT_MONEY,
+                      json={'user_id': user['user_id'], 'amount': '3'})
+        response = await ac.get(
+            WALLET_BALANCE.format(user_id=user['user_id']))
+        assert response.json()['balance'] == '3'
+        response = await ac.post(TRANSFERS_BATCH, json={'items': []})
+        assert response.status_code == 404
+    await engine.disconnect()
+
+
+# runpy warns that the module is imported already, it's executed again
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_memory_engine_started_directly_has_no_database_routes(
+        monkeypatch):
+    served = []
+    monkeypatch.setattr(engine_module, 'engine', MemoryEngine())
+    # Executing the module again registers its fast routes again
+    monkeypatch.setattr(fast_path, 'routes', dict(fast_path.routes))
+    monkeypatch.setattr(uvicorn, 'run', lambda app, **kwargs: served.extend(
+        getattr(route, 'path', None) for route in app.router.routes))
+    runpy.run_module('src.main.app', run_name='__main__')
+    assert CREATE_USER in served
+    assert TRANSFERS_BATCH not in served
+
+
+def test_write_ahead_log_skips_partial_record(tmp_path):
+    path = os.path.join(tmp_path, 'wal-00000001.log')
+    with open(path, 'w') as file:
+        file.write('["u", "a", "b"]\n["u", "c"')
+    assert WriteAheadLog.read(path) == [['u', 'a', 'b']]
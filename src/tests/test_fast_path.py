@@ -0,0 +1,73 @@
+import pytest
+from httpx import AsyncClient
+
+from src.main import fast_path
+from src.main.app import app
+from src.main.crud import create_user, get_balance
+from src.main.fast_path import parse
+from src.main.model import DepositRequest, TransferRequest
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import TEST_URL, DEPOSIT_MONEY, \
+    TRANSFER_MONEY, YES, NO
+
+
+def test_only_bodies_of_expected_shape_are_parsed():
+    request = parse(TransferRequest,
+                    b'{"from_user_id": 1, "to_user_id": 2, "amount": "1.5"}')
+    assert (request.from_user_id, request.to_user_id) == (1, 2)
+    assert request.amount == '1.5' and request.amount.value == 1.5
+    for body in (b'{"user_id": "1", "amount": "1"}',
+                 b'{"user_id": true, "amount": "1"}',
+                 b'{"user_id": 1, "amount": 1}',
+                 b'{"user_id": 1, "amount": "-1"}',
+                 b'{"user_id": 1, "amount": "NaN"}',
+                 b'{"user_id": 1}', b'[]', b'{'):
+        assert parse(DepositRequest, body) is None
+
+
+@pytest.mark.asyncio
+async def test_fast_path_answers_like_regular_one(monkeypatch, sample_user1,
+                                                  sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    requests = [
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': '10'}, {}),
+        (TRANSFER_MONEY, {'from_user_id': user1.user_id,
+                          'to_user_id': user2.user_id, 'amount': '2'}, {}),
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': 'x'}, {}),
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': '0'}, {}),
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': '1'},
+         {'idempotency-key': 'fast-path'}),
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': '2'},
+         {'idempotency-key': 'fast-path'}),
+        (DEPOSIT_MONEY, {'user_id': user1.user_id, 'amount': '1'},
+         {'idempotency-key': 'k' * 256}),
+    ]
+    parsed = []
+
+    def spy(model, body):
+        request = parse(model, body)
+        parsed.append(request is not None)
+        return request
+
+    monkeypatch.setattr(fast_path, 'parse', spy)
+    answers = {}
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        for mode in (NO, YES):
+            monkeypatch.setattr(settings, 'fast_path', mode)
+            answers[mode] = []
+            for path, body, headers in requests:
+                response = await ac.post(path, json=body, headers=headers)
+                answers[mode].append(
+                    (response.status_code,
+                     response.headers['content-type'],
+                     sorted(response.json()) if response.status_code == 200
+                     else response.text))
+    assert answers[YES] == answers[NO]
+    # Unexpected bodies and too long keys go the regular way
+    assert parsed == [True, True, False, False, True, True]
+    assert [status for status, _, _ in answers[YES]] == \
+        [200, 200, 400, 400, 200, 422, 400]
+    assert (await get_balance(user_id=user1.user_id)).balance == 17
+    await database.disconnect()
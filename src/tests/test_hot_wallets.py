@@ -0,0 +1,128 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import select
+
+from src.main.crud import create_user, create_transaction, get_wallet, \
+    create_transactions_batch
+from src.main.hot_wallets import make_wallet_hot
+from src.main.model import HotWalletRequest, TransferRequest, wallets, \
+    wallet_slots, BatchItemStatus
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import YES
+
+
+async def slot_balances(wallet_id):
+    query = (select([wallet_slots.c.balance])
+             .where(wallet_slots.c.wallet_id == wallet_id)
+             .order_by(wallet_slots.c.slot))
+    return [row['balance'] for row in await database.fetch_all(query)]
+
+
+async def base_balance(wallet_id):
+    query = select([wallets.c.balance]).where(wallets.c.id == wallet_id)
+    return await database.fetch_val(query)
+
+
+@pytest.mark.asyncio
+async def test_deposits_go_to_slots(sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    await create_transaction(to_user_id=user.user_id, amount='5')
+    hot = await make_wallet_hot(
+        request=HotWalletRequest(user_id=user.user_id, slots=4))
+    assert hot.wallet_id == user.wallet_id
+    for _ in range(10):
+        await create_transaction(to_user_id=user.user_id, amount='1')
+    assert await base_balance(user.wallet_id) == Decimal('5')
+    assert sum(await slot_balances(user.wallet_id)) == Decimal('10')
+    wallet = await get_wallet(user_id=user.user_id)
+    assert wallet['balance'] == Decimal('15')
+    assert wallet['slots'] == 4
+    with pytest.raises(ValueError, match='Cannot decrease number of slots'):
+        await make_wallet_hot(
+            request=HotWalletRequest(user_id=user.user_id, slots=2))
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_single_statement_falls_back_for_hot_wallet(monkeypatch,
+                                                          sample_user1):
+    monkeypatch.setattr(settings, 'single_statement', YES)
+    await init_db()
+    user = await create_user(request=sample_user1)
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=user.user_id, slots=2))
+    transaction = await create_transaction(to_user_id=user.user_id,
+                                           amount='3')
+    assert transaction.debit_transaction_id is not None
+    assert sum(await slot_balances(user.wallet_id)) == Decimal('3')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_transfer_from_hot_wallet(sample_user1, sample_user2):
+    await init_db()
+    hot_user = await create_user(request=sample_user1)
+    user = await create_user(request=sample_user2)
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=hot_user.user_id, slots=1))
+    await create_transaction(to_user_id=hot_user.user_id, amount='10')
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=hot_user.user_id, slots=3))
+    # Enough money in the only funded slot or, after that, only in all
+    # the slots together
+    await create_transaction(to_user_id=user.user_id,
+                             from_user_id=hot_user.user_id, amount='4')
+    await create_transaction(to_user_id=user.user_id,
+                             from_user_id=hot_user.user_id, amount='5')
+    assert await slot_balances(hot_user.wallet_id) == [
+        Decimal('1'), Decimal('0'), Decimal('0')]
+    with pytest.raises(ValueError, match=r'Balance 1. Amount 2'):
+        await create_transaction(to_user_id=user.user_id,
+                                 from_user_id=hot_user.user_id, amount='2')
+    hot_wallet = await get_wallet(user_id=hot_user.user_id)
+    wallet = await get_wallet(user_id=user.user_id)
+    assert hot_wallet['balance'] == Decimal('1')
+    assert wallet['balance'] == Decimal('9')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_slow_debit_spreads_balance(sample_user1, sample_user2):
+    await init_db()
+    hot_user = await create_user(request=sample_user1)
+    user = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=hot_user.user_id, amount='10.01')
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=hot_user.user_id, slots=3))
+    await create_transaction(to_user_id=user.user_id,
+                             from_user_id=hot_user.user_id, amount='3')
+    assert await base_balance(hot_user.wallet_id) == Decimal('0')
+    assert await slot_balances(hot_user.wallet_id) == [
+        Decimal('2.35'), Decimal('2.33'), Decimal('2.33')]
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_batch_from_hot_wallet(sample_user1, sample_user2):
+    await init_db()
+    hot_user = await create_user(request=sample_user1)
+    user = await create_user(request=sample_user2)
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=hot_user.user_id, slots=4))
+    for _ in range(4):
+        await create_transaction(to_user_id=hot_user.user_id, amount='2')
+    batch = await create_transactions_batch(items=[
+        TransferRequest(from_user_id=hot_user.user_id,
+                        to_user_id=user.user_id, amount='7'),
+        TransferRequest(from_user_id=user.user_id,
+                        to_user_id=hot_user.user_id, amount='1'),
+    ])
+    assert [r.status for r in batch.results] == [BatchItemStatus.applied] * 2
+    assert sum(await slot_balances(hot_user.wallet_id)) == Decimal('0')
+    hot_wallet = await get_wallet(user_id=hot_user.user_id)
+    wallet = await get_wallet(user_id=user.user_id)
+    assert hot_wallet['balance'] == Decimal('2')
+    assert wallet['balance'] == Decimal('6')
+    await database.disconnect()
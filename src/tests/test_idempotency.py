@@ -0,0 +1,121 @@
+import time
+import uuid
+
+import pytest
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.cache import TTLCache
+from src.main.crud import create_user, create_transaction, get_wallet
+from src.main.idempotency import IdempotencyKeyReused, idempotency_cache, \
+    expire_idempotency_keys, get_stored
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import CREATE_USER, DEPOSIT_MONEY, TEST_URL, \
+    TRANSFER_MONEY
+
+
+@pytest.mark.asyncio
+async def test_repeated_key_returns_original_transaction(sample_user1,
+                                                         sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='10')
+    key = str(uuid.uuid4())
+    first = await create_transaction(to_user_id=user2.user_id, amount='3',
+                                     from_user_id=user1.user_id,
+                                     idempotency_key=key)
+    # Served by the database once the cache doesn't have it
+    idempotency_cache.clear()
+    second = await create_transaction(to_user_id=user2.user_id, amount='3.0',
+                                      from_user_id=user1.user_id,
+                                      idempotency_key=key)
+    hits = idempotency_cache.hits
+    third = await create_transaction(to_user_id=user2.user_id, amount='3',
+                                     from_user_id=user1.user_id,
+                                     idempotency_key=key)
+    assert first == second == third
+    assert idempotency_cache.hits == hits + 1
+    assert (await get_wallet(user_id=user1.user_id))['balance'] == 7
+    assert (await get_wallet(user_id=user2.user_id))['balance'] == 3
+    with pytest.raises(IdempotencyKeyReused):
+        await create_transaction(to_user_id=user2.user_id, amount='4',
+                                 from_user_id=user1.user_id,
+                                 idempotency_key=key)
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_failed_operation_does_not_store_key(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    key = str(uuid.uuid4())
+    with pytest.raises(ValueError, match='Not enough money'):
+        await create_transaction(to_user_id=user2.user_id, amount='1',
+                                 from_user_id=user1.user_id,
+                                 idempotency_key=key)
+    assert await get_stored(key) is None
+    await create_transaction(to_user_id=user1.user_id, amount='1')
+    transfer = await create_transaction(to_user_id=user2.user_id, amount='1',
+                                        from_user_id=user1.user_id,
+                                        idempotency_key=key)
+    assert transfer.credit_transaction_id is not None
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_expired_keys_are_deleted_in_batches(sample_user1, monkeypatch):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    keys = [str(uuid.uuid4()) for _ in range(5)]
+    for key in keys:
+        await create_transaction(to_user_id=user.user_id, amount='1',
+                                 idempotency_key=key)
+    await database.execute(
+        "UPDATE public.idempotency_keys "
+        "SET created_at = created_at - interval '2 days'")
+    monkeypatch.setattr(settings, 'idempotency_key_ttl', 86400)
+    monkeypatch.setattr(settings, 'idempotency_expiry_batch_size', 2)
+    assert await expire_idempotency_keys() >= 5
+    for key in keys:
+        assert await get_stored(key) is None
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_idempotency_key_header(sample_user1, sample_user2):
+    await init_db()
+    key = str(uuid.uuid4())
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        user1 = (await ac.post(CREATE_USER, json=sample_user1.dict())).json()
+        user2 = (await ac.post(CREATE_USER, json=sample_user2.dict())).json()
+        deposit = {'user_id': user1['user_id'], 'amount': '5'}
+        responses = [await ac.post(DEPOSIT_MONEY, json=deposit,
+                                   headers={'Idempotency-Key': key})
+                     for _ in range(2)]
+        assert [r.status_code for r in responses] == [200, 200]
+        assert responses[0].json() == responses[1].json()
+        response = await ac.post(TRANSFER_MONEY,
+                                 json={'from_user_id': user1['user_id'],
+                                       'to_user_id': user2['user_id'],
+                                       'amount': '5'},
+                                 headers={'Idempotency-Key': key})
+        assert response.status_code == 422
+    assert (await get_wallet(user_id=user1['user_id']))['balance'] == 5
+    await database.disconnect()
+
+
+def test_ttl_cache_evicts_least_recently_used_and_expired():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    cache.ttl = 0
+    cache.set('d', 4)
+    time.sleep(0.001)
+    assert cache.get('d') is None
+    assert len(cache) == 1
@@ -0,0 +1,60 @@
+import pytest
+
+from src.main import settings as settings_module
+from src.main.crud import create_user, create_transaction, get_wallet, \
+    warm_up_statements
+from src.main.launcher import pool_size, worker_environment, \
+    restart_delay, RESTART_DELAY_MIN, RESTART_DELAY_MAX, WORKER_STABLE_AFTER
+from src.main.settings import database, init_db, settings, warm_up_pool
+from src.main.utils.constants import NO, YES
+
+
+def test_connection_budget_is_divided_between_workers():
+    assert pool_size(connections=80, workers=3) == 26
+    with pytest.raises(ValueError):
+        pool_size(connections=2, workers=3)
+    assert worker_environment(0, 26)['BACKGROUND_TASKS'] == YES
+    assert worker_environment(1, 26) == {
+        'POOL_MIN': '26', 'POOL_MAX': '26', 'RUN_MIGRATIONS': NO,
+        'BACKGROUND_TASKS': NO}
+
+
+def test_replica_pools_and_metrics_ports_are_per_worker():
+    # Every worker has a pool of the primary and one of each replica
+    assert pool_size(connections=80, workers=4, replicas=1) == 10
+    with pytest.raises(ValueError):
+        pool_size(connections=5, workers=3, replicas=1)
+    environment = worker_environment(2, 10, replicas=1, metrics_port=9100)
+    assert environment['REPLICA_POOL_MIN'] == '10'
+    assert environment['REPLICA_POOL_MAX'] == '10'
+    assert environment['METRICS_PORT'] == '9102'
+    assert 'METRICS_PORT' not in worker_environment(2, 10)
+
+
+def test_restarts_of_crashing_workers_back_off():
+    delay = restart_delay(0, uptime=0)
+    assert delay == RESTART_DELAY_MIN
+    delays = []
+    for _ in range(20):
+        delay = restart_delay(delay, uptime=0.1)
+        delays.append(delay)
+    assert delays[0] == 2 * RESTART_DELAY_MIN
+    assert delays[-1] == RESTART_DELAY_MAX
+    # A worker which ran for a while starts over
+    assert restart_delay(delay, WORKER_STABLE_AFTER) == RESTART_DELAY_MIN
+
+
+@pytest.mark.asyncio
+async def test_workers_start_without_ddl(monkeypatch, sample_user1):
+    async def create_schema():
+        raise AssertionError('Schema created by a worker')
+
+    monkeypatch.setattr(settings, 'run_migrations', NO)
+    monkeypatch.setattr(settings_module, 'create_schema', create_schema)
+    await init_db()
+    # Tests share one connection, so the pool has a single one to warm up
+    await warm_up_pool(connections=1, statements=warm_up_statements())
+    user = await create_user(request=sample_user1)
+    await create_transaction(to_user_id=user.user_id, amount='2')
+    assert (await get_wallet(user_id=user.user_id))['balance'] == 2
+    await database.disconnect()
@@ -0,0 +1,136 @@
+import csv
+import gzip
+import os
+from datetime import date, datetime
+
+import pytest
+
+from src.main.crud import create_user, create_transaction
+from src.main.ledger import ensure_partitions, cold_partitions, \
+    archive_partition, export_partition
+from src.main.migrations import partition_ledger
+from src.main.settings import database, init_db
+from src.main.utils.constants import LEDGER_LAYOUT, PARTITIONED, \
+    LEDGER_PARTITIONS, CREATE_TRANSACTION_PARTITIONS_FROM
+
+# Layout of the ledger before it was partitioned
+LEGACY_TRANSACTIONS = """
+    CREATE TABLE public.transactions
+    (
+        id serial PRIMARY KEY,
+        wallet_id bigint NOT NULL REFERENCES public.wallets (id),
+        type varchar(32) NOT NULL,
+        amount numeric NOT NULL,
+        transaction_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+INSERT_AT = """
+    INSERT INTO public.transactions (wallet_id, type, amount,
+                                     transaction_timestamp)
+    VALUES (:wallet_id, 'debit', 1, :ts)
+    RETURNING id
+"""
+
+PARTITION_OF = """
+    SELECT tableoid::regclass::text FROM public.transactions WHERE id = :id
+"""
+
+
+async def partitions():
+    return {row['name'] for row in await database.fetch_all(LEDGER_PARTITIONS)}
+
+
+@pytest.mark.asyncio
+async def test_partitions_are_created_ahead(sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    deposit = await create_transaction(to_user_id=user.user_id, amount='1')
+    month = date.today().strftime('%Y_%m')
+    assert f'transactions_p{month}' in await partitions()
+    assert await database.fetch_val(
+        query=PARTITION_OF,
+        values={'id': deposit.debit_transaction_id}) == \
+        f'transactions_p{month}'
+    # A row outside of existing partitions lands in the default one and is
+    # moved once its partition is created
+    future = datetime(date.today().year + 3, 1, 15)
+    row_id = await database.fetch_val(
+        query=INSERT_AT, values={'wallet_id': user.wallet_id, 'ts': future})
+    assert await database.fetch_val(query=PARTITION_OF,
+                                    values={'id': row_id}) == \
+        'transactions_default'
+    created = await ensure_partitions(months_ahead=40)
+    assert f'transactions_p{future.year}_01' in created
+    assert await database.fetch_val(query=PARTITION_OF,
+                                    values={'id': row_id}) == \
+        f'transactions_p{future.year}_01'
+    assert await ensure_partitions(months_ahead=40) == []
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_cold_partitions_are_archived_and_exported(monkeypatch,
+                                                         sample_user1,
+                                                         tmp_path):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    await database.fetch_all(query=CREATE_TRANSACTION_PARTITIONS_FROM,
+                             values={'months_ahead': 0,
+                                     'from_date': date(2001, 1, 1)})
+    old_ids = []
+    for ts in (datetime(2001, 1, 10), datetime(2001, 2, 10)):
+        old_ids.append(await database.fetch_val(
+            query=INSERT_AT, values={'wallet_id': user.wallet_id, 'ts': ts}))
+    assert await cold_partitions(before=date(2001, 2, 1)) == \
+        ['transactions_p2001_01']
+    await archive_partition('transactions_p2001_01')
+    assert await database.fetch_val(
+        'SELECT count(*) FROM public.transactions_archive') >= 1
+    assert await database.fetch_val(query=PARTITION_OF,
+                                    values={'id': old_ids[0]}) is None
+
+    # A failed export leaves the partition in the ledger and no file
+    def fail(fd):
+        raise OSError('No space left on device')
+
+    with monkeypatch.context() as patched, pytest.raises(OSError):
+        patched.setattr(os, 'fsync', fail)
+        await export_partition('transactions_p2001_02', str(tmp_path))
+    assert 'transactions_p2001_02' in await partitions()
+    assert os.listdir(tmp_path) == []
+    path = await export_partition('transactions_p2001_02', str(tmp_path))
+    with gzip.open(path, 'rt') as file:
+        rows = list(csv.DictReader(file))
+    assert [int(row['id']) for row in rows] == old_ids[1:]
+    assert 'transactions_p2001_02' not in await partitions()
+    with pytest.raises(ValueError):
+        await archive_partition('transactions_default')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_single_table_ledger_is_migrated(sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    # Everything is rolled back when the test disconnects
+    await database.execute('DROP TABLE public.transactions')
+    await database.execute(LEGACY_TRANSACTIONS)
+    old_id = await database.fetch_val(
+        query=INSERT_AT,
+        values={'wallet_id': user.wallet_id, 'ts': datetime(2002, 5, 5)})
+    deposit = await create_transaction(to_user_id=user.user_id, amount='1')
+    assert await database.fetch_val(LEDGER_LAYOUT) != PARTITIONED
+    assert await partition_ledger() is True
+    assert await database.fetch_val(LEDGER_LAYOUT) == PARTITIONED
+    assert await database.fetch_val(query=PARTITION_OF,
+                                    values={'id': old_id}) == \
+        'transactions_p2002_05'
+    assert await database.fetch_val(
+        query=PARTITION_OF, values={'id': deposit.debit_transaction_id}) == \
+        f'transactions_p{date.today().strftime("%Y_%m")}'
+    next_deposit = await create_transaction(to_user_id=user.user_id,
+                                            amount='1')
+    assert next_deposit.debit_transaction_id > deposit.debit_transaction_id
+    assert await partition_ledger() is False
+    await database.disconnect()
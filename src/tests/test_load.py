@@ -0,0 +1,41 @@
+import pytest
+
+from src.benchmarks.load import build_parser, run_load, regressions, \
+    opening_balances, in_process_client
+from src.main.app import app
+from src.main.settings import database, init_db
+
+
+@pytest.mark.asyncio
+async def test_load_conserves_money():
+    await init_db()
+    # Tests share one database connection, hence a single client
+    args = build_parser().parse_args(
+        ['--users', '5', '--operations', '40', '--concurrency', '1',
+         '--balance', '3', '--balance-distribution', 'zipf'])
+    async with in_process_client(app) as ac:
+        report = await run_load(ac, args)
+    assert report['users'] == 5
+    assert report['operations'] == 40
+    assert report['error_rate'] == 0
+    assert report['conservation']['ok'] is True
+    assert set(report['latency_ms']) == {'p50', 'p95', 'p99', 'p999'}
+    await database.disconnect()
+
+
+def test_regressions_against_baseline():
+    baseline = {'ops_per_sec': 100, 'latency_ms': {'p50': 10, 'p99': 50},
+                'error_rate': 0, 'conservation': {'ok': True}}
+    report = {'ops_per_sec': 95, 'latency_ms': {'p50': 10.5, 'p99': 80},
+              'error_rate': 0.0005, 'conservation': {'ok': True}}
+    assert regressions(report, baseline, tolerance=0.1) == \
+        ['p99 80 ms > baseline 50 ms']
+    report['conservation']['ok'] = False
+    assert 'money was not conserved' in \
+        regressions(report, baseline, tolerance=0.1)
+
+
+def test_zipf_balances_are_skewed():
+    balances = opening_balances(100, 'zipf', balance=1000, skew=1.0)
+    assert balances[0] > 10 * balances[-1]
+    assert abs(sum(balances) - 100 * 1000) < 100
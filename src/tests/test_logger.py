@@ -0,0 +1,47 @@
+import io
+import json
+import logging
+import sys
+
+from src.main.utils.logger import get_console_logger, configure_logging, \
+    flush_logs, SamplingFilter, TEXT, JSON
+
+
+def test_logger_is_configured_once():
+    output = io.StringIO()
+    configure_logging(level='INFO', levels={'test.debug': 'DEBUG'},
+                      format_=JSON, stream=output)
+    try:
+        logger = get_console_logger('test.once')
+        assert get_console_logger('test.once').handlers == logger.handlers
+        assert len(logger.handlers) == 1
+        logger.info('written once')
+        logger.debug('not written')
+        get_console_logger('test.debug').debug('written')
+        flush_logs()
+        entries = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [entry['message'] for entry in entries] == \
+            ['written once', 'written']
+        assert entries[0]['level'] == 'INFO'
+    finally:
+        configure_logging(format_=TEXT, stream=sys.stderr)
+
+
+def test_records_of_a_call_site_are_sampled():
+    sampling = SamplingFilter(first=3, every=10)
+    record = logging.LogRecord('test', logging.INFO, 'test.py', 1,
+                               'message', None, None)
+    passed = [i for i in range(1, 31) if sampling.filter(record)]
+    assert passed == [1, 2, 3, 13, 23]
+    # Other call sites are counted on their own
+    other = logging.LogRecord('test', logging.INFO, 'test.py', 2,
+                              'message', None, None)
+    assert sampling.filter(other)
+    # Warnings and errors are never dropped
+    error = logging.LogRecord('test', logging.ERROR, 'test.py', 3,
+                              'message', None, None)
+    assert all(sampling.filter(error) for _ in range(30))
+    # Counts of a second are dropped when the next one starts
+    record.created += 1
+    assert sampling.filter(record)
+    assert list(sampling._counts) == [('test.py', 1)]
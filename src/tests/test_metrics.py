@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main import metrics
+from src.main.metrics import Counter, Histogram, Metric, REGISTRY, \
+    REJECTIONS, MetricsServer
+from src.main.settings import database, init_db
+from src.main.utils.constants import CREATE_USER, TEST_URL, DEPOSIT_MONEY, \
+    TRANSFER_MONEY, METRICS, WALLET_BALANCE
+
+
+def test_histogram_and_counter_rendering():
+    histogram = Histogram('test_seconds', 'Test histogram', ('stage',),
+                          buckets=(0.1, 1))
+    counter = Counter('test_total', 'Test counter', ('reason',))
+    REGISTRY.remove(histogram)
+    REGISTRY.remove(counter)
+    child = histogram.labels('a"b')
+    for value in (0.05, 0.1, 0.5, 3):
+        child.observe(value)
+    counter.labels('x').inc()
+    counter.labels('x').inc(2)
+    assert histogram.render().splitlines() == [
+        '# HELP test_seconds Test histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="a\\"b",le="0.1"} 2',
+        'test_seconds_bucket{stage="a\\"b",le="1"} 3',
+        'test_seconds_bucket{stage="a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{stage="a\\"b"} 3.65',
+        'test_seconds_count{stage="a\\"b"} 4',
+    ]
+    assert counter.render().splitlines()[-1] == 'test_total{reason="x"} 3.0'
+
+
+def test_pool_is_resolved_once_per_render(monkeypatch):
+    with pytest.raises(TypeError):
+        Metric('test_abstract', 'Not a metric')
+    lookups = []
+    monkeypatch.setattr(metrics, 'asyncpg_pool',
+                        lambda database_: lookups.append(database_))
+    text = metrics.render()
+    assert lookups == [database]
+    assert 'db_pool_max 0\n' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(sample_user1, sample_user2):
+    await init_db()
+    rejected = REJECTIONS.labels('insufficient_funds').value
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        user1 = (await ac.post(CREATE_USER, json=sample_user1.dict())).json()
+        user2 = (await ac.post(CREATE_USER, json=sample_user2.dict())).json()
+        await ac.post(DEPOSIT_MONEY,
+                      json={'user_id': user1['user_id'], 'amount': '1'})
+        await ac.get(WALLET_BALANCE.format(user_id=user1['user_id']))
+        with pytest.raises(ValueError):
+            await ac.post(TRANSFER_MONEY,
+                          json={'from_user_id': user1['user_id'],
+                                'to_user_id': user2['user_id'],
+                                'amount': '5'})
+        response = await ac.get(METRICS)
+    assert response.status_code == 200
+    text = response.text
+    assert 'http_request_duration_seconds_count' \
+           '{method="GET",path="/wallets/{user_id}/balance"}' in text
+    assert 'http_requests_total' \
+           '{method="POST",path="/deposit_money/",status="200"}' in text
+    for stage in ('validation', 'pool_wait', 'lock_wait', 'insert', 'update',
+                  'commit'):
+        assert f'stage_duration_seconds_count{{stage="{stage}"}}' in text
+    assert 'db_pool_in_use ' in text
+    assert REJECTIONS.labels('insufficient_funds').value == rejected + 1
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_metrics_server_serves_own_port():
+    server = MetricsServer()
+    await server.start(host='127.0.0.1', port=0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = (await reader.read()).decode()
+    writer.close()
+    await server.stop()
+    assert response.startswith('HTTP/1.1 200 OK')
+    assert '# TYPE http_requests_total counter' in response
+    assert server.port is None
@@ -0,0 +1,99 @@
+from decimal import Decimal
+
+import pytest
+from pydantic import ValidationError
+
+from src.main.crud import create_user, create_transaction, get_balance, \
+    create_transactions_batch, get_transactions_page
+from src.main.hot_wallets import make_wallet_hot
+from src.main.migrations import money_minor_units
+from src.main.model import DepositRequest, TransferRequest, BatchItemStatus, \
+    HotWalletRequest
+from src.main.money import to_minor_units, to_decimal
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import MONEY_LAYOUT, MINOR_UNITS, NUMERIC, YES
+
+
+def test_conversion_to_minor_units_is_exact():
+    assert to_minor_units(Decimal('6.5'), 2) == 650
+    assert to_minor_units(Decimal('6.500'), 2) == 650
+    assert to_minor_units(Decimal('-0.01'), 2) == -1
+    assert to_minor_units(Decimal('1E+3'), 0) == 1000
+    assert to_minor_units(Decimal('92233720368547758.07'), 2) == 2 ** 63 - 1
+    with pytest.raises(ValueError, match='decimal places'):
+        to_minor_units(Decimal('6.505'), 2)
+    for amount in ('92233720368547758.08', '1E+999999'):
+        with pytest.raises(ValueError, match='out of range'):
+            to_minor_units(Decimal(amount), 2)
+
+
+def test_amount_is_parsed_once(monkeypatch):
+    assert DepositRequest(user_id=1, amount='6.50').amount.value == \
+        Decimal('6.50')
+    monkeypatch.setattr(settings, 'currency', 'USD')
+    request = DepositRequest(user_id=1, amount='6.50')
+    assert request.amount == '6.50'
+    assert request.amount.value == 650
+    assert to_decimal(650) == Decimal('6.50')
+    for amount in ('6.505', '0.001', 'NaN', '-1'):
+        with pytest.raises(ValidationError):
+            DepositRequest(user_id=1, amount=amount)
+
+
+@pytest.mark.asyncio
+async def test_migration_to_minor_units(monkeypatch, sample_user1,
+                                        sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='6.5')
+    monkeypatch.setattr(settings, 'currency', 'USD')
+    # Everything is rolled back when the test disconnects
+    assert await money_minor_units() is True
+    assert await database.fetch_val(MONEY_LAYOUT) == MINOR_UNITS
+    assert await database.fetch_val(
+        query='SELECT balance FROM wallets WHERE id = :id',
+        values={'id': user1.wallet_id}) == 650
+    await create_transaction(
+        to_user_id=user1.user_id,
+        amount=DepositRequest(user_id=user1.user_id, amount='1.25').amount)
+    await create_transaction(to_user_id=user2.user_id, amount='0.75',
+                             from_user_id=user1.user_id)
+    with pytest.raises(ValueError,
+                       match='Balance 7.00. Amount 10.00'):
+        await create_transaction(to_user_id=user2.user_id, amount='10',
+                                 from_user_id=user1.user_id)
+    monkeypatch.setattr(settings, 'single_statement', YES)
+    await create_transaction(to_user_id=user2.user_id, amount='1',
+                             from_user_id=user1.user_id)
+    batch = await create_transactions_batch(items=[
+        TransferRequest(from_user_id=user2.user_id, to_user_id=user1.user_id,
+                        amount='0.05'),
+        DepositRequest(user_id=user2.user_id, amount='0.01')])
+    assert [result.status for result in batch.results] == \
+        [BatchItemStatus.applied] * 2
+    await make_wallet_hot(
+        request=HotWalletRequest(user_id=user2.user_id, slots=3))
+    await create_transaction(to_user_id=user1.user_id, amount='1.01',
+                             from_user_id=user2.user_id)
+    assert (await get_balance(user_id=user1.user_id)).balance == \
+        Decimal('7.06')
+    assert (await get_balance(user_id=user2.user_id)).balance == \
+        Decimal('0.70')
+    page = await get_transactions_page(user_id=user2.user_id, limit=1)
+    assert page.items[0].amount == Decimal('1.01')
+    assert await money_minor_units() is False
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_migration_keeps_too_precise_amounts(monkeypatch,
+                                                   sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    await create_transaction(to_user_id=user.user_id, amount='0.001')
+    monkeypatch.setattr(settings, 'currency', 'USD')
+    with pytest.raises(ValueError, match='more than 2 decimal places'):
+        await money_minor_units()
+    assert await database.fetch_val(MONEY_LAYOUT) == NUMERIC
+    await database.disconnect()
@@ -0,0 +1,102 @@
+import json
+from decimal import Decimal
+
+import pytest
+from asyncpg import UniqueViolationError
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.crud import get_balance, get_transaction
+from src.main.onboarding import onboard, get_job, OnboardingFormat, \
+    read_records, mapping_lines
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import TEST_URL, ONBOARD_USERS, ONBOARDING_JOB
+
+
+async def pieces(data: bytes, size: int = 7):
+    """Input received in small chunks, so lines are split between them"""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@pytest.mark.asyncio
+async def test_onboard_users_from_csv():
+    await init_db()
+    data = (b'last_name,first_name,balance\n'
+            b'Doe,Jane,12.5\n'
+            b'"Smith, Jr.",John,\n')
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        response = await ac.post(ONBOARD_USERS, content=data,
+                                 params={'job_id': 'csv-job'})
+        assert response.status_code == 200
+        mapping = [json.loads(line) for line in response.text.splitlines()]
+        assert [item['record'] for item in mapping] == [1, 2]
+        job = (await ac.get(ONBOARDING_JOB.format(job_id='csv-job'))).json()
+        assert job['status'] == 'done' and job['records'] == 2
+        response = await ac.get(ONBOARDING_JOB.format(job_id='unknown'))
+        assert response.status_code == 404
+    jane, john = mapping
+    balance = await get_balance(user_id=jane['user_id'])
+    assert balance.wallet_id == jane['wallet_id']
+    assert balance.balance == Decimal('12.5')
+    deposit = await get_transaction(wallet_id=jane['wallet_id'])
+    assert deposit['type'] == 'debit' and deposit['amount'] == Decimal('12.5')
+    assert (await get_balance(user_id=john['user_id'])).balance == 0
+    row = await database.fetch_one(
+        'SELECT first_name, last_name FROM users WHERE id = :id',
+        values={'id': john['user_id']})
+    assert (row['first_name'], row['last_name']) == ('John', 'Smith, Jr.')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_failed_job_is_resumed(monkeypatch):
+    await init_db()
+    monkeypatch.setattr(settings, 'onboarding_chunk_size', 2)
+    lines = [json.dumps({'first_name': f'bulk{i}', 'last_name': 'user',
+                         'balance': i}) for i in range(1, 6)]
+    broken = lines.copy()
+    broken[3] = '{"first_name": "bulk4", "balance": -1}'
+    data = '\n'.join(broken).encode()
+    committed = []
+    with pytest.raises(ValueError, match='Record 4'):
+        async for ids in onboard('ndjson-job', pieces(data),
+                                 OnboardingFormat.ndjson):
+            committed.extend(ids)
+    assert [number for number, _, _ in committed] == [1, 2]
+    job = await get_job('ndjson-job')
+    assert job['status'] == 'failed' and job['records'] == 2
+    assert 'Record 4' in job['error']
+    data = '\n'.join(lines).encode()
+    resumed = [ids async for ids in onboard('ndjson-job', pieces(data),
+                                            OnboardingFormat.ndjson)]
+    assert [[number for number, _, _ in ids] for ids in resumed] == \
+        [[3, 4], [5]]
+    for number, user_id, _ in committed + resumed[0] + resumed[1]:
+        balance = await get_balance(user_id=user_id)
+        assert balance.balance == number
+    assert (await get_job('ndjson-job'))['records'] == 5
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_quoted_fields_span_lines_and_chunks():
+    data = (b'first_name,last_name\n'
+            b'"Ann\nMarie",Smith\n'
+            b'Bob,"Lee ""Jr.""\n"\n')
+    records = [record async for chunk in
+               read_records(pieces(data, 3), OnboardingFormat.csv)
+               for record in chunk]
+    assert records == [('Ann\nMarie', 'Smith', None),
+                       ('Bob', 'Lee "Jr."\n', None)]
+
+
+@pytest.mark.asyncio
+async def test_database_error_ends_the_mapping():
+    async def chunks():
+        yield [(1, 10, 20)]
+        raise UniqueViolationError('duplicate key value')
+
+    lines = [json.loads(line) async for line in mapping_lines(chunks())]
+    assert lines[0] == {'record': 1, 'user_id': 10, 'wallet_id': 20}
+    assert lines[1] == {'error': 'UniqueViolationError: duplicate key value'}
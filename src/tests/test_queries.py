@@ -0,0 +1,85 @@
+import asyncio
+
+import databases
+import pytest
+from databases import Database
+
+from src.main.crud import GET_BALANCE_QUERY, INSERT_TRANSACTIONS_QUERY, \
+    create_user, create_transaction, get_wallet, get_transaction
+from src.main.model import TransactionType
+from src.main.queries import compile_queries, invalidate_queries, \
+    query_lock
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import YES, NO
+
+
+def test_queries_are_compiled_once():
+    compile_queries()
+    compiled = GET_BALANCE_QUERY.compiled()
+    assert GET_BALANCE_QUERY.compiled() is compiled
+    # Literals of Core expressions are bound as parameters too
+    assert compiled.names[-1] == 'user_id' and '$' in compiled.sql
+    args = compiled.args({'user_id': 7})
+    assert args[-1] == 7 and None not in args
+    assert INSERT_TRANSACTIONS_QUERY.compiled().sql.count('$') == 3
+
+
+@pytest.mark.asyncio
+async def test_compiled_queries_return_what_databases_does(monkeypatch,
+                                                           sample_user1,
+                                                           sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='10')
+    await create_transaction(to_user_id=user2.user_id, amount='3',
+                             from_user_id=user1.user_id)
+    results = []
+    for mode in (YES, NO):
+        monkeypatch.setattr(settings, 'compiled_queries', mode)
+        transaction = await get_transaction(user1.wallet_id,
+                                            TransactionType.credit)
+        results.append((await get_wallet(user1.user_id), transaction))
+    assert results[0] == results[1]
+    assert results[0][0]['balance'] == 7
+    await invalidate_queries()
+    assert not GET_BALANCE_QUERY._compiled
+    assert (await get_wallet(user2.user_id))['balance'] == 3
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_query_lock_of_known_databases_versions_only(monkeypatch,
+                                                           sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    async with database.connection() as connection:
+        lock = query_lock(connection)
+        # The lock databases holds while it runs a query
+        assert isinstance(lock, asyncio.Lock)
+        async with lock:
+            task = asyncio.ensure_future(
+                connection.fetch_val('SELECT 1'))
+            await asyncio.sleep(0.01)
+            assert not task.done()
+        assert await task == 1
+        monkeypatch.setattr(databases, '__version__', '0.6.0')
+        assert query_lock(connection) is None
+    # Unknown versions go through databases
+    assert (await get_wallet(user.user_id))['balance'] == 0
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_invalidation_replaces_pooled_connections(monkeypatch):
+    other = Database(settings.DATABASE_URL, min_size=1, max_size=1)
+    await other.connect()
+    backend_pid = 'SELECT pg_backend_pid()'
+    pid = await other.fetch_val(backend_pid)
+    await invalidate_queries(other)
+    assert await other.fetch_val(backend_pid) != pid
+    # Without the pool its connections can't be replaced
+    monkeypatch.setattr(databases, '__version__', '0.6.0')
+    with pytest.raises(RuntimeError):
+        await invalidate_queries(other)
+    await other.disconnect()
@@ -0,0 +1,99 @@
+from decimal import Decimal
+
+import asyncpg
+import pytest
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.crud import create_user, create_transaction, get_balance
+from src.main.reconciliation import reconcile, repair, ledger_horizon, \
+    replay, get_mismatches
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import TEST_URL, RECONCILIATION, LEDGER_ROWS
+
+
+async def skip_reconciled_ledger():
+    """Rows committed before the test are taken as reconciled"""
+    await database.execute(
+        query='UPDATE public.reconciliation SET transaction_id = :id',
+        values={'id': await ledger_horizon()})
+
+
+@pytest.mark.asyncio
+async def test_ledger_is_replayed_incrementally(monkeypatch, sample_user1,
+                                                sample_user2):
+    await init_db()
+    await skip_reconciled_ledger()
+    monkeypatch.setattr(settings, 'reconciliation_batch_size', 1)
+    monkeypatch.setattr(settings, 'reconciliation_pause', 0)
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='10')
+    await create_transaction(to_user_id=user2.user_id,
+                             from_user_id=user1.user_id, amount='4')
+    report = await reconcile()
+    assert (report.rows, report.wallets, report.mismatches) == (3, 2, [])
+    checkpoints = await database.fetch_all(
+        'SELECT wallet_id, balance FROM public.wallet_checkpoints '
+        'WHERE wallet_id = ANY(:ids) ORDER BY wallet_id',
+        values={'ids': [user1.wallet_id, user2.wallet_id]})
+    assert [row['balance'] for row in checkpoints] == [6, 4]
+    report = await reconcile()
+    assert (report.rows, report.wallets) == (0, 0)
+    with pytest.raises(ValueError, match='concurrent'):
+        await replay(0, 1, LEDGER_ROWS)
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_mismatch_is_found_and_repaired(sample_user1, sample_user2):
+    await init_db()
+    await skip_reconciled_ledger()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='10')
+    await create_transaction(to_user_id=user2.user_id, amount='5')
+    assert (await reconcile()).mismatches == []
+    # Balance changed without a ledger row, found once the wallet has new rows
+    await database.execute(
+        query='UPDATE public.wallets SET balance = balance + 2 WHERE id = :id',
+        values={'id': user2.wallet_id})
+    await create_transaction(to_user_id=user2.user_id,
+                             from_user_id=user1.user_id, amount='1')
+    report = await reconcile()
+    assert [(item.wallet_id, item.mismatch) for item in report.mismatches] \
+        == [(user2.wallet_id, Decimal(2))]
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        status = (await ac.get(RECONCILIATION)).json()
+        assert [item['mismatch'] for item in status['mismatches']
+                if item['wallet_id'] == user2.wallet_id] == ['2']
+    repaired = await repair([user1.wallet_id, user2.wallet_id])
+    assert [(item.wallet_id, item.mismatch) for item in repaired] == \
+        [(user2.wallet_id, Decimal(2))]
+    assert (await get_balance(user_id=user2.user_id)).balance == 6
+    assert (await get_balance(user_id=user1.user_id)).balance == 9
+    assert user2.wallet_id not in \
+        [item.wallet_id for item in await get_mismatches()]
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_horizon_waits_for_ledger_writers_only(monkeypatch):
+    # Not init_db, its DDL would hold locks the other session waits for
+    await database.connect()
+    monkeypatch.setattr(settings, 'reconciliation_horizon_timeout', 0.05)
+    horizon = await ledger_horizon(reconciled=-1)
+    other = await asyncpg.connect(str(database.url))
+    try:
+        async with other.transaction():
+            # A long reader doesn't hold the horizon back
+            await other.execute('SELECT count(*) FROM public.wallets')
+            assert await ledger_horizon(reconciled=-1) >= horizon
+            await other.execute('SET LOCAL lock_timeout = 5000')
+            await other.execute('LOCK TABLE public.transactions '
+                                'IN ROW EXCLUSIVE MODE')
+            # A writer does, the pass replays nothing new instead of failing
+            assert await ledger_horizon(reconciled=-1) == -1
+    finally:
+        await other.close()
+    await database.disconnect()
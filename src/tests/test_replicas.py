@@ -0,0 +1,81 @@
+import pytest
+from databases import Database
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.replicas import Replica, ReadRouter, parse_lsn, read_router, \
+    REPLICA_READS
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import TEST_URL, CREATE_USER, DEPOSIT_MONEY, \
+    WALLET_BALANCE, LSN_HEADER, MIN_LSN_HEADER, READ_FROM_HEADER, PRIMARY, \
+    QUEUE_DEPOSIT_MONEY, ONBOARD_USERS
+
+
+def test_lsn_is_parsed():
+    assert parse_lsn('0/16B3748') == 0x16B3748
+    assert parse_lsn('16/B374D848') == (0x16 << 32) + 0xB374D848
+    assert parse_lsn('1/0') > parse_lsn('0/FFFFFFFF')
+    with pytest.raises(ValueError):
+        parse_lsn('16B3748')
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_fresh_replicas(monkeypatch):
+    monkeypatch.setattr(settings, 'replica_wait_timeout', 0.05)
+    router = ReadRouter()
+    replica = Replica(Database(settings.DATABASE_URL), name='replica')
+    replica.replay_lsn, replica.lag = 100, 0.1
+    router.replicas = [replica]
+    assert await router.database_for() is replica.database
+    assert await router.database_for(min_lsn=100) is replica.database
+    replica.lag = settings.replica_max_lag + 1
+    assert await router.database_for() is database
+
+    async def refresh():
+        replica.replay_lsn += 50
+
+    replica.lag = 0
+    monkeypatch.setattr(replica, 'refresh', refresh)
+    # Replays a position on every check, so it catches up while waited for
+    assert await router.database_for(min_lsn=200) is replica.database
+    assert await router.database_for(min_lsn=10 ** 6) is database
+
+
+@pytest.mark.asyncio
+async def test_read_your_writes_token(monkeypatch, sample_user1):
+    await init_db()
+    # The primary plays the replica; it never reports a replayed position
+    replica = Replica(database, name='test')
+    replica.lag = 0
+    monkeypatch.setattr(read_router, 'replicas', [replica])
+    monkeypatch.setattr(settings, 'replica_wait_timeout', 0.01)
+    monkeypatch.setattr(settings, 'write_behind_workers', 1)
+    replica_reads = REPLICA_READS.labels('test').value
+    primary_reads = REPLICA_READS.labels(PRIMARY).value
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        response = await ac.post(CREATE_USER, json=sample_user1.dict())
+        user_id = response.json()['user_id']
+        response = await ac.post(DEPOSIT_MONEY,
+                                 json={'user_id': user_id, 'amount': '3'})
+        lsn = response.headers[LSN_HEADER]
+        assert parse_lsn(lsn) > 0
+        path = WALLET_BALANCE.format(user_id=user_id)
+        assert (await ac.get(path)).json()['balance'] == '3'
+        assert REPLICA_READS.labels('test').value == replica_reads + 1
+        response = await ac.get(path, headers={MIN_LSN_HEADER: lsn})
+        assert response.json()['balance'] == '3'
+        response = await ac.get(path, headers={READ_FROM_HEADER: PRIMARY})
+        assert LSN_HEADER not in response.headers
+        # A queued operation isn't committed yet, so there's no token
+        response = await ac.post(QUEUE_DEPOSIT_MONEY,
+                                 json={'user_id': user_id, 'amount': '1'})
+        assert response.status_code == 202
+        assert LSN_HEADER not in response.headers
+        # Neither are users of a bulk upload when its response starts
+        response = await ac.post(ONBOARD_USERS,
+                                 content=b'first_name,last_name\na,b\n',
+                                 params={'job_id': 'replica-job'})
+        assert response.status_code == 200
+        assert LSN_HEADER not in response.headers
+    assert REPLICA_READS.labels(PRIMARY).value == primary_reads + 2
+    await database.disconnect()
@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+import tracemalloc
+
+import pytest
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.crud import create_user, create_transaction
+from src.main.settings import database, init_db
+from src.main.statements import statement_chunks, StatementFormat
+from src.main.utils.constants import TEST_URL
+
+HISTORY_ROWS = 100000
+
+SEED_HISTORY = """
+    INSERT INTO public.transactions (wallet_id, type, amount)
+    SELECT :wallet_id, 'debit', i FROM generate_series(1, :rows) AS i
+"""
+
+
+@pytest.fixture
+async def async_client():
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        yield ac
+
+
+@pytest.mark.asyncio
+async def test_statement_endpoint(async_client, sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    await create_transaction(to_user_id=user1.user_id, amount='10.5')
+    await create_transaction(to_user_id=user2.user_id, amount='3',
+                             from_user_id=user1.user_id)
+    url = f'/wallets/{user1.user_id}/statement'
+    resp = await async_client.get(url=url)
+    assert resp.status_code == 200
+    assert resp.headers['content-type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [(line['type'], line['amount']) for line in lines] == \
+        [('debit', '10.5'), ('credit', '3')]
+    resp = await async_client.get(url=url, params={'format': 'csv'})
+    rows = list(csv.reader(io.StringIO(resp.text)))
+    assert rows[0] == ['transaction_id', 'type', 'amount',
+                       'transaction_timestamp']
+    assert [row[1:3] for row in rows[1:]] == [['debit', '10.5'],
+                                              ['credit', '3']]
+    resp = await async_client.get(url=url, params={'gzip': True})
+    assert resp.headers['content-encoding'] == 'gzip'
+    assert len(resp.text.splitlines()) == 2
+    resp = await async_client.get(url='/wallets/-1/statement')
+    assert resp.status_code == 404
+    await database.disconnect()
+
+
+async def export(wallet_id):
+    size = 0
+    lines = 0
+    tracemalloc.start()
+    async for chunk in statement_chunks(wallet_id=wallet_id,
+                                        format_=StatementFormat.ndjson):
+        size += len(chunk)
+        lines += chunk.count(b'\n')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return lines, size, peak
+
+
+@pytest.mark.asyncio
+async def test_statement_memory_is_flat(sample_user1, sample_user2):
+    await init_db()
+    short = await create_user(request=sample_user1)
+    long = await create_user(request=sample_user2)
+    for user, rows in ((short, HISTORY_ROWS // 5), (long, HISTORY_ROWS)):
+        await database.execute(query=SEED_HISTORY,
+                               values={'wallet_id': user.wallet_id,
+                                       'rows': rows})
+    short_lines, short_size, short_peak = await export(short.wallet_id)
+    long_lines, long_size, long_peak = await export(long.wallet_id)
+    assert (short_lines, long_lines) == (HISTORY_ROWS // 5, HISTORY_ROWS)
+    # Only one fetched batch is held in memory at a time
+    assert long_peak < 1.5 * short_peak
+    assert long_peak < 5 * 1024 * 1024 < long_size
+    await database.disconnect()
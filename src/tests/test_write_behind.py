@@ -0,0 +1,128 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+from httpx import AsyncClient
+
+from src.main.app import app
+from src.main.crud import create_user, get_wallet
+from src.main.model import OperationStatus
+from src.main.settings import database, init_db, settings
+from src.main.utils.constants import TEST_URL, CREATE_USER, \
+    QUEUE_DEPOSIT_MONEY, QUEUE_TRANSFER_MONEY
+from src.main.write_behind import enqueue_operation, get_operation, \
+    apply_pending_operations, operation_appender
+
+
+@pytest.fixture
+async def async_client():
+    async with AsyncClient(app=app, base_url=TEST_URL) as ac:
+        yield ac
+
+
+@pytest.mark.asyncio
+async def test_pending_operations_are_applied(sample_user1, sample_user2):
+    await init_db()
+    user1 = await create_user(request=sample_user1)
+    user2 = await create_user(request=sample_user2)
+    deposit = await enqueue_operation(to_user_id=user1.user_id, amount='30')
+    transfer = await enqueue_operation(to_user_id=user2.user_id, amount='10',
+                                       from_user_id=user1.user_id)
+    overdraft = await enqueue_operation(to_user_id=user2.user_id,
+                                        amount='100',
+                                        from_user_id=user1.user_id)
+    assert deposit.status == OperationStatus.pending
+    wallet_row = await get_wallet(user_id=user1.user_id)
+    assert wallet_row['balance'] == Decimal('0')
+    assert await apply_pending_operations(limit=1000) >= 3
+    deposit = await get_operation(operation_id=deposit.operation_id)
+    assert deposit.status == OperationStatus.applied
+    assert deposit.transaction.credit_transaction_id is None
+    transfer = await get_operation(operation_id=transfer.operation_id)
+    assert transfer.status == OperationStatus.applied
+    assert transfer.transaction.credit_transaction_id is not None
+    overdraft = await get_operation(operation_id=overdraft.operation_id)
+    assert overdraft.status == OperationStatus.rejected
+    assert overdraft.transaction is None
+    assert overdraft.error == (f'Not enough money on user {user1.user_id} '
+                               f'account. Balance 20. Amount 100')
+    wallet_row = await get_wallet(user_id=user1.user_id)
+    assert wallet_row['balance'] == Decimal('20')
+    wallet_row = await get_wallet(user_id=user2.user_id)
+    assert wallet_row['balance'] == Decimal('10')
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_operations_accepted_together_share_one_insert(sample_user1):
+    await init_db()
+    user = await create_user(request=sample_user1)
+    flushes = operation_appender.flushes
+    accepted = await asyncio.gather(*(
+        enqueue_operation(to_user_id=user.user_id, amount=str(amount))
+        for amount in range(1, 21)))
+    assert operation_appender.flushes == flushes + 1
+    assert len({operation.operation_id for operation in accepted}) == 20
+    # Every caller gets the id of its own operation
+    for amount, operation in enumerate(accepted, start=1):
+        assert await database.fetch_val(
+            'SELECT amount FROM public.operations WHERE id = :id',
+            values={'id': operation.operation_id}) == amount
+    await apply_pending_operations(limit=1000)
+    wallet_row = await get_wallet(user_id=user.user_id)
+    assert wallet_row['balance'] == Decimal(sum(range(1, 21)))
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_queue_endpoints(monkeypatch, async_client, sample_user1,
+                               sample_user2):
+    monkeypatch.setattr(settings, 'write_behind_workers', 1)
+    await init_db()
+    user1 = await async_client.post(url=CREATE_USER,
+                                    content=sample_user1.json())
+    user2 = await async_client.post(url=CREATE_USER,
+                                    content=sample_user2.json())
+    resp = await async_client.post(
+        url=QUEUE_DEPOSIT_MONEY,
+        json={'user_id': user1.json()['user_id'], 'amount': '5'})
+    assert resp.status_code == 202
+    assert resp.json()['status'] == 'pending'
+    deposit_id = resp.json()['operation_id']
+    resp = await async_client.post(
+        url=QUEUE_TRANSFER_MONEY,
+        json={'from_user_id': user1.json()['user_id'],
+              'to_user_id': user2.json()['user_id'], 'amount': '2'})
+    assert resp.status_code == 202
+    transfer_id = resp.json()['operation_id']
+    resp = await async_client.get(url=f'/operations/{transfer_id}')
+    assert resp.status_code == 200
+    assert resp.json()['status'] == 'pending'
+    await apply_pending_operations(limit=1000)
+    resp = await async_client.get(url=f'/operations/{deposit_id}')
+    assert resp.json()['status'] == 'applied'
+    resp = await async_client.get(url=f'/operations/{transfer_id}')
+    assert resp.json()['status'] == 'applied'
+    assert resp.json()['transaction']['credit_transaction_id'] is not None
+    resp = await async_client.post(
+        url=QUEUE_DEPOSIT_MONEY,
+        json={'user_id': user1.json()['user_id'], 'amount': '-5'})
+    assert resp.status_code == 400
+    resp = await async_client.get(url='/operations/0')
+    assert resp.status_code == 404
+    await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_queue_rejects_operations_without_workers(monkeypatch,
+                                                        async_client,
+                                                        sample_user1):
+    monkeypatch.setattr(settings, 'write_behind_workers', 0)
+    await init_db()
+    user = await async_client.post(url=CREATE_USER,
+                                   content=sample_user1.json())
+    resp = await async_client.post(
+        url=QUEUE_DEPOSIT_MONEY,
+        json={'user_id': user.json()['user_id'], 'amount': '5'})
+    assert resp.status_code == 503
+    await database.disconnect()